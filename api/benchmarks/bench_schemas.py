@@ -0,0 +1,50 @@
+"""Compare schema load and dump throughput before and after schema reuse and JIT.
+
+Run from the api directory, no database is required:
+    > python -m benchmarks.bench_schemas
+"""
+
+import timeit
+
+from types import SimpleNamespace
+from marshmallow import INCLUDE
+
+from utils.jit import JitSchema
+from user.forms import ClientSchema, client_update_schema, clients_schema
+
+
+def make_clients(count: int, projects: int) -> list:
+    return [SimpleNamespace(
+        name='client{}'.format(i), email='client{}@live.com'.format(i),
+        description='benchmark client description.',
+        active_projects=[SimpleNamespace(name='project{}_{}'.format(i, j),
+                                         description='benchmark project description.')
+                         for j in range(projects)])
+            for i in range(count)]
+
+
+def report(name: str, func, number: int):
+    seconds = min(timeit.repeat(func, number=number, repeat=3))
+    print('{:<40} {:>10.0f} ops/s'.format(name, number / seconds))
+
+
+def main():
+    payload = {'client_name': 'client1', 'client_email': 'client1@live.com',
+               'description': 'an updated description.'}
+    clients = make_clients(50, 5)
+
+    print('load (one client update)')
+    report('  new schema per request', lambda: ClientSchema(
+        partial=True, unknown=INCLUDE).load(payload), 2000)
+    report('  prebuilt schema', lambda: client_update_schema.load(payload), 2000)
+
+    print('dump (50 clients with 5 projects)')
+    JitSchema.jit = False
+    report('  new schema per request', lambda: ClientSchema(many=True).dump(clients), 100)
+    report('  prebuilt schema', lambda: clients_schema.dump(clients), 100)
+    JitSchema.jit = True
+    report('  prebuilt schema, compiled dump', lambda: clients_schema.dump(clients), 100)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,130 @@
+"""Compare threaded (sync) and gevent workers while many idle connections are open.
+
+For each worker class a single gunicorn worker is started against the configured
+Postgres and Redis, ``--idle`` connections are opened and left silent, and then
+authenticated profile requests are made at ``--concurrency`` alongside them.
+
+Run from the api directory with Postgres and Redis available, the open file limit
+must allow for the idle connections (eg. `ulimit -n 8192`):
+    > FLASK_ENV=development python -m benchmarks.bench_serving --idle 2000
+"""
+
+import os
+import sys
+import time
+import json
+import socket
+import argparse
+import subprocess
+import http.client
+
+from concurrent.futures import ThreadPoolExecutor
+from werkzeug.http import parse_cookie
+
+from settings import routes
+
+BENCH_USER = {'username': 'bench_user', 'password': 'bench_password',
+              'email': 'bench_user@live.com', 'first_name': 'Bench', 'last_name': 'User'}
+
+
+def start_server(worker_class: str, port: int, threads: int) -> subprocess.Popen:
+    env = dict(os.environ, WORKER_CLASS=worker_class, WEB_CONCURRENCY='1',
+               WORKER_THREADS=str(threads))
+    server = subprocess.Popen(
+        [sys.executable, '-m', 'gunicorn', '-c', 'gunicorn.conf.py',
+         '--bind', '127.0.0.1:{}'.format(port), 'run:app'], env=env)
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return server
+        except OSError:
+            time.sleep(0.2)
+    server.terminate()
+    raise RuntimeError('gunicorn did not start on port {}.'.format(port))
+
+
+def request(port: int, method: str, path: str, body=None, cookie=None, timeout=10):
+    conn = http.client.HTTPConnection('127.0.0.1', port, timeout=timeout)
+    headers = {'Content-Type': 'application/json'}
+    if cookie is not None:
+        headers['Cookie'] = 'session={}'.format(cookie)
+    try:
+        conn.request(method, path, body=json.dumps(body) if body else None, headers=headers)
+        resp = conn.getresponse()
+        resp.read()
+        return resp
+    finally:
+        conn.close()
+
+
+def login(port: int) -> str:
+    # Register the benchmark user on first use, then return a session cookie.
+    request(port, 'POST', routes.REGISTRATION, BENCH_USER)
+    resp = request(port, 'POST', routes.LOGIN, {'username': BENCH_USER['username'],
+                                               'password': BENCH_USER['password']})
+    return parse_cookie(resp.getheader('Set-Cookie'))['session']
+
+
+def open_idle(port: int, count: int) -> list:
+    sockets = []
+    for _ in range(count):
+        try:
+            sockets.append(socket.create_connection(('127.0.0.1', port), timeout=5))
+        except OSError:
+            break
+    return sockets
+
+
+def run_load(port: int, cookie: str, concurrency: int, total: int) -> dict:
+    def timed(_):
+        start = time.perf_counter()
+        try:
+            ok = request(port, 'GET', routes.PROFILE, cookie=cookie, timeout=5).status < 500
+        except OSError:
+            ok = False
+        return ok, time.perf_counter() - start
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = list(executor.map(timed, range(total)))
+    elapsed = time.perf_counter() - start
+    latencies = sorted(latency for ok, latency in results if ok)
+    return {
+        'rps': len(latencies) / elapsed,
+        'p50': latencies[len(latencies) // 2] * 1000 if latencies else float('nan'),
+        'p99': latencies[int(len(latencies) * 0.99)] * 1000 if latencies else float('nan'),
+        'errors': total - len(latencies),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--idle', type=int, default=1000, help='Idle connections to hold open.')
+    parser.add_argument('--concurrency', type=int, default=50, help='Concurrent requests.')
+    parser.add_argument('--requests', type=int, default=2000, help='Requests per worker class.')
+    parser.add_argument('--threads', type=int, default=4, help='Threads for the sync worker.')
+    parser.add_argument('--port', type=int, default=8090)
+    args = parser.parse_args()
+
+    print('{:<8} {:>6} {:>10} {:>10} {:>10} {:>8}'.format(
+        'worker', 'idle', 'req/s', 'p50 ms', 'p99 ms', 'errors'))
+    for worker_class in ('sync', 'gevent'):
+        server = start_server(worker_class, args.port, args.threads)
+        idle = []
+        try:
+            cookie = login(args.port)
+            idle = open_idle(args.port, args.idle)
+            result = run_load(args.port, cookie, args.concurrency, args.requests)
+            print('{:<8} {:>6} {:>10.0f} {:>10.1f} {:>10.1f} {:>8}'.format(
+                worker_class, len(idle), result['rps'], result['p50'], result['p99'],
+                result['errors']))
+        finally:
+            for sock in idle:
+                sock.close()
+            server.terminate()
+            server.wait()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,62 @@
+"""Compare token issue and verify throughput for each signing option.
+
+The first row parses the PEM keys on every call as the models used to, the others
+use utils.tokens.TokenSigner with keys parsed once.
+
+Run from the api directory, no database is required:
+    > python -m benchmarks.bench_tokens
+"""
+
+import jwt
+import timeit
+
+from datetime import datetime, timedelta
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives.asymmetric import ec, ed25519, rsa
+from cryptography.hazmat.primitives.serialization import (
+    Encoding, NoEncryption, PrivateFormat, PublicFormat)
+
+from utils.tokens import TokenSigner
+
+
+def make_keys(algorithm: str):
+    if algorithm == 'EdDSA':
+        key = ed25519.Ed25519PrivateKey.generate()
+    elif algorithm == 'ES256':
+        key = ec.generate_private_key(ec.SECP256R1(), default_backend())
+    else:
+        key = rsa.generate_private_key(public_exponent=65537, key_size=2048,
+                                       backend=default_backend())
+    private_pem = key.private_bytes(Encoding.PEM, PrivateFormat.PKCS8, NoEncryption())
+    public_pem = key.public_key().public_bytes(Encoding.PEM, PublicFormat.SubjectPublicKeyInfo)
+    return private_pem.decode('utf-8'), public_pem.decode('utf-8')
+
+
+def report(name: str, func, number: int):
+    seconds = min(timeit.repeat(func, number=number, repeat=3))
+    print('{:<40} {:>10.0f} tokens/s'.format(name, number / seconds))
+
+
+def main():
+    payload = {'exp': datetime.utcnow() + timedelta(days=1), 'iat': datetime.utcnow(),
+               'username': 'bench_user'}
+
+    private_pem, public_pem = make_keys('RS256')
+    token = jwt.encode(payload, private_pem.encode('utf-8'), algorithm='RS256')
+    print('RS256, PEM parsed per call')
+    report('  issue', lambda: jwt.encode(
+        payload, private_pem.encode('utf-8'), algorithm='RS256'), 200)
+    report('  verify', lambda: jwt.decode(
+        token, public_pem.encode('utf-8'), algorithms=['RS256']), 200)
+
+    for algorithm in ('RS256', 'ES256', 'EdDSA'):
+        signer = TokenSigner()
+        signer.configure(algorithm, *make_keys(algorithm))
+        token = signer.encode(payload)
+        print('{}, cached keys'.format(algorithm))
+        report('  issue', lambda: signer.encode(payload), 1000)
+        report('  verify', lambda: signer.decode(token), 1000)
+
+
+if __name__ == '__main__':
+    main()
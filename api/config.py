@@ -1,8 +1,8 @@
 import os
 
-from redis import Redis
 from pathlib import Path
 from dotenv import load_dotenv
+from utils.pools import TimedQueuePool, shared_redis
 
 def load_env():
     # Production environment variables should be injected
@@ -26,9 +26,49 @@ class Config(object):
     FLASK_ENV = os.getenv('FLASK_ENV')
     DEBUG = os.getenv('DEBUG')
     SECRET_KEY = os.getenv('SECRET_KEY')
+    # PEM encoded key pair signing account and session tokens, see utils.tokens
+    PRIVATE_KEY = os.getenv('PRIVATE_KEY')
+    PUBLIC_KEY = os.getenv('PUBLIC_KEY')
+    # RS256, ES256 or EdDSA, matching the type of the key pair
+    JWT_ALGORITHM = os.getenv('JWT_ALGORITHM', 'RS256')
+    # Public keys of rotated out key pairs, tokens they signed are still accepted
+    PREVIOUS_PUBLIC_KEYS = os.getenv('PREVIOUS_PUBLIC_KEYS')
     CSRF_ENABLED = os.getenv('CSRF_ENABLED')
     SESSION_FILE_THRESHOLD = os.getenv('SESSION_FILE_THRESHOLD')
-    MARSHMALLOW_SCHEMA_DEFAULT_JIT = 'toastedmarshmallow.Jit'
+    # Compile schema dump functions, see utils.jit
+    MARSHMALLOW_JIT = os.getenv('MARSHMALLOW_JIT', 'True') == 'True'
+    # Encoder for response bodies, orjson or json, see utils.fastjson
+    JSON_PROVIDER = os.getenv('JSON_PROVIDER', 'orjson')
+    # Request, SQL, Redis and hashing metrics served on /metrics, see utils.metrics
+    METRICS_ENABLED = os.getenv('METRICS_ENABLED', 'True') == 'True'
+    # /metrics and /status/* answer STATUS_ALLOWED_IPS, a comma separated list, and
+      # requests with an "Authorization: Bearer <STATUS_TOKEN>" header
+    STATUS_TOKEN = os.getenv('STATUS_TOKEN')
+    STATUS_ALLOWED_IPS = [ip.strip() for ip in os.getenv('STATUS_ALLOWED_IPS', '').split(',')
+                          if ip.strip()]
+    # Sharing of each worker's statistics for the status endpoints, see utils.snapshots
+    STATUS_PUBLISH_INTERVAL = int(os.getenv('STATUS_PUBLISH_INTERVAL', 10))
+    STATUS_WORKER_TIMEOUT = int(os.getenv('STATUS_WORKER_TIMEOUT', 60))
+    STATUS_SNAPSHOT_RETENTION = int(os.getenv('STATUS_SNAPSHOT_RETENTION', 86400))
+    # Slow query log and N+1 detection for development, see utils.queries
+    QUERY_INSPECTOR_ENABLED = os.getenv('QUERY_INSPECTOR_ENABLED', 'False') == 'True'
+    SLOW_QUERY_THRESHOLD_MS = int(os.getenv('SLOW_QUERY_THRESHOLD_MS', 100))
+    N_PLUS_ONE_THRESHOLD = int(os.getenv('N_PLUS_ONE_THRESHOLD', 3))
+
+    # Worker sizing, WEB_CONCURRENCY is also read by gunicorn for its worker count
+    WORKERS = int(os.getenv('WEB_CONCURRENCY', 1))
+    WORKER_THREADS = int(os.getenv('WORKER_THREADS', 1))
+    # sync (threaded) or gevent workers, see gunicorn.conf.py
+    WORKER_CLASS = os.getenv('WORKER_CLASS', 'sync')
+    WORKER_CONNECTIONS = int(os.getenv('WORKER_CONNECTIONS', 1000))
+
+    # Pagination
+    PAGE_SIZE = int(os.getenv('PAGE_SIZE', 50))
+    MAX_PAGE_SIZE = int(os.getenv('MAX_PAGE_SIZE', 200))
+
+    # Bulk Client Import and Export
+    CLIENT_IMPORT_BATCH_SIZE = int(os.getenv('CLIENT_IMPORT_BATCH_SIZE', 500))
+    CLIENT_EXPORT_BATCH_SIZE = int(os.getenv('CLIENT_EXPORT_BATCH_SIZE', 1000))
 
     # Database Config
     SQLALCHEMY_TRACK_MODIFICATIONS = False
@@ -36,9 +76,21 @@ class Config(object):
     POSTGRES_USER = os.getenv('POSTGRES_USER')
     POSTGRES_PASSWORD = os.getenv('POSTGRES_PASSWORD')
     POSTGRES_DB_NAME = os.getenv('POSTGRES_DB_NAME')
+    POSTGRES_MAX_CONNECTIONS = int(os.getenv('POSTGRES_MAX_CONNECTIONS', 100))
+    DB_POOL_TIMEOUT = int(os.getenv('DB_POOL_TIMEOUT', 10))
+    DB_POOL_RECYCLE = int(os.getenv('DB_POOL_RECYCLE', 1800))
+
+    # Read Replicas, comma separated URIs of standbys serving reads, see utils.replicas
+    REPLICA_URIS = [uri for uri in os.getenv('REPLICA_URIS', '').split(',') if uri]
+    REPLICA_MAX_LAG = float(os.getenv('REPLICA_MAX_LAG', 1.0))
+    REPLICA_LAG_CHECK_INTERVAL = float(os.getenv('REPLICA_LAG_CHECK_INTERVAL', 5))
+    REPLICA_STICKY_SECONDS = int(os.getenv('REPLICA_STICKY_SECONDS', 5))
 
-    # Session Config
-    SESSION_TYPE = 'redis'
+    # Session Config, redis or token for stateless signed sessions, see utils.sessions
+    SESSION_TYPE = os.getenv('SESSION_TYPE', 'redis')
+    SESSION_TOKEN_TTL = int(os.getenv('SESSION_TOKEN_TTL', 300))
+    # Seconds between expiry refreshes of an unmodified Redis session
+    SESSION_REFRESH_INTERVAL = int(os.getenv('SESSION_REFRESH_INTERVAL', 300))
     SESSION_USE_SIGNER = True
     SESSION_COOKIE_HTTPONLY = os.getenv('SESSION_COOKIE_HTTPONLY')
     SESSION_PERMANENT = os.getenv('SESSION_PERMANENT')
@@ -46,7 +98,53 @@ class Config(object):
     # Configure Redis Sessions
     REDIS_HOST = os.getenv('REDIS_HOST')
     REDIS_PORT = os.getenv('REDIS_PORT')
+    REDIS_POOL_TIMEOUT = int(os.getenv('REDIS_POOL_TIMEOUT', 5))
+    REDIS_MAX_CONNECTIONS = int(os.getenv('REDIS_MAX_CONNECTIONS', 200))
+
+    # Background Tasks, redis or eager to run tasks in process, see utils.tasks
+    TASK_QUEUE_BACKEND = os.getenv('TASK_QUEUE_BACKEND', 'redis')
+    TASK_MAX_RETRIES = int(os.getenv('TASK_MAX_RETRIES', 3))
+    TASK_RETRY_DELAY = float(os.getenv('TASK_RETRY_DELAY', 10))
+    TASK_WORKER_TIMEOUT = int(os.getenv('TASK_WORKER_TIMEOUT', 60))
+
+    # Email, smtp, console or memory, see utils.mail
+    MAIL_BACKEND = os.getenv('MAIL_BACKEND', 'console')
+    MAIL_SENDER = os.getenv('MAIL_SENDER', 'noreply@localhost')
+    MAIL_SERVER = os.getenv('MAIL_SERVER')
+    MAIL_PORT = int(os.getenv('MAIL_PORT', 587))
+    MAIL_USERNAME = os.getenv('MAIL_USERNAME')
+    MAIL_PASSWORD = os.getenv('MAIL_PASSWORD')
+    MAIL_USE_TLS = os.getenv('MAIL_USE_TLS', 'True') == 'True'
+    MAIL_TIMEOUT = float(os.getenv('MAIL_TIMEOUT', 10))
+
+    # Login and Registration Rate Limits, see settings.routes.RATE_LIMITS
+    RATE_LIMIT_ENABLED = os.getenv('RATE_LIMIT_ENABLED', 'True') == 'True'
+
+    # Authenticated User Cache
+    USER_CACHE_ENABLED = os.getenv('USER_CACHE_ENABLED', 'True') == 'True'
+    USER_CACHE_SIZE = int(os.getenv('USER_CACHE_SIZE', 1024))
+    USER_CACHE_TTL = int(os.getenv('USER_CACHE_TTL', 30))
+    USER_CACHE_USE_REDIS = os.getenv('USER_CACHE_USE_REDIS', 'False') == 'True'
 
+    # Serialized Response Cache
+    RESPONSE_CACHE_ENABLED = os.getenv('RESPONSE_CACHE_ENABLED', 'True') == 'True'
+    RESPONSE_CACHE_TTL = int(os.getenv('RESPONSE_CACHE_TTL', 300))
+    RESPONSE_CACHE_MAX_BYTES = int(os.getenv('RESPONSE_CACHE_MAX_BYTES', 1048576))
+
+    # HTTP Caching of id addressed resources, shared caches must key on the Cookie header
+    HTTP_CACHE_MAX_AGE = int(os.getenv('HTTP_CACHE_MAX_AGE', 0))
+    HTTP_CACHE_SHARED = os.getenv('HTTP_CACHE_SHARED', 'False') == 'True'
+
+    # Password Hashing Pool
+    PASSWORD_HASH_EXECUTOR = os.getenv('PASSWORD_HASH_EXECUTOR',
+                                       'gevent' if WORKER_CLASS == 'gevent' else 'thread')
+    PASSWORD_HASH_WORKERS = int(os.getenv('PASSWORD_HASH_WORKERS', 2))
+    PASSWORD_HASH_QUEUE_SIZE = int(os.getenv('PASSWORD_HASH_QUEUE_SIZE', 8))
+    PASSWORD_HASH_TIMEOUT = float(os.getenv('PASSWORD_HASH_TIMEOUT', 5))
+    # Argon2 costs, generate values for a host with `flask calibrate-hasher`
+    ARGON2_TIME_COST = int(os.getenv('ARGON2_TIME_COST', 2))
+    ARGON2_MEMORY_COST = int(os.getenv('ARGON2_MEMORY_COST', 102400))
+    ARGON2_PARALLELISM = int(os.getenv('ARGON2_PARALLELISM', 8))
 
     @property
     def SQLALCHEMY_DATABASE_URI(self):
@@ -55,6 +153,39 @@ class Config(object):
                                                  self.POSTGRES_HOST, 
                                                  self.POSTGRES_DB_NAME)
 
+    @property
+    def SQLALCHEMY_BINDS(self):
+        return {'replica_{}'.format(index): uri for index, uri in enumerate(self.REPLICA_URIS)}
+
+    @property
+    def REQUEST_CONCURRENCY(self):
+        # Requests a worker process serves at once, greenlets for gevent workers
+          # and threads otherwise.
+        if self.WORKER_CLASS == 'gevent':
+            return self.WORKER_CONNECTIONS
+        return self.WORKER_THREADS
+
+    @property
+    def SQLALCHEMY_ENGINE_OPTIONS(self):
+        # Each worker process holds a connection per concurrent request, pool size
+          # and overflow are capped so that all workers together stay within the
+          # server's connection limit. Further greenlets wait for a connection.
+        per_worker = max(1, self.POSTGRES_MAX_CONNECTIONS // self.WORKERS)
+        pool_size = min(self.REQUEST_CONCURRENCY, per_worker)
+        spare = per_worker - pool_size
+        return {
+            'poolclass': TimedQueuePool,
+            'pool_size': pool_size,
+            'max_overflow': max(0, min(pool_size, spare)),
+            'pool_timeout': self.DB_POOL_TIMEOUT,
+            'pool_recycle': self.DB_POOL_RECYCLE,
+            'pool_pre_ping': True,
+        }
+
     @property
     def SESSION_REDIS(self):
-        return Redis(host=self.REDIS_HOST, port=self.REDIS_PORT)
+        # Sessions and caches may each hold a connection while a request is served.
+        return shared_redis(self.REDIS_HOST, self.REDIS_PORT,
+                            max_connections=min(self.REQUEST_CONCURRENCY * 2 + 1,
+                                                self.REDIS_MAX_CONNECTIONS),
+                            timeout=self.REDIS_POOL_TIMEOUT)
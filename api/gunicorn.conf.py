@@ -0,0 +1,19 @@
+import os
+
+# Connection pools in config.py are sized from the same variables.
+bind = '0.0.0.0:8080'
+workers = int(os.getenv('WEB_CONCURRENCY', 1))
+threads = int(os.getenv('WORKER_THREADS', 1))
+
+# WORKER_CLASS=gevent serves each request on a greenlet, so a worker can hold
+  # WORKER_CONNECTIONS mostly idle connections while Postgres and Redis calls yield.
+worker_class = os.getenv('WORKER_CLASS', 'sync')
+worker_connections = int(os.getenv('WORKER_CONNECTIONS', 1000))
+
+
+def post_worker_init(worker):
+    # gevent workers have monkey patched sockets by now, psycopg2 also needs a
+      # wait callback since it talks to Postgres through libpq rather than Python.
+    if worker.cfg.worker_class_str == 'gevent':
+        from psycogreen.gevent import patch_psycopg
+        patch_psycopg()
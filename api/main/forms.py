@@ -1,9 +1,10 @@
-from marshmallow import Schema, fields, validate
+from marshmallow import fields, validate
 from marshmallow.validate import Validator
 from utils.custom_forms import Regexr
+from utils.jit import JitSchema
 
 
-class UserSchema(Schema):
+class UserSchema(JitSchema):
     """Validate provided user information."""
     username = fields.String(
         validate=[
@@ -36,10 +37,10 @@ class UserSchema(Schema):
         ],
         load_only=True
     )
-    clients = fields.Nested("ClientSchema", exclude=['projects'],
+    clients = fields.Nested("ClientSchema", exclude=['projects'], attribute='active_clients',
         many=True, dump_only=True, allow_none=True)
 
-class UpdateUserSchema(Schema):
+class UpdateUserSchema(JitSchema):
     """Validate a user's new password along with their other information."""
     user = fields.Nested(UserSchema)
     new_password = fields.Str(
@@ -49,7 +50,7 @@ class UpdateUserSchema(Schema):
             Regexr(r'\W', error='New password must only be contain letters and numbers.')
         ])
 
-class ConfirmUserPasswordSchema(Schema):
+class ConfirmUserPasswordSchema(JitSchema):
     """Validate length and characters for password."""
     confirm_password = fields.Str(
         validate=[
@@ -58,3 +59,11 @@ class ConfirmUserPasswordSchema(Schema):
             Regexr(r'\W', error='New password must only be contain letters and numbers.')
         ])
 
+
+# Prebuilt schema variants shared by all requests. Schemas keep no state between
+  # load and dump calls, so a single instance can be used from many threads.
+user_schema = UserSchema()
+login_schema = UserSchema(exclude=['first_name', 'last_name', 'email', 'clients'])
+registration_schema = UserSchema(exclude=['clients'])
+update_user_schema = UpdateUserSchema(partial=True)
+confirm_password_schema = ConfirmUserPasswordSchema()
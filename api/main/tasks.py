@@ -0,0 +1,30 @@
+from models import User
+from utils.mail import mailer
+from utils.tasks import task_queue
+
+
+@task_queue.task
+def send_registration_confirmation(user_id: int):
+    """Email a new user the token that confirms their account."""
+    user = User.query.filter_by(id=user_id).first()
+    if user is None:
+        # Retried in case the user was queried before the registration committed.
+        raise LookupError('User {} does not exist.'.format(user_id))
+    token = user.generate_username_token()
+    if not token:
+        raise ValueError('Unable to generate a confirmation token.')
+    mailer.send(user.email, 'Confirm your account',
+                'Use this code to confirm your account: {}'.format(token))
+
+
+@task_queue.task
+def send_email_change_confirmation(user_id: int, new_email: str):
+    """Email the token that confirms a change of email address to the new address."""
+    user = User.query.filter_by(id=user_id).first()
+    if user is None:
+        return
+    token = user.generate_email_change_token(new_email)
+    if not token:
+        raise ValueError('Unable to generate an email change token.')
+    mailer.send(new_email, 'Confirm your new email address',
+                'Use this code to confirm your new email address: {}'.format(token))
@@ -6,23 +6,36 @@ from flask.views import MethodView
 from marshmallow import ValidationError
 from marshmallow import INCLUDE
 
-from .forms import UserSchema
-from .forms import UpdateUserSchema
-from .forms import ConfirmUserPasswordSchema
+from .forms import user_schema
+from .forms import login_schema
+from .forms import registration_schema
+from .forms import update_user_schema
+from .forms import confirm_password_schema
+from .tasks import send_email_change_confirmation
+from .tasks import send_registration_confirmation
 from utils.auth import generate_session
+from utils.auth import list_sessions
 from utils.auth import login_required
 from utils.auth import remove_session
+from utils.auth import revoke_sessions
+from utils.fastjson import json_response
+from utils.hashing import HashingUnavailable
+from utils.ratelimit import rate_limit
+from utils.versions import conditional_get
+from utils.versions import current_user_version
 from models import User
 from models import db
+from models import transaction
 
 
 class LoginView(MethodView):
     """Validate a given user's and manage access to secure interface."""
+    decorators = [rate_limit]
+
+    @transaction()
     def post(self):
         # get json data from post request
         json_data = request.get_json()
-        # initialize user login schema
-        login_schema = UserSchema(exclude=['first_name', 'last_name', 'email', 'clients'])
         try: # check for errors in form data
             data = login_schema.load(json_data)
         except ValidationError as err:
@@ -33,25 +46,33 @@ class LoginView(MethodView):
             return jsonify({'errors': 'User with that username does not exist.'}), 422
         if not user.verify_password(data['password']):
             return jsonify({'errors': 'Username and password do not match.'}), 422
-        user_schema = UserSchema()
-        resp_object = user_schema.dumps(user)
+        if user.password_needs_rehash():
+            # upgrade hashes created with outdated parameters while the password is known
+            try:
+                user.set_password(data['password'])
+            except HashingUnavailable:
+                pass
+        resp_object = user_schema.dump_json(user)
         generate_session(user.username)
-        return jsonify(resp_object), 201
+        return json_response(resp_object, 201)
 
 
 class LogoutView(MethodView):
     """Remove a user's session from session table."""
     def post(self):
         remove_session()
+        return jsonify({'success': 'Logged out.'}), 200
 
 
 class RegistrationView(MethodView):
     """Create a new user View to deal with user registration flow."""
+    decorators = [rate_limit]
+
+    @transaction()
     def post(self):
         json_data = request.get_json()
-        user_schema = UserSchema(exclude=['clients'])
         try:
-            data = user_schema.load(json_data)
+            data = registration_schema.load(json_data)
         except ValidationError as err:
             return jsonify({'errors': err.messages}), 422
         user = User.query.filter_by(username=data['username']).first()
@@ -60,66 +81,79 @@ class RegistrationView(MethodView):
         try:
             user = User(**data) # automatically assign dictionary values to object
             user.add()
+        except HashingUnavailable:
+            raise
         except:
+            db.session.rollback()
             return jsonify({'errors': 'Unable to add user.'}), 422
         
-        resp_object = user_schema.dump(user)
+        send_registration_confirmation.delay(user.id)
+        resp_object = registration_schema.dump_json(user)
         generate_session(user.username)
-        return jsonify(resp_object), 201
+        return json_response(resp_object, 201)
 
 class HomeView(MethodView):
     """Resource to allow user to manage their personal account."""
     decorators = [login_required]
     
+    @conditional_get(current_user_version)
     def get(self):
         """Retrieve information about a given user to endpoint."""
-        user_schema = UserSchema()
-        resp_object = user_schema.dump(g.user)
-        return jsonify(resp_object), 202
+        resp_object = user_schema.dump_json(g.user)
+        return json_response(resp_object, 202)
 
+    @transaction()
     def put(self):
         """Update and validate a provided user's information."""
         json_input = request.get_json()
-        update_schema = UpdateUserSchema(partial=True)
         try:
-            data = update_schema.load(json_input)
+            data = update_user_schema.load(json_input)
         except ValidationError as err:
             return jsonify({'errors': err.messages}), 422
 
-        user_schema = UserSchema()
         if 'new_password' in data:
             if not g.user.verify_password(data['user']['password']):
                 return jsonify({'errors': 'Must enter proper current password.'}), 422
-            g.user.password = data['new_password']
-            g.user.hash_password()
-            db.session.add(g.user)
-            db.session.commit()
-            ret_vals = user_schema.dump(g.user)
-            return jsonify(ret_vals), 202
+            g.user.set_password(data['new_password'])
+            revoke_sessions(g.user.username, keep_current=True)
+            ret_vals = user_schema.dump_json(g.user)
+            return json_response(ret_vals, 202)
 
         if 'email' in data:
-            g.user.generate_email_change_token(data['email'])
-
-            # send verification email to client using desired API
-
-            ret_vals = user_schema.dump(g.user)
-            return jsonify(ret_vals), 202
+            send_email_change_confirmation.delay(g.user.id, data['email'])
+            ret_vals = user_schema.dump_json(g.user)
+            return json_response(ret_vals, 202)
 
         g.user.update(**data['user'])
-        ret_vals = user_schema.dump(g.user)
-        return jsonify(ret_vals), 202
+        ret_vals = user_schema.dump_json(g.user)
+        return json_response(ret_vals, 202)
 
+    @transaction()
     def delete(self):
         """Delete a user permanently from the database."""
         json_input = request.get_json()
-        delete_schema = ConfirmUserPasswordSchema()
         try:
-            data = delete_schema.load(json_input)
+            data = confirm_password_schema.load(json_input)
         except ValidationError as err:
             return jsonify({'errors': err.messages}), 422
         if not g.user.verify_password(data['confirm_password']):
             return jsonify({'errors': 'Username and password do not match.'}), 422
+        username = g.user.username
         g.user.permanently_delete()
-        remove_session()
+        revoke_sessions(username)
         return jsonify({'success': 'Account has been permanently deleted.'}), 308
 
+
+class SessionsView(MethodView):
+    """List and revoke the sessions a user is logged in with."""
+    decorators = [login_required]
+
+    def get(self):
+        """Retrieve the user's active sessions."""
+        return json_response({'sessions': list_sessions(g.user.username)}, 200)
+
+    def delete(self):
+        """Log the user out of every session, including the current one."""
+        count = revoke_sessions(g.user.username)
+        return jsonify({'success': 'Logged out of {} sessions.'.format(count)}), 200
+
@@ -8,13 +8,78 @@ called. In a perfect world, this encourages more readable and condensed view met
 
 import jwt
 
+from contextlib import contextmanager
 from datetime import datetime, timedelta
-from flask import current_app
-from argon2 import PasswordHasher
-from argon2.exceptions import VerifyMismatchError, InvalidHash
-from flask_sqlalchemy import SQLAlchemy, BaseQuery
-
-db = SQLAlchemy()
+from functools import partial
+from flask_sqlalchemy import BaseQuery
+from sqlalchemy import event
+from sqlalchemy.orm import make_transient_to_detached
+
+from utils.cache import user_cache
+from utils.hashing import hashing_pool
+from utils.pagination import paginate
+from utils.replicas import RoutingSession, RoutingSQLAlchemy
+from utils.tokens import token_signer
+from utils.versions import data_versions
+
+db = RoutingSQLAlchemy()
+
+
+@contextmanager
+def transaction():
+    """Unit of work scope deferring the commits of model methods to the end of the block.
+
+    Model methods called in the block flush their changes, so database errors are raised
+    where the change is made, and the block commits once when it exits or rolls back if
+    it raises. Cache invalidations and version bumps queued by the model methods run after
+    that commit. Blocks may be nested, only the outermost one commits. It can also
+    decorate a view so that a request commits once.
+    """
+    session = db.session()
+    depth = session.info.get('transaction_depth', 0)
+    if depth == 0:
+        session.info['after_commit'] = []
+    session.info['transaction_depth'] = depth + 1
+    try:
+        yield session
+        if depth == 0:
+            session.commit()
+    except:
+        if depth == 0:
+            session.info.pop('after_commit', None)
+            session.rollback()
+        raise
+    finally:
+        session.info['transaction_depth'] = depth
+    if depth == 0:
+        for callback in session.info.pop('after_commit'):
+            callback()
+
+
+def commit(*callbacks):
+    # Commit the session and then run callbacks, or flush it and queue the callbacks
+      # for the commit ending the enclosing transaction() block.
+    session = db.session()
+    if session.info.get('transaction_depth'):
+        session.flush()
+        session.info['after_commit'].extend(callbacks)
+        return
+    session.commit()
+    for callback in callbacks:
+        callback()
+
+
+@event.listens_for(RoutingSession, 'after_soft_rollback')
+def discard_callbacks(session, previous_transaction):
+    # A rollback inside a transaction() block, eg. a view recovering from an
+      # IntegrityError, undoes the writes the queued callbacks were for.
+    if 'after_commit' in session.info:
+        session.info['after_commit'] = []
+
+
+def identity(instance) -> int:
+    # Primary key of a persisted instance, read without refreshing it after a commit.
+    return db.inspect(instance).identity[0]
 
 
 class QueryWithSoftDelete(BaseQuery):
@@ -59,52 +124,82 @@ class User(db.Model):
     deleted = db.Column(db.Boolean(), default=False)
     deleted_on = db.Column(db.DateTime, default=datetime.utcnow)
     clients = db.relationship('Client', backref='user', lazy='dynamic')
+    # Read only collection of clients that can be eager loaded for serialization.
+    active_clients = db.relationship(
+        'Client', primaryjoin='and_(User.id == Client.user_id, Client.deleted == False)',
+        order_by='Client.created_at', viewonly=True)
+
+    # Columns that are never written to the user cache, they are loaded on access instead.
+    uncached_columns = ('password',)
 
     def __repr__(self) -> str:
         return ('<User {} {}>'.format(self.first_name, self.last_name))
-    
+
+    @classmethod
+    def get_by_username(cls, username: str):
+        # Retrieve an active user, using the user cache to avoid a query when possible.
+        state, generation = user_cache.get(username)
+        if state is not None:
+            user = cls(**state)
+            make_transient_to_detached(user)
+            return db.session.merge(user, load=False)
+        user = cls.query.filter_by(username=username).first()
+        if user is not None:
+            user_cache.set(username, user.cache_state(), generation)
+        return user
+
+    def cache_state(self) -> dict:
+        # Return loaded column values that can safely be stored in the user cache.
+        return {column.key: getattr(self, column.key)
+                for column in db.inspect(self.__class__).column_attrs
+                if column.key not in self.uncached_columns}
+
     def add(self):
         self.hash_password()
         db.session.add(self)
-        db.session.commit()
+        commit()
 
     def update(self, **kwargs):
+        id, username = self.id, self.username
         for key, value in kwargs.items():
             setattr(self, key, value)
         db.session.add(self)
-        db.session.commit()
+        commit(partial(user_cache.invalidate, username), partial(data_versions.bump_user, id))
 
     def check_deleted(self) -> bool:
         return self.deleted
 
     def delete(self):
         # Save delete date and remove entry from database query
+        id, username = self.id, self.username
         if self.deleted is False:
             self.deleted = True
             self.deleted_on = datetime.utcnow()
         db.session.add(self)
-        db.session.commit()
+        commit(partial(user_cache.invalidate, username), partial(data_versions.bump_user, id))
 
     def permanently_delete(self):
         # permanently delete a user from the database.
+        id, username = self.id, self.username
         db.session.delete(self)
-        db.session.commit()
+        commit(partial(user_cache.invalidate, username), partial(data_versions.bump_user, id))
 
     def hash_password(self):
-        hasher = PasswordHasher()
-        self.password = hasher.hash(self.password)
+        # Hashing runs on the hashing pool and raises HashingUnavailable when it is full.
+        self.password = hashing_pool.hash(self.password)
 
     def verify_password(self, password: str) -> bool:
-        # Return false if passwords do not match or if 
-          # password hash has been tampered.
-        try:
-            hasher = PasswordHasher()
-            hasher.verify(self.password, password)
-            return True
-        except VerifyMismatchError:
-            return False
-        except InvalidHash:
-            return False
+        return hashing_pool.verify(self.password, password)
+
+    def password_needs_rehash(self) -> bool:
+        return hashing_pool.needs_rehash(self.password)
+
+    def set_password(self, password: str):
+        # Hash and store a new password using the current hasher parameters.
+        self.password = password
+        self.hash_password()
+        db.session.add(self)
+        commit()
 
     def generate_username_token(self, days: int = 1, seconds: int = 60):
         # Generate a new token based on provided username
@@ -114,24 +209,20 @@ class User(db.Model):
                 'iat': datetime.utcnow(),
                 'username': self.username
             }
-            return jwt.encode(
-                payload,
-                current_app.config['PRIVATE_KEY'].encode('utf-8'),
-                algorithm='RS256'
-            ).decode('utf-8')
+            return token_signer.encode(payload)
         except:
             return False
 
     def confirm_user(self, token: str) -> bool:
         # Create user and return true if provided token is valid, otherwise return false
         try:
-            data = jwt.decode(token, current_app.config['PUBLIC_KEY'].encode('utf-8'),
-                algorithms=['RS256'])
+            data = token_signer.decode(token)
             if data['username'] != self.username:
                 return False
             self.confirmed = True
             db.session.add(self)
-            db.session.commit()
+            commit(partial(user_cache.invalidate, data['username']),
+                   partial(data_versions.bump_user, self.id))
             return True
         except jwt.ExpiredSignatureError:
             return False
@@ -147,26 +238,22 @@ class User(db.Model):
                 'username': self.username,
                 'new_email': new_email
             }
-            return jwt.encode(
-                payload,
-                current_app.config['PRIVATE_KEY'].encode('utf-8'),
-                algorithm='RS256'
-            ).decode('utf-8')
+            return token_signer.encode(payload)
         except:
             return False
 
     def confirm_email_change(self, token: str) -> bool:
         # Verify that token associated with new e-mail matches, otherwise return false
         try:
-            data = jwt.decode(token, current_app.config['PUBLIC_KEY'].encode('utf-8'),
-                algorithms=['RS256'])
+            data = token_signer.decode(token)
             if data['username'] != self.username:
                 return False
             if data['new_email'] is None:
                 return False
             self.email = data['new_email']
             db.session.add(self)
-            db.session.commit()
+            commit(partial(user_cache.invalidate, data['username']),
+                   partial(data_versions.bump_user, self.id))
             return True
         except jwt.ExpiredSignatureError:
             return False
@@ -176,10 +263,51 @@ class User(db.Model):
     def get_client(self, name: str, email: str):
         # Retrieve a client based on provided user (self), and the
           # client's name and email.
-        return self.clients.filter_by(name=name, email=email).first()
+        return self.clients.filter_by(name=name, email=email, deleted=False).first()
+
+    def get_client_id(self, name: str, email: str):
+        # Look up only the id of a client found by get_client, or None.
+        row = (self.clients.with_entities(Client.id)
+               .filter_by(name=name, email=email, deleted=False).first())
+        return row[0] if row is not None else None
+
+    def get_client_by_id(self, client_id: int):
+        # Retrieve an active client of this user by primary key, from the identity map
+          # when it is already loaded.
+        client = Client.query.get(client_id)
+        if client is None or client.user_id != self.id or client.deleted:
+            return None
+        return client
 
     def get_clients(self) -> list:
-        return self.clients.all()
+        # Projects are batch loaded with a single query for all returned clients.
+        query = self.clients.filter_by(deleted=False).options(db.selectinload(Client.active_projects))
+        return query.all()
+
+    def export_clients(self, batch_size: int = 1000):
+        # Yield (client, projects) for every active client, reading rows through a
+          # server side cursor so memory use does not depend on the number of clients.
+        query = (db.session.query(Client, Project)
+                 .outerjoin(Project, db.and_(Project.client_id == Client.id,
+                                             Project.deleted == False))
+                 .filter(Client.user_id == self.id, Client.deleted == False)
+                 .order_by(Client.id, Project.id)
+                 .yield_per(batch_size))
+        client, projects = None, []
+        for row_client, project in query:
+            if client is None or row_client.id != client.id:
+                if client is not None:
+                    yield client, projects
+                client, projects = row_client, []
+            if project is not None:
+                projects.append(project)
+        if client is not None:
+            yield client, projects
+
+    def get_clients_page(self, after: tuple = None, limit: int = 50) -> tuple:
+        # Retrieve a page of active clients in creation order and the cursor for the next page.
+        query = self.clients.filter_by(deleted=False).options(db.selectinload(Client.active_projects))
+        return paginate(query, Client, after, limit)
 
 
 class Client(db.Model):
@@ -188,6 +316,13 @@ class Client(db.Model):
     * A client can be deleted using soft-delete or permanent delete.
     """
     __tablename__ = 'client'
+    __table_args__ = (
+        # Lookups by name and email, and listings of a user's active clients.
+        db.Index('ix_client_user_id_name_email', 'user_id', 'name', 'email',
+                 postgresql_where=db.text('deleted = false')),
+        db.Index('ix_client_user_id_created_at', 'user_id', 'created_at', 'id',
+                 postgresql_where=db.text('deleted = false')),
+    )
     
     id = db.Column(db.Integer, primary_key=True, nullable=False)
     email = db.Column(db.String(150))
@@ -195,33 +330,89 @@ class Client(db.Model):
     description = db.Column(db.Text())
     created_at = db.Column(db.DateTime, index=True, default=datetime.utcnow)
     projects = db.relationship('Project', backref='client', lazy='dynamic')
+    # Read only collection of projects that can be eager loaded for serialization.
+    active_projects = db.relationship(
+        'Project', primaryjoin='and_(Client.id == Project.client_id, Project.deleted == False)',
+        order_by='Project.created_at', viewonly=True)
     deleted = db.Column(db.Boolean(), default=False)
     deleted_on = db.Column(db.DateTime, default=datetime.utcnow)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'))
 
     def add(self, user, **kwargs):
-        self.users = user
+        self.user = user
         for key, value in kwargs.items():
             setattr(self, key, value)
         db.session.add(self)
-        db.session.commit()
+        commit(self.version_bumper())
     
     def update(self, **kwargs):
         for key, value in kwargs.items():
             setattr(self, key, value)
         db.session.add(self)
-        db.session.commit()
+        commit(self.version_bumper())
 
     def delete(self):
         if self.deleted is False:
             self.deleted = True
             self.deleted_on = datetime.utcnow()
         db.session.add(self)
-        db.session.commit()
+        commit(self.version_bumper())
 
     def permanently_delete(self):
+        bump = self.version_bumper()
         db.session.delete(self)
-        db.session.commit()
+        commit(bump)
+
+    def version_bumper(self):
+        # Return a callback bumping the versions of this client and its owner. The
+          # client's id is read when the callback runs, after the commit has assigned
+          # it, and a client added in the same transaction() block has no user_id
+          # until it is flushed.
+        user_id = self.user_id
+        if user_id is None and self.user is not None:
+            user_id = self.user.id
+        return lambda: data_versions.bump_client(identity(self), user_id)
+
+    @staticmethod
+    def add_many(user_id: int, rows: list) -> list:
+        # Insert rows as clients of user_id with a single multi-row INSERT and commit.
+          # Rows whose name and email match an active client, or an earlier row,
+          # are skipped. Return whether each row was created. Callers pass the id
+          # rather than the user, which is expired by each commit.
+        pairs = {(row['name'], row['email']) for row in rows}
+        existing = set()
+        if pairs:
+            existing = set(db.session.query(Client.name, Client.email).filter(
+                Client.user_id == user_id, Client.deleted == False,
+                db.tuple_(Client.name, Client.email).in_(pairs)))
+        now = datetime.utcnow()
+        new_rows = []
+        created = []
+        for row in rows:
+            key = (row['name'], row['email'])
+            created.append(key not in existing)
+            if key in existing:
+                continue
+            existing.add(key)
+            new_rows.append({'user_id': user_id, 'name': row['name'], 'email': row['email'],
+                             'description': row.get('description'), 'created_at': now,
+                             'deleted': False, 'deleted_on': now})
+        if new_rows:
+            db.session.execute(Client.__table__.insert().values(new_rows))
+        callbacks = [partial(data_versions.bump_user, user_id)] if new_rows else []
+        commit(*callbacks)
+        return created
+
+    def get_project_by_id(self, project_id: int):
+        # Retrieve an active project of this client by primary key.
+        project = Project.query.get(project_id)
+        if project is None or project.client_id != self.id or project.deleted:
+            return None
+        return project
+
+    def get_projects_page(self, after: tuple = None, limit: int = 50) -> tuple:
+        # Retrieve a page of active projects in creation order and the cursor for the next page.
+        return paginate(self.projects.filter_by(deleted=False), Project, after, limit)
     
     def __repr__(self):
         return ('<Client {}>'.format(self.name))
@@ -233,6 +424,11 @@ class Project(db.Model):
     """
 
     __tablename__ = 'project'
+    __table_args__ = (
+        # Listings of a client's active projects.
+        db.Index('ix_project_client_id_created_at', 'client_id', 'created_at', 'id',
+                 postgresql_where=db.text('deleted = false')),
+    )
 
     id = db.Column(db.Integer, primary_key=True, nullable=False)
     name = db.Column(db.String(150), unique=True)
@@ -244,24 +440,31 @@ class Project(db.Model):
 
     def add(self):
         db.session.add(self)
-        db.session.commit()
+        commit(self.version_bumper())
     
     def update(self, user_id, **kwargs):
         for key, value in kwargs.items():
             setattr(self, key, value)
         db.session.add(self)
-        db.session.commit()
+        commit(self.version_bumper())
 
     def delete(self):
         if self.deleted is False:
             self.deleted = True
             self.deleted_on = datetime.utcnow()
         db.session.add(self)
-        db.session.commit()
+        commit(self.version_bumper())
 
     def permanently_delete(self):
+        bump = self.version_bumper()
         db.session.delete(self)
-        db.session.commit()
+        commit(bump)
+
+    def version_bumper(self):
+        # A project is part of its client's data and of the owning user's listings.
+        if self.client is None:
+            return lambda: None
+        return self.client.version_bumper()
 
     def __repr__(self):
         return ('<Project {}>'.format(self.name))
@@ -4,21 +4,61 @@ from pathlib import Path
 
 from flask import Flask
 from flask_session import Session
+from flask_migrate import Migrate
 from models import db
 from config import Config
+from utils.cache import user_cache, response_cache
+from utils.hashing import hashing_pool, calibrate_command
+from utils.explain import check_indexes_command
+from utils.versions import data_versions
+from utils.fastjson import json_provider
+from utils.jit import JitSchema
+from utils.metrics import metrics
+from utils.queries import query_inspector
+from utils.ratelimit import rate_limiter
+from utils.replicas import replica_router
+from utils.snapshots import worker_snapshots
+from utils.mail import mailer
+from utils.tasks import task_queue
+from utils.tokens import token_signer
+from utils.sessions import redis_sessions, token_sessions, session_index
+
+migrate = Migrate()
 
 def create_app():
     app_config = Config()
     app = Flask(__name__)
     with app.app_context():
         app.config.from_object(app_config)
+        token_signer.init_app(app)
         Session(app)
+        redis_sessions.init_app(app)
+        token_sessions.init_app(app)
+        session_index.init_app(app)
         db.init_app(app)
+        replica_router.init_app(app)
+        migrate.init_app(app, db)
+        user_cache.init_app(app)
+        response_cache.init_app(app)
+        hashing_pool.init_app(app)
+        data_versions.init_app(app)
+        rate_limiter.init_app(app)
+        task_queue.init_app(app, db)
+        mailer.init_app(app)
+        json_provider.init_app(app)
+        worker_snapshots.init_app(app)
+        metrics.init_app(app, db)
+        query_inspector.init_app(app)
+        JitSchema.jit = app.config['MARSHMALLOW_JIT']
 
         from main import main
         from user import user
+        from status import status
         app.register_blueprint(main)
         app.register_blueprint(user)
+        app.register_blueprint(status)
+        app.cli.add_command(calibrate_command)
+        app.cli.add_command(check_indexes_command)
     return app
 
 app = create_app()
\ No newline at end of file
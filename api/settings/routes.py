@@ -3,5 +3,22 @@ REGISTRATION = '/register'
 LOGIN = '/'
 LOGOUT = '/logout'
 PROFILE = '/profile'
+SESSIONS = '/profile/sessions'
 CLIENTS = '/clients'
-CLIENT = '/client'
\ No newline at end of file
+CLIENT = '/client'
+CLIENT_BY_ID = '/clients/<int:client_id>'
+PROJECT_BY_ID = '/clients/<int:client_id>/projects/<int:project_id>'
+PROJECTS = '/client/projects'
+CLIENTS_IMPORT = '/clients/import'
+CLIENTS_EXPORT = '/clients/export'
+STATUS_POOLS = '/status/pools'
+STATUS_CACHES = '/status/caches'
+METRICS = '/metrics'
+
+
+# Rate limits per route as {key: (capacity, refill period in seconds)}, requests are
+  # counted against the client's IP and the username they submit, see utils.ratelimit.
+RATE_LIMITS = {
+    LOGIN: {'ip': (30, 60), 'username': (5, 60)},
+    REGISTRATION: {'ip': (10, 60)},
+}
@@ -0,0 +1,17 @@
+from flask import Blueprint
+
+from settings import routes
+
+from .views import PoolStatusView
+from .views import CacheStatusView
+from .views import MetricsView
+
+status = Blueprint('status', __name__)
+
+pools = PoolStatusView.as_view('pools')
+caches = CacheStatusView.as_view('caches')
+metrics = MetricsView.as_view('metrics')
+
+status.add_url_rule(routes.STATUS_POOLS, view_func=pools, methods=['GET'])
+status.add_url_rule(routes.STATUS_CACHES, view_func=caches, methods=['GET'])
+status.add_url_rule(routes.METRICS, view_func=metrics, methods=['GET'])
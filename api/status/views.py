@@ -0,0 +1,60 @@
+from flask import Response
+from flask import current_app
+from flask import jsonify
+from flask.views import MethodView
+
+from utils.auth import status_required
+from utils.cache import response_cache
+from utils.cache import user_cache
+from utils.metrics import metrics
+from utils.pools import pool_stats
+from utils.replicas import replica_router
+from utils.snapshots import merge_stats
+from utils.snapshots import worker_snapshots
+from models import db
+
+
+def pools_snapshot():
+    return pool_stats(db.engine, current_app.config['SESSION_REDIS'])
+
+
+def caches_snapshot():
+    return {'users': user_cache.stats(), 'responses': response_cache.stats()}
+
+
+worker_snapshots.register('metrics', metrics.snapshot)
+worker_snapshots.register('pools', pools_snapshot)
+worker_snapshots.register('caches', caches_snapshot)
+
+
+class PoolStatusView(MethodView):
+    """Report connection pool usage and checkout wait times summed over live workers."""
+    decorators = [status_required]
+
+    def get(self):
+        snapshots = worker_snapshots.collect('pools', live=True)
+        stats = merge_stats(snapshots)
+        stats['workers'] = len(snapshots)
+        stats['replicas'] = replica_router.health()
+        return jsonify(stats), 200
+
+
+class CacheStatusView(MethodView):
+    """Report user and response cache effectiveness summed over live workers."""
+    decorators = [status_required]
+
+    def get(self):
+        stats = merge_stats(worker_snapshots.collect('caches', live=True))
+        responses = stats['responses']
+        lookups = responses['hits'] + responses['misses']
+        responses['hit_ratio'] = round(responses['hits'] / lookups, 4) if lookups else None
+        return jsonify(stats), 200
+
+
+class MetricsView(MethodView):
+    """Expose the metrics of all workers in the Prometheus text format."""
+    decorators = [status_required]
+
+    def get(self):
+        return Response(metrics.render(worker_snapshots.collect('metrics')), status=200,
+                        mimetype='text/plain; version=0.0.4')
@@ -1,18 +1,29 @@
 import os
 import sys
+import json
 import unittest
 
+from sqlalchemy import event
+from sqlalchemy.exc import IntegrityError
 from werkzeug.http import parse_cookie
 
 from run import create_app
 from settings import routes
-from models import db, User, Client, Project
+from models import db, transaction, User, Client, Project
 from .client_helpers import (
                         addTestUsers,
                         addTestClients,
                         addTestProjects,
                         removeTestEntries
                     )
+from utils.queries import count_queries, query_budget, query_inspector
+from utils.replicas import replica_router
+from utils.versions import data_versions
+from utils.explain import check_indexes
+from utils.cache import response_cache
+from utils.fastjson import json_provider
+from utils.jit import JitSchema
+from user.forms import clients_schema
 
 
 DOMAIN = '127.0.0.1'
@@ -192,3 +203,491 @@ class ClientTestCase(unittest.TestCase):
                                               })
             self.assertEqual(r.status_code, 308)
 
+
+
+    def testGetClientsPages(self):
+        cookie = self.get_cookie('test_user1', 'password1')
+        with self.client() as tc:
+            tc.set_cookie('127.0.0.1', 'session', str(cookie['session']), 
+                          path=routes.LOGIN, domain='127.0.0.1')
+            r = tc.get(routes.CLIENTS, query_string={'limit': 2})
+            self.assertEqual(r.status_code, 201)
+            first_page = r.get_json()
+            self.assertEqual(len(first_page['clients']), 2)
+            self.assertIsNotNone(first_page['next_cursor'])
+
+            r = tc.get(routes.CLIENTS, query_string={'limit': 2, 
+                                                     'cursor': first_page['next_cursor']})
+            self.assertEqual(r.status_code, 201)
+            second_page = r.get_json()
+            names = [client['name'] for client in first_page['clients'] + second_page['clients']]
+            self.assertEqual(len(names), len(set(names)))
+            self.assertIn('miscclient3', names)
+
+
+    def testGetClientsWithInvalidCursor(self):
+        cookie = self.get_cookie('test_user1', 'password1')
+        with self.client() as tc:
+            tc.set_cookie('127.0.0.1', 'session', str(cookie['session']), 
+                          path=routes.LOGIN, domain='127.0.0.1')
+            r = tc.get(routes.CLIENTS, query_string={'cursor': 'not-a-cursor'})
+            self.assertEqual(r.status_code, 422)
+            r = tc.get(routes.CLIENTS, query_string={'limit': 10000})
+            self.assertEqual(r.status_code, 422)
+
+
+    def testGetProjectsPages(self):
+        cookie = self.get_cookie('test_user1', 'password1')
+        with self.client() as tc:
+            tc.set_cookie('127.0.0.1', 'session', str(cookie['session']), 
+                          path=routes.LOGIN, domain='127.0.0.1')
+            client = {'client_name': 'miscclient1', 'client_email': 'miscemail1@live.com'}
+            r = tc.get(routes.PROJECTS, json=client, query_string={'limit': 2})
+            self.assertEqual(r.status_code, 201)
+            first_page = r.get_json()
+            self.assertEqual([p['name'] for p in first_page['projects']], ['project1', 'project2'])
+
+            r = tc.get(routes.PROJECTS, json=client, query_string={'limit': 2, 
+                                                                   'cursor': first_page['next_cursor']})
+            second_page = r.get_json()
+            self.assertEqual([p['name'] for p in second_page['projects']], ['project3'])
+            self.assertIsNone(second_page['next_cursor'])
+
+
+    def testGetClientsQueryBudget(self):
+        cookie = self.get_cookie('test_user1', 'password1')
+        with self.client() as tc:
+            tc.set_cookie('127.0.0.1', 'session', str(cookie['session']), 
+                          path=routes.LOGIN, domain='127.0.0.1')
+            with count_queries() as small_page:
+                r = tc.get(routes.CLIENTS, query_string={'limit': 1})
+                self.assertEqual(r.status_code, 201)
+            with count_queries() as large_page:
+                r = tc.get(routes.CLIENTS, query_string={'limit': 50})
+                self.assertEqual(r.status_code, 201)
+            self.assertLessEqual(len(large_page), 3)
+            self.assertLessEqual(len(large_page), len(small_page))
+
+
+    def testGetClientQueryBudget(self):
+        cookie = self.get_cookie('test_user1', 'password1')
+        with self.client() as tc:
+            tc.set_cookie('127.0.0.1', 'session', str(cookie['session']), 
+                          path=routes.LOGIN, domain='127.0.0.1')
+            with count_queries() as statements:
+                r = tc.get(routes.CLIENT, json={'client_name': 'miscclient1', 
+                                                'client_email': 'miscemail1@live.com'
+                                                })
+                self.assertEqual(r.status_code, 201)
+                self.assertEqual(len(r.get_json()['projects']), 3)
+            self.assertLessEqual(len(statements), 3)
+
+
+    def testGetProfileQueryBudget(self):
+        cookie = self.get_cookie('test_user1', 'password1')
+        with self.client() as tc:
+            tc.set_cookie('127.0.0.1', 'session', str(cookie['session']), 
+                          path=routes.LOGIN, domain='127.0.0.1')
+            with count_queries() as statements:
+                r = tc.get(routes.PROFILE)
+                self.assertEqual(r.status_code, 202)
+                self.assertGreaterEqual(len(r.get_json()['clients']), 3)
+            self.assertLessEqual(len(statements), 2)
+
+
+    def testHotQueriesUseIndexes(self):
+        for index, (used, plan) in check_indexes().items():
+            self.assertTrue(used, '{} is not used:\n{}'.format(index, plan))
+
+
+    def testImportClientsNdjson(self):
+        cookie = self.get_cookie('test_user1', 'password1')
+        body = '\n'.join([
+            '{"name": "imported1", "email": "imported1@live.com", "description": "imported client."}',
+            '{"name": "miscclient2", "email": "miscemail2@live.com"}',
+            '{"name": "imported1", "email": "imported1@live.com"}',
+            '{"name": "bad$name", "email": "imported2@live.com"}',
+            '{"name": "imported3", ',
+            '',
+            '{"name": "imported4", "email": "imported4@live.com"}',
+        ])
+        with self.client() as tc:
+            tc.set_cookie('127.0.0.1', 'session', str(cookie['session']), 
+                          path=routes.LOGIN, domain='127.0.0.1')
+            self.app.config['CLIENT_IMPORT_BATCH_SIZE'] = 2
+            commits = []
+            listener = lambda conn: commits.append(conn)
+            event.listen(db.engine, 'commit', listener)
+            try:
+                r = tc.post(routes.CLIENTS_IMPORT, data=body, content_type='application/x-ndjson')
+            finally:
+                event.remove(db.engine, 'commit', listener)
+                self.app.config['CLIENT_IMPORT_BATCH_SIZE'] = 500
+            self.assertEqual(r.status_code, 201)
+            # each batch is committed on its own
+            self.assertEqual(len(commits), 3)
+            json_data = r.get_json()
+            self.assertEqual([row['status'] for row in json_data['rows']],
+                             ['created', 'duplicate', 'duplicate', 'invalid', 'invalid', 'created'])
+            self.assertEqual(json_data['created'], 2)
+            self.assertEqual(json_data['invalid'], 2)
+            self.assertIn('name', json_data['rows'][3]['errors'])
+
+
+    def testImportClientsCsv(self):
+        cookie = self.get_cookie('test_user2', 'password2')
+        body = ('name,email,description\n'
+                'csvclient1,csvclient1@live.com,first csv client.\n'
+                'csvclient2,csvclient2@live.com,\n')
+        with self.client() as tc:
+            tc.set_cookie('127.0.0.1', 'session', str(cookie['session']), 
+                          path=routes.LOGIN, domain='127.0.0.1')
+            r = tc.post(routes.CLIENTS_IMPORT, data=body, content_type='text/csv')
+            self.assertEqual(r.status_code, 201)
+            self.assertEqual(r.get_json()['created'], 2)
+            user = User.query.filter_by(username='test_user2').first()
+            self.assertIsNotNone(user.get_client('csvclient2', 'csvclient2@live.com'))
+
+            r = tc.post(routes.CLIENTS_IMPORT, data='name', content_type='text/plain')
+            self.assertEqual(r.status_code, 415)
+
+
+    def testExportClientsNdjson(self):
+        cookie = self.get_cookie('test_user1', 'password1')
+        with self.client() as tc:
+            tc.set_cookie('127.0.0.1', 'session', str(cookie['session']), 
+                          path=routes.LOGIN, domain='127.0.0.1')
+            r = tc.get(routes.CLIENTS_EXPORT)
+            self.assertEqual(r.status_code, 200)
+            self.assertEqual(r.mimetype, 'application/x-ndjson')
+            records = [json.loads(line) for line in r.get_data(as_text=True).splitlines()]
+            clients = {record['name']: record for record in records}
+            self.assertEqual(len(clients), len(records))
+            self.assertEqual([p['name'] for p in clients['miscclient1']['projects']], 
+                             ['project1', 'project2', 'project3'])
+            self.assertEqual(clients['miscclient2']['projects'], [])
+
+
+    def testExportClientsCsv(self):
+        cookie = self.get_cookie('test_user1', 'password1')
+        with self.client() as tc:
+            tc.set_cookie('127.0.0.1', 'session', str(cookie['session']), 
+                          path=routes.LOGIN, domain='127.0.0.1')
+            r = tc.get(routes.CLIENTS_EXPORT, query_string={'format': 'csv'})
+            self.assertEqual(r.status_code, 200)
+            lines = r.get_data(as_text=True).splitlines()
+            self.assertEqual(lines[0], 'client_name,client_email,client_description,'
+                                       'project_name,project_description')
+            self.assertIn('miscclient1,miscemail1@live.com,misc users files.,'
+                          'project2,project2 description', lines)
+
+            r = tc.get(routes.CLIENTS_EXPORT, query_string={'format': 'xml'})
+            self.assertEqual(r.status_code, 422)
+
+
+    def testAddProject(self):
+        cookie = self.get_cookie('test_user2', 'password2')
+        with self.client() as tc:
+            tc.set_cookie('127.0.0.1', 'session', str(cookie['session']), 
+                          path=routes.LOGIN, domain='127.0.0.1')
+            r = tc.post(routes.CLIENT, json={'client_name': 'miscclient1', 
+                                             'client_email': 'miscemail3@live.com',
+                                             'name': 'project4',
+                                             'description': 'project4 description'
+                                             })
+            self.assertEqual(r.status_code, 202)
+            self.assertEqual([p['name'] for p in r.get_json()['projects']], ['project4'])
+
+
+    def testClientsConditionalGet(self):
+        cookie = self.get_cookie('test_user2', 'password2')
+        with self.client() as tc:
+            tc.set_cookie('127.0.0.1', 'session', str(cookie['session']), 
+                          path=routes.LOGIN, domain='127.0.0.1')
+            r = tc.get(routes.CLIENTS)
+            etag = r.headers['ETag']
+            with count_queries() as statements:
+                r = tc.get(routes.CLIENTS, headers={'If-None-Match': etag})
+                self.assertEqual(r.status_code, 304)
+            self.assertEqual(len(statements), 0)
+
+            r = tc.get(routes.CLIENTS, query_string={'limit': 1}, headers={'If-None-Match': etag})
+            self.assertEqual(r.status_code, 201)
+
+            tc.put(routes.CLIENT, json={'client_email': 'miscemail5@live.com', 
+                                        'client_name': 'miscclient2', 
+                                        'description': 'this is updated again.'
+                                        })
+            r = tc.get(routes.CLIENTS, headers={'If-None-Match': etag})
+            self.assertEqual(r.status_code, 201)
+
+
+    def testClientResponseCache(self):
+        cookie = self.get_cookie('test_user1', 'password1')
+        client = {'client_name': 'miscclient3', 'client_email': 'miscemail3@live.com'}
+        # fixture clients were inserted without a version, the first write creates it
+        user = User.query.filter_by(username='test_user1').first()
+        data_versions.bump_client(user.get_client_id('miscclient3', 'miscemail3@live.com'))
+        with self.client() as tc:
+            tc.set_cookie('127.0.0.1', 'session', str(cookie['session']), 
+                          path=routes.LOGIN, domain='127.0.0.1')
+            first = tc.get(routes.CLIENT, json=client)
+            hits = response_cache.stats()['hits']
+            with count_queries() as statements:
+                second = tc.get(routes.CLIENT, json=client)
+            # only the client id is looked up
+            self.assertEqual(len(statements), 1)
+            self.assertEqual(response_cache.stats()['hits'], hits + 1)
+            self.assertEqual(second.status_code, 201)
+            self.assertEqual(second.get_data(), first.get_data())
+
+            # writes to the user's other clients keep the entry
+            data_versions.bump_client(user.get_client_id('miscclient1', 'miscemail1@live.com'),
+                                      user.id)
+            tc.get(routes.CLIENT, json=client)
+            hits += 1
+            self.assertEqual(response_cache.stats()['hits'], hits + 1)
+
+            tc.put(routes.CLIENT, json=dict(client, description='cache is invalidated.'))
+            third = tc.get(routes.CLIENT, json=client)
+            self.assertEqual(response_cache.stats()['hits'], hits + 1)
+            self.assertEqual(third.get_json()['description'], 'cache is invalidated.')
+
+            r = tc.get(routes.STATUS_CACHES)
+            self.assertGreaterEqual(r.get_json()['responses']['bytes_saved'], len(first.get_data()))
+
+
+    def testUnknownClientCreatesNoVersion(self):
+        cookie = self.get_cookie('test_user1', 'password1')
+        with self.client() as tc:
+            tc.set_cookie(DOMAIN, 'session', cookie['session'])
+            r = tc.get(routes.CLIENT_BY_ID.replace('<int:client_id>', '987654321'))
+            self.assertNotIn('ETag', r.headers)
+        self.assertIsNone(data_versions.redis.get(data_versions.key_prefix + 'client:987654321'))
+
+
+    def testCompiledClientDump(self):
+        user = User.query.filter_by(username='test_user1').first()
+        clients = user.get_clients()
+        self.assertIsNotNone(clients_schema.jit_dumper())
+        compiled = clients_schema.dump(clients)
+        JitSchema.jit = False
+        try:
+            expected = clients_schema.dump(clients)
+        finally:
+            JitSchema.jit = True
+        self.assertEqual(compiled, expected)
+        self.assertTrue(any(client['projects'] for client in compiled))
+
+
+    def testJsonProvidersMatch(self):
+        cookie = self.get_cookie('test_user1', 'password1')
+        with self.client() as tc:
+            tc.set_cookie(DOMAIN, 'session', cookie['session'])
+            r = tc.get(routes.CLIENTS)
+            self.assertEqual(r.status_code, 201)
+            self.assertEqual(r.mimetype, 'application/json')
+
+            user = User.query.filter_by(username='test_user1').first()
+            payload = {'clients': clients_schema.dump(user.get_clients())}
+            backend = json_provider.backend
+            try:
+                json_provider.backend = 'json'
+                expected = json_provider.dumps(payload)
+            finally:
+                json_provider.backend = backend
+            self.assertEqual(json.loads(json_provider.dumps(payload)), json.loads(expected))
+            self.assertEqual(clients_schema.dump_json(user.get_clients()),
+                             json_provider.dumps(payload['clients']))
+
+
+    # Statements each endpoint may execute, login_required lookups are served by the user cache.
+    QUERY_BUDGETS = [
+        ('GET', routes.CLIENTS, {}, 3),
+        ('GET', routes.CLIENT, {'json': {'client_name': 'miscclient1',
+                                         'client_email': 'miscemail1@live.com'}}, 3),
+        ('GET', routes.PROJECTS, {'json': {'client_name': 'miscclient1',
+                                           'client_email': 'miscemail1@live.com'}}, 3),
+        ('GET', routes.PROFILE, {}, 2),
+        ('GET', routes.CLIENTS_EXPORT, {}, 2),
+    ]
+
+    def testEndpointQueryBudgets(self):
+        cookie = self.get_cookie('test_user1', 'password1')
+        with self.client() as tc:
+            tc.set_cookie(DOMAIN, 'session', cookie['session'])
+            for method, route, kwargs, budget in self.QUERY_BUDGETS:
+                with self.subTest(method=method, route=route):
+                    with query_budget(budget):
+                        r = tc.open(route, method=method, **kwargs)
+                        r.get_data()
+                    self.assertLess(r.status_code, 300)
+
+
+    def testRepeatedStatementsAreLogged(self):
+        user = User.query.filter_by(username='test_user1').first()
+        with self.app.test_request_context(routes.CLIENTS):
+            self.app.preprocess_request()
+            with self.assertLogs('utils.queries', 'WARNING') as logs:
+                for client in user.clients:
+                    client.projects.all()
+                self.app.do_teardown_request()
+        self.assertTrue(any('Possible N+1 in GET user.clients' in line for line in logs.output))
+
+
+    def testSlowStatementsAreLogged(self):
+        threshold = query_inspector.slow_threshold
+        query_inspector.slow_threshold = 0
+        try:
+            with self.app.test_request_context(routes.CLIENTS):
+                with self.assertLogs('utils.queries', 'WARNING') as logs:
+                    User.query.filter_by(username='test_user1').first()
+        finally:
+            query_inspector.slow_threshold = threshold
+        self.assertIn('in user.clients', logs.output[0])
+        self.assertIn('test_user1', logs.output[0])
+
+
+    def testReadsUseReplica(self):
+        # The primary doubles as a replica, routing is observed through each engine's statements.
+        self.app.config['SQLALCHEMY_BINDS'] = {'replica_0': self.app.config['SQLALCHEMY_DATABASE_URI']}
+        replica_router.binds = ['replica_0']
+        replica = db.get_engine(self.app, bind='replica_0')
+        cookie = self.get_cookie('test_user2', 'password2')
+        other_cookie = self.get_cookie('test_user2', 'password2')
+        replica_router.redis.delete(replica_router.key_prefix + 'test_user2')
+        try:
+            with self.client() as tc:
+                tc.set_cookie(DOMAIN, 'session', cookie['session'])
+                with count_queries(replica) as replica_statements, count_queries() as primary_statements:
+                    r = tc.get(routes.CLIENTS, query_string={'limit': 7})
+                    self.assertEqual(r.status_code, 201)
+                self.assertGreater(len(replica_statements), 0)
+                self.assertEqual(len(primary_statements), 0)
+
+                # writes, and the user's reads shortly after, stay on the primary
+                with count_queries(replica) as replica_statements:
+                    r = tc.post(routes.CLIENTS, json={'name': 'replicaclient1',
+                                                      'email': 'replica1@live.com'})
+                    self.assertEqual(r.status_code, 201)
+                    r = tc.get(routes.CLIENTS, query_string={'limit': 8})
+                    self.assertIn('replicaclient1', [c['name'] for c in r.get_json()['clients']])
+                self.assertEqual(len(replica_statements), 0)
+
+            # as do the reads of the user's other sessions
+            with self.client() as tc:
+                tc.set_cookie(DOMAIN, 'session', other_cookie['session'])
+                with count_queries(replica) as replica_statements:
+                    r = tc.get(routes.CLIENTS, query_string={'limit': 8})
+                    self.assertIn('replicaclient1', [c['name'] for c in r.get_json()['clients']])
+                self.assertEqual(len(replica_statements), 0)
+
+            # lagging replicas are skipped
+            replica_router.max_lag = -1
+            replica_router._health.clear()
+            replica_router.redis.delete(replica_router.key_prefix + 'test_user2')
+            cookie = self.get_cookie('test_user2', 'password2')
+            with self.client() as tc:
+                tc.set_cookie(DOMAIN, 'session', cookie['session'])
+                with count_queries() as primary_statements:
+                    r = tc.get(routes.CLIENTS, query_string={'limit': 9})
+                    self.assertEqual(r.status_code, 201)
+                self.assertGreater(len(primary_statements), 0)
+                self.assertEqual(replica_router.health(), {'replica_0': False})
+        finally:
+            self.app.config['SQLALCHEMY_BINDS'] = {}
+            replica_router.binds = []
+            replica_router.max_lag = self.app.config['REPLICA_MAX_LAG']
+            replica_router._health.clear()
+
+
+    def testTransactionCommitsOnce(self):
+        user = User.query.filter_by(username='test_user2').first()
+        commits = []
+        listener = lambda conn: commits.append(conn)
+        event.listen(db.engine, 'commit', listener)
+        try:
+            version = data_versions.user(user.id)
+            with transaction():
+                client = Client()
+                client.add(user, name='uowclient1', email='uow1@live.com')
+                Project(name='uowproject1', description='one of many writes.', client=client).add()
+                client.update(description='added in a single transaction.')
+                self.assertEqual(len(commits), 0)
+                self.assertEqual(data_versions.user(user.id), version)
+            self.assertEqual(len(commits), 1)
+            self.assertGreater(data_versions.user(user.id), version)
+            self.assertGreater(data_versions.client(client.id), 0)
+
+            with self.assertRaises(ValueError):
+                with transaction():
+                    Client().add(user, name='uowclient2', email='uow2@live.com')
+                    raise ValueError('abandon the block')
+            self.assertEqual(len(commits), 1)
+
+            # a failed commit rolls the block back and drops its callbacks
+            version = data_versions.user(user.id)
+            with self.assertRaises(IntegrityError):
+                with transaction():
+                    Client().add(user, name='uowclient3', email='uow3@live.com')
+                    db.session.add(Project(name='uowproject1'))
+            self.assertEqual(len(commits), 1)
+            self.assertEqual(data_versions.user(user.id), version)
+        finally:
+            event.remove(db.engine, 'commit', listener)
+
+        client = user.get_client('uowclient1', 'uow1@live.com')
+        self.assertEqual(client.description, 'added in a single transaction.')
+        self.assertEqual([p.name for p in client.active_projects], ['uowproject1'])
+        self.assertIsNone(user.get_client('uowclient2', 'uow2@live.com'))
+        self.assertIsNone(user.get_client('uowclient3', 'uow3@live.com'))
+
+
+    def testClientAndProjectById(self):
+        cookie = self.get_cookie('test_user2', 'password2')
+        with self.client() as tc:
+            tc.set_cookie(DOMAIN, 'session', cookie['session'])
+            tc.post(routes.CLIENTS, json={'name': 'idclient1', 'email': 'idclient1@live.com'})
+            r = tc.post(routes.CLIENT, json={'client_name': 'idclient1',
+                                             'client_email': 'idclient1@live.com',
+                                             'name': 'idproject1'})
+            client = r.get_json()
+            project = client['projects'][0]
+            client_url = '/clients/{}'.format(client['id'])
+            project_url = '{}/projects/{}'.format(client_url, project['id'])
+
+            r = tc.get(client_url)
+            self.assertEqual(r.status_code, 200)
+            self.assertEqual(r.get_json()['name'], 'idclient1')
+            self.assertIn('private', r.headers['Cache-Control'])
+            self.assertIn('Cookie', r.headers['Vary'])
+            etag = r.headers['ETag']
+            with count_queries() as statements:
+                r = tc.get(client_url, headers={'If-None-Match': etag})
+                self.assertEqual(r.status_code, 304)
+            self.assertEqual(len(statements), 0)
+
+            r = tc.get(project_url)
+            self.assertEqual(r.status_code, 200)
+            self.assertEqual(r.get_json()['name'], 'idproject1')
+
+            r = tc.put(project_url, json={'description': 'updated by its id.'})
+            self.assertEqual(r.status_code, 202)
+            r = tc.get(client_url, headers={'If-None-Match': etag})
+            self.assertEqual(r.status_code, 200)
+            self.assertEqual(r.get_json()['projects'][0]['description'], 'updated by its id.')
+
+            r = tc.put(client_url, json={'client_name': 'idclient1'})
+            self.assertEqual(r.status_code, 422)
+            self.assertEqual(tc.delete(project_url).status_code, 200)
+            self.assertEqual(tc.get(project_url).status_code, 404)
+            self.assertEqual(tc.delete(client_url).status_code, 200)
+            self.assertEqual(tc.get(client_url).status_code, 404)
+
+        # clients are only visible to their owner
+        user = User.query.filter_by(username='test_user1').first()
+        other = user.get_clients()[0]
+        cookie = self.get_cookie('test_user2', 'password2')
+        with self.client() as tc:
+            tc.set_cookie(DOMAIN, 'session', cookie['session'])
+            self.assertEqual(tc.get('/clients/{}'.format(other.id)).status_code, 404)
@@ -1,21 +1,44 @@
 import os
 import json
 import sys
+import time
 import unittest
+import jwt
 
+from argon2 import PasswordHasher
 from werkzeug.http import parse_cookie
 
 from run import create_app
+from config import Config
 from settings import routes
-from models import db, User, Client
+from models import db, transaction, User, Client
+from utils.cache import user_cache
+from utils.hashing import hashing_pool, GeventThreadPoolExecutor
+from utils.metrics import metrics
+from utils.queries import count_queries
+from utils.ratelimit import rate_limiter
+from utils.sessions import redis_sessions, token_sessions
+from utils.snapshots import worker_snapshots
+from utils.mail import mailer
+from utils.tasks import task_queue
+from utils.tokens import token_signer
 from .user_helpers import (
                             addTestUsers,
+                            generateKeyPair,
                             removeTestUsers
                           )
 
 
 DOMAIN = '127.0.0.1'
 
+flaky_calls = []
+
+@task_queue.task
+def flaky_task(value):
+    flaky_calls.append(value)
+    if len(flaky_calls) < 2:
+        raise RuntimeError('Task failed on its first attempt.')
+
 class MainUserTestCase(unittest.TestCase):
     """Class for main module user test cases."""
 
@@ -54,6 +77,22 @@ class MainUserTestCase(unittest.TestCase):
         self.assertEqual(json_data['username'], 'macdonejhlk')
 
 
+    def testRegistrationUsernameRace(self):
+        # A deleted user is not found by the username check, like a concurrent
+          # registration, so the username is only rejected by the insert.
+        db.session.add(User(username='racer1', email='racer1@live.ca', first_name='Rae',
+                            last_name='Racer', password='Racer123', deleted=True))
+        db.session.commit()
+        re = self.client().post(routes.REGISTRATION, json={'username': 'racer1',
+                                                   'email': 'racer2@live.ca',
+                                                   'first_name': 'Rae',
+                                                   'last_name': 'Racer',
+                                                   'password': 'Racer123'
+                                                   })
+        self.assertEqual(re.status_code, 422)
+        self.assertIsNotNone(re.get_json()['errors'])
+
+
     def testInvalidFirstNameRegistration(self):
         re = self.client().post(routes.REGISTRATION, json={'username': 'madssdf2323',
                                                     'email': 'magicman@hotmail.com',
@@ -131,6 +170,9 @@ class MainUserTestCase(unittest.TestCase):
                                            'password': 'Passin123'
                                            })
         self.assertEqual(re.status_code, 201)
+        json_data = re.get_json()
+        self.assertEqual(json_data['username'], 'mhird23')
+        self.assertNotIn('password', json_data)
 
 
     def testLoginInvalidUsername(self):
@@ -189,3 +231,409 @@ class MainUserTestCase(unittest.TestCase):
                               path=routes.LOGIN, domain=DOMAIN)
             r = client.delete(routes.PROFILE, json={'confirm_password': 'Pass241'})
             self.assertEqual(r.status_code, 308)
+
+
+    def testCachedProfileLookup(self):
+        cookie = self.get_cookie('johnmc3s', 'Newpass')
+        with self.client() as client:
+            client.set_cookie(DOMAIN, 'session', str(cookie['session']), 
+                              path=routes.LOGIN, domain=DOMAIN)
+            user_cache.invalidate('johnmc3s')
+            misses = user_cache.stats()['misses']
+            client.get(routes.PROFILE)
+            self.assertEqual(user_cache.stats()['misses'], misses + 1)
+            hits = user_cache.stats()['hits']
+            r = client.get(routes.PROFILE)
+            self.assertEqual(r.status_code, 202)
+            self.assertEqual(user_cache.stats()['hits'], hits + 1)
+            self.assertEqual(r.get_json()['username'], 'johnmc3s')
+
+
+    def testCacheInvalidatedOnUpdate(self):
+        cookie = self.get_cookie('johnmc3s', 'Newpass')
+        with self.client() as client:
+            client.set_cookie(DOMAIN, 'session', str(cookie['session']), 
+                              path=routes.LOGIN, domain=DOMAIN)
+            client.get(routes.PROFILE)
+            r = client.put(routes.PROFILE, json={'user': {'last_name': 'Mcdonald'}})
+            self.assertEqual(r.status_code, 202)
+            r = client.get(routes.PROFILE)
+            self.assertEqual(r.get_json()['last_name'], 'Mcdonald')
+
+
+    def testCacheInvalidatedByAnotherWorker(self):
+        user_cache.invalidate('johnmc3s')
+        state, generation = user_cache.get('johnmc3s')
+        self.assertIsNone(state)
+        user = User.query.filter_by(username='johnmc3s').first()
+        user_cache.set('johnmc3s', user.cache_state(), generation)
+        self.assertIsNotNone(user_cache.get('johnmc3s')[0])
+        # Another worker invalidating the user only touches Redis.
+        user_cache.redis.incr(user_cache.generation_prefix + 'johnmc3s')
+        self.assertIsNone(user_cache.get('johnmc3s')[0])
+
+        user_cache.use_redis = True
+        try:
+            state, generation = user_cache.get('johnmc3s')
+            user_cache.set('johnmc3s', user.cache_state(), generation)
+            with user_cache._lock:
+                user_cache._entries.clear()
+            state, _ = user_cache.get('johnmc3s')
+            self.assertEqual(state['member_since'], user.member_since)
+            self.assertEqual(user_cache.stats()['redis_hits'], 1)
+        finally:
+            user_cache.invalidate('johnmc3s')
+            user_cache.use_redis = False
+
+
+    def testLoginWhenHashingPoolIsFull(self):
+        for _ in range(hashing_pool.max_pending):
+            hashing_pool._slots.acquire()
+        try:
+            re = self.client().post(routes.LOGIN, json={'username': 'mhird23', 
+                                               'password': 'Passin123'
+                                               })
+        finally:
+            for _ in range(hashing_pool.max_pending):
+                hashing_pool._slots.release()
+        self.assertEqual(re.status_code, 503)
+        self.assertIsNotNone(re.get_json()['errors'])
+
+
+    @unittest.skipIf(GeventThreadPoolExecutor is None, 'gevent is not installed')
+    def testGeventHashingExecutor(self):
+        kind = hashing_pool.kind
+        hashing_pool.shutdown()
+        hashing_pool.kind = 'gevent'
+        try:
+            password_hash = hashing_pool.hash('Passin123')
+            self.assertIsInstance(hashing_pool._executor, GeventThreadPoolExecutor)
+            self.assertTrue(hashing_pool.verify(password_hash, 'Passin123'))
+        finally:
+            hashing_pool.shutdown()
+            hashing_pool.kind = kind
+
+
+    def testLoginRehashesOutdatedPassword(self):
+        outdated = PasswordHasher(time_cost=1, memory_cost=1024, parallelism=1)
+        user = User(username='rehashme1', email='rehash@gmail.com', first_name='Re', 
+                    last_name='Hash', password=outdated.hash('Passin123'))
+        db.session.add(user)
+        db.session.commit()
+        re = self.client().post(routes.LOGIN, json={'username': 'rehashme1', 
+                                           'password': 'Passin123'
+                                           })
+        self.assertEqual(re.status_code, 201)
+        user = User.query.filter_by(username='rehashme1').first()
+        self.assertFalse(user.password_needs_rehash())
+        self.assertTrue(user.verify_password('Passin123'))
+
+
+    def testPoolStatus(self):
+        self.assertIs(Config().SESSION_REDIS, self.app.config['SESSION_REDIS'])
+        worker_snapshots.clear()
+        self.client().get(routes.PROFILE)
+        r = self.client().get(routes.STATUS_POOLS)
+        self.assertEqual(r.status_code, 200)
+        json_data = r.get_json()
+        self.assertGreaterEqual(json_data['database']['checkouts'], 1)
+        self.assertGreaterEqual(json_data['redis']['checkouts'], 1)
+        self.assertEqual(json_data['redis']['max_connections'], 
+                         self.app.config['WORKER_THREADS'] * 2 + 1)
+        self.assertEqual(json_data['workers'], 1)
+
+
+    def testStatusRequiresAllowedAddressOrToken(self):
+        allowed_ips = self.app.config['STATUS_ALLOWED_IPS']
+        self.app.config.update(STATUS_ALLOWED_IPS=[], STATUS_TOKEN='status-token')
+        try:
+            for route in (routes.METRICS, routes.STATUS_POOLS, routes.STATUS_CACHES):
+                self.assertEqual(self.client().get(route).status_code, 401)
+                r = self.client().get(route, headers={'Authorization': 'Bearer wrong'})
+                self.assertEqual(r.status_code, 401)
+                r = self.client().get(route, headers={'Authorization': 'Bearer status-token'})
+                self.assertEqual(r.status_code, 200)
+        finally:
+            self.app.config.update(STATUS_ALLOWED_IPS=allowed_ips, STATUS_TOKEN=None)
+
+
+    def testLoginRateLimit(self):
+        rate_limiter.enabled = True
+        rate_limiter.limits = {routes.LOGIN: {'ip': (100, 60), 'username': (2, 60)}}
+        rate_limiter.reset()
+        try:
+            attempt = {'username': 'macdonej24', 'password': 'WrongPass1'}
+            for _ in range(2):
+                re = self.client().post(routes.LOGIN, json=attempt)
+                self.assertEqual(re.status_code, 422)
+            with count_queries() as statements:
+                re = self.client().post(routes.LOGIN, json=attempt)
+            self.assertEqual(re.status_code, 429)
+            self.assertGreaterEqual(int(re.headers['Retry-After']), 1)
+            self.assertEqual(len(statements), 0)
+
+            # other usernames from the same address are still admitted
+            re = self.client().post(routes.LOGIN, json={'username': 'mhird23',
+                                                        'password': 'Passin123'})
+            self.assertEqual(re.status_code, 201)
+        finally:
+            rate_limiter.reset()
+            rate_limiter.enabled = False
+            rate_limiter.limits = dict(routes.RATE_LIMITS)
+
+
+    def testMetrics(self):
+        metrics.clear()
+        worker_snapshots.clear()
+        cookie = self.get_cookie('mhird23', 'Passin123')
+        with self.client() as tc:
+            tc.set_cookie(DOMAIN, 'session', cookie['session'])
+            tc.get(routes.PROFILE)
+            r = tc.get(routes.METRICS)
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(r.mimetype, 'text/plain')
+        body = r.get_data(as_text=True)
+        self.assertIn('http_requests_total{endpoint="main.login",method="POST",status="201"} 1.0', body)
+        self.assertIn('http_request_duration_seconds_count{endpoint="main.profile",method="GET"} 1.0', body)
+        self.assertIn('db_queries_per_request_count{endpoint="main.login",method="POST"} 1.0', body)
+        self.assertIn('db_query_duration_seconds_count{endpoint="main.login"}', body)
+        self.assertIn('redis_command_duration_seconds_count{endpoint="main.profile"}', body)
+        self.assertIn('password_hash_duration_seconds_count{operation="verify"} 1.0', body)
+
+        # metrics published by another worker are added to this one's
+        other = metrics.snapshot()
+        worker_snapshots.redis.hset(worker_snapshots.key_prefix + 'metrics', 'other',
+                                    json.dumps({'at': time.time(), 'stats': other}))
+        body = self.client().get(routes.METRICS).get_data(as_text=True)
+        self.assertIn('http_requests_total{endpoint="main.login",method="POST",status="201"} 2.0', body)
+        self.assertIn('password_hash_duration_seconds_count{operation="verify"} 2.0', body)
+        worker_snapshots.clear()
+
+
+    def testProfileConditionalGet(self):
+        cookie = self.get_cookie('johnmc3s', 'Newpass')
+        with self.client() as client:
+            client.set_cookie(DOMAIN, 'session', str(cookie['session']), 
+                              path=routes.LOGIN, domain=DOMAIN)
+            r = client.get(routes.PROFILE)
+            self.assertEqual(r.status_code, 202)
+            etag = r.headers['ETag']
+            r = client.get(routes.PROFILE, headers={'If-None-Match': etag})
+            self.assertEqual(r.status_code, 304)
+
+            client.put(routes.PROFILE, json={'user': {'first_name': 'Johnny'}})
+            r = client.get(routes.PROFILE, headers={'If-None-Match': etag})
+            self.assertEqual(r.status_code, 202)
+            self.assertNotEqual(r.headers['ETag'], etag)
+
+
+    def testRedisSessionsWrittenOnlyWhenModified(self):
+        cookie = self.get_cookie('mhird23', 'Passin123')
+        redis = self.app.config['SESSION_REDIS']
+        sid = redis_sessions._get_signer(self.app).unsign(cookie['session']).decode()
+        key = redis_sessions.key_prefix + sid
+        lifetime = int(self.app.permanent_session_lifetime.total_seconds())
+        self.assertIsNotNone(redis.get(key))
+        with self.client() as tc:
+            tc.set_cookie(DOMAIN, 'session', cookie['session'])
+            redis.expire(key, lifetime - 10)
+            r = tc.get(routes.PROFILE)
+            self.assertEqual(r.status_code, 202)
+            self.assertNotIn('Set-Cookie', r.headers)
+            self.assertLessEqual(redis.ttl(key), lifetime - 10)
+
+            # the expiry of an unmodified session slides once the refresh interval passes
+            redis.expire(key, lifetime - redis_sessions.refresh_interval - 10)
+            redis.zadd('user_sessions:mhird23', {sid: 0})
+            r = tc.get(routes.PROFILE)
+            self.assertIn('Set-Cookie', r.headers)
+            self.assertGreater(redis.ttl(key), lifetime - 10)
+            # along with the session's last use in the session index
+            self.assertGreater(redis.zscore('user_sessions:mhird23', sid), 0)
+
+            # anonymous requests store nothing
+            sessions = len(redis.keys(redis_sessions.key_prefix + '*'))
+            self.client().get(routes.PROFILE)
+            self.assertEqual(len(redis.keys(redis_sessions.key_prefix + '*')), sessions)
+
+
+    def testSessionIndex(self):
+        r = self.client().post(routes.REGISTRATION, json={'username': 'sessions1',
+                                                         'email': 'sessions1@live.ca',
+                                                         'first_name': 'Sam',
+                                                         'last_name': 'Sessions',
+                                                         'password': 'Sessions1'
+                                                         })
+        first = parse_cookie(r.headers['Set-Cookie'])['session']
+        second = self.get_cookie('sessions1', 'Sessions1')['session']
+        third = self.get_cookie('sessions1', 'Sessions1')['session']
+        with self.client() as tc:
+            tc.set_cookie(DOMAIN, 'session', first)
+            r = tc.get(routes.SESSIONS)
+            self.assertEqual(r.status_code, 200)
+            sessions = r.get_json()['sessions']
+            self.assertEqual(len(sessions), 3)
+            self.assertEqual([s['current'] for s in sessions].count(True), 1)
+
+            # sessions not seen within the session lifetime are dropped from the index
+            redis = self.app.config['SESSION_REDIS']
+            redis.set('session:expiredsid', b'')
+            lifetime = self.app.permanent_session_lifetime.total_seconds()
+            redis.zadd('user_sessions:sessions1', {'expiredsid': time.time() - lifetime - 1})
+            self.assertEqual(len(tc.get(routes.SESSIONS).get_json()['sessions']), 3)
+            self.assertIsNone(redis.zscore('user_sessions:sessions1', 'expiredsid'))
+
+            # changing the password logs every other session out
+            r = tc.put(routes.PROFILE, json={'new_password': 'Sessions2',
+                                             'user': {'password': 'Sessions1'}})
+            self.assertEqual(r.status_code, 202)
+            self.assertEqual(len(tc.get(routes.SESSIONS).get_json()['sessions']), 1)
+        for cookie in (second, third):
+            with self.client() as tc:
+                tc.set_cookie(DOMAIN, 'session', cookie)
+                self.assertEqual(tc.get(routes.PROFILE).status_code, 401)
+
+        fourth = self.get_cookie('sessions1', 'Sessions2')['session']
+        with self.client() as tc:
+            tc.set_cookie(DOMAIN, 'session', first)
+            self.assertEqual(tc.delete(routes.SESSIONS).status_code, 200)
+        for cookie in (first, fourth):
+            with self.client() as tc:
+                tc.set_cookie(DOMAIN, 'session', cookie)
+                self.assertEqual(tc.get(routes.PROFILE).status_code, 401)
+
+
+    def testTokenSessions(self):
+        private_key, public_key = generateKeyPair()
+        redis_sessions = self.app.session_interface
+        self.app.config.update(SESSION_TYPE='token', PRIVATE_KEY=private_key,
+                               PUBLIC_KEY=public_key)
+        token_signer.init_app(self.app)
+        token_sessions.init_app(self.app)
+        try:
+            redis = self.app.config['SESSION_REDIS']
+            stored = len(redis.keys('session:*'))
+            cookie = self.get_cookie('mhird23', 'Passin123')
+            claims = jwt.decode(cookie['session'], public_key, algorithms=['RS256'])
+            self.assertEqual(claims['data']['username'], 'mhird23')
+            with self.client() as tc:
+                tc.set_cookie(DOMAIN, 'session', cookie['session'])
+                self.assertEqual(tc.get(routes.PROFILE).status_code, 202)
+                self.assertEqual(tc.post(routes.LOGOUT).status_code, 200)
+            self.assertEqual(len(redis.keys('session:*')), stored)
+            sid = claims['jti']
+            self.assertIsNone(redis.zscore('user_sessions:mhird23', sid))
+
+            # a logged out token is refused by writes at once and by reads once stale
+            with self.client() as tc:
+                tc.set_cookie(DOMAIN, 'session', cookie['session'])
+                self.assertEqual(tc.get(routes.PROFILE).status_code, 202)
+                self.assertEqual(tc.put(routes.PROFILE, json={}).status_code, 401)
+                tc.set_cookie(DOMAIN, 'session', cookie['session'])
+                token_sessions.ttl = 0
+                self.assertEqual(tc.get(routes.PROFILE).status_code, 401)
+
+            # stale tokens of live sessions are reissued for the same session
+            cookie = self.get_cookie('mhird23', 'Passin123')
+            with self.client() as tc:
+                tc.set_cookie(DOMAIN, 'session', cookie['session'])
+                r = tc.get(routes.PROFILE)
+                self.assertEqual(r.status_code, 202)
+                reissued = parse_cookie(r.headers['Set-Cookie'])['session']
+            self.assertEqual(jwt.decode(reissued, public_key, algorithms=['RS256'])['jti'],
+                             jwt.decode(cookie['session'], public_key, algorithms=['RS256'])['jti'])
+        finally:
+            self.app.config['SESSION_TYPE'] = 'redis'
+            self.app.session_interface = redis_sessions
+
+
+    def testRegistrationEmailIsSentByTask(self):
+        private_key, public_key = generateKeyPair()
+        self.app.config.update(PRIVATE_KEY=private_key, PUBLIC_KEY=public_key)
+        token_signer.init_app(self.app)
+        del mailer.outbox[:]
+        r = self.client().post(routes.REGISTRATION, json={'username': 'tasks1',
+                                                         'email': 'tasks1@live.ca',
+                                                         'first_name': 'Tess',
+                                                         'last_name': 'Tasks',
+                                                         'password': 'Tasks123'
+                                                         })
+        self.assertEqual(r.status_code, 201)
+        self.assertEqual(len(mailer.outbox), 1)
+        message = mailer.outbox[0]
+        self.assertEqual(message['To'], 'tasks1@live.ca')
+        token = message.get_content().strip().rsplit(' ', 1)[-1]
+        self.assertTrue(User.get_by_username('tasks1').confirm_user(token))
+
+
+    def testTaskRetriedByWorker(self):
+        del flaky_calls[:]
+        task_queue.backend, task_queue.retry_delay = 'redis', 0
+        try:
+            task_queue.clear()
+            self.assertIsNotNone(flaky_task.delay('first'))
+            self.assertEqual(task_queue.stats()['queued'], 1)
+            task_queue.work(self.app, burst=True)
+            self.assertEqual(flaky_calls, ['first', 'first'])
+            self.assertEqual(task_queue.stats(), {'queued': 0, 'scheduled': 0, 'failed': 0})
+
+            # tasks held by a worker that stopped without a heartbeat are run again
+            redis = task_queue.redis
+            job = {'id': 'orphan', 'name': flaky_task.__module__ + '.flaky_task',
+                   'args': ['second'], 'kwargs': {}, 'attempts': 0}
+            redis.sadd(task_queue.workers_key, 'stopped')
+            redis.lpush(task_queue.processing_key('stopped'), json.dumps(job))
+            task_queue.work(self.app, burst=True)
+            self.assertEqual(flaky_calls, ['first', 'first', 'second'])
+            self.assertEqual(redis.smembers(task_queue.workers_key), set())
+            self.assertEqual(redis.keys(task_queue.key_prefix + 'processing:*'), [])
+        finally:
+            task_queue.init_app(self.app, db)
+
+
+    def testTaskQueuedAfterCommit(self):
+        task_queue.backend = 'redis'
+        try:
+            task_queue.clear()
+            with transaction():
+                self.assertIsNotNone(flaky_task.delay('deferred'))
+                self.assertEqual(task_queue.stats()['queued'], 0)
+            self.assertEqual(task_queue.stats()['queued'], 1)
+
+            # a rolled back block never queues its tasks
+            with self.assertRaises(ValueError):
+                with transaction():
+                    flaky_task.delay('abandoned')
+                    raise ValueError('abandon the block')
+            self.assertEqual(task_queue.stats()['queued'], 1)
+        finally:
+            task_queue.clear()
+            task_queue.init_app(self.app, db)
+
+
+    def testTokenKeyRotation(self):
+        private_key, public_key = generateKeyPair()
+        self.app.config.update(JWT_ALGORITHM='RS256', PRIVATE_KEY=private_key,
+                               PUBLIC_KEY=public_key, PREVIOUS_PUBLIC_KEYS=None)
+        token_signer.init_app(self.app)
+        user = User.get_by_username('mhird23')
+        token = user.generate_username_token()
+
+        # tokens signed with a rotated out key are verified by the key their kid names
+        new_private_key, new_public_key = generateKeyPair('EdDSA')
+        self.app.config.update(JWT_ALGORITHM='EdDSA', PRIVATE_KEY=new_private_key,
+                               PUBLIC_KEY=new_public_key, PREVIOUS_PUBLIC_KEYS=public_key)
+        try:
+            token_signer.init_app(self.app)
+            new_token = user.generate_username_token()
+            self.assertEqual(jwt.get_unverified_header(new_token)['alg'], 'EdDSA')
+            self.assertTrue(user.confirm_user(token))
+            self.assertTrue(user.confirm_user(new_token))
+
+            self.app.config['PREVIOUS_PUBLIC_KEYS'] = None
+            token_signer.init_app(self.app)
+            self.assertFalse(user.confirm_user(token))
+        finally:
+            self.app.config.update(JWT_ALGORITHM='RS256', PRIVATE_KEY=private_key,
+                                   PUBLIC_KEY=public_key, PREVIOUS_PUBLIC_KEYS=None)
+            token_signer.init_app(self.app)
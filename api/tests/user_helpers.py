@@ -7,6 +7,15 @@ from sqlalchemy.schema import (
         DropConstraint,
         )
 
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives.asymmetric import ed25519, rsa
+from cryptography.hazmat.primitives.serialization import (
+        Encoding,
+        NoEncryption,
+        PrivateFormat,
+        PublicFormat,
+        )
+
 from models import db, User, Client
 
 
@@ -30,3 +39,15 @@ def removeTestUsers():
     db.session.commit()
     db.session.close()
 
+
+
+def generateKeyPair(algorithm: str = 'RS256'):
+    """Return a new PEM encoded private and public key for an RS256 or EdDSA signer."""
+    if algorithm == 'EdDSA':
+        key = ed25519.Ed25519PrivateKey.generate()
+    else:
+        key = rsa.generate_private_key(public_exponent=65537, key_size=2048,
+                                       backend=default_backend())
+    private_key = key.private_bytes(Encoding.PEM, PrivateFormat.PKCS8, NoEncryption())
+    public_key = key.public_key().public_bytes(Encoding.PEM, PublicFormat.SubjectPublicKeyInfo)
+    return private_key.decode('utf-8'), public_key.decode('utf-8')
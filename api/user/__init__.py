@@ -2,12 +2,27 @@ from flask import Blueprint
 
 from settings import routes
 from .views import ClientView
+from .views import ClientByIdView
 from .views import ClientsView
+from .views import ClientsImportView
+from .views import ClientsExportView
+from .views import ProjectsView
+from .views import ProjectByIdView
 
 user = Blueprint('user', __name__)
 
 client = ClientView.as_view('client')
 clients = ClientsView.as_view('clients')
+clients_import = ClientsImportView.as_view('clients_import')
+clients_export = ClientsExportView.as_view('clients_export')
+projects = ProjectsView.as_view('projects')
+client_by_id = ClientByIdView.as_view('client_by_id')
+project_by_id = ProjectByIdView.as_view('project_by_id')
 
 user.add_url_rule(routes.CLIENT, view_func=client, methods=['GET', 'PUT', 'POST', 'DELETE'])
-user.add_url_rule(routes.CLIENTS, view_func=clients, methods=['GET', 'POST'])
\ No newline at end of file
+user.add_url_rule(routes.CLIENTS, view_func=clients, methods=['GET', 'POST'])
+user.add_url_rule(routes.CLIENTS_IMPORT, view_func=clients_import, methods=['POST'])
+user.add_url_rule(routes.CLIENTS_EXPORT, view_func=clients_export, methods=['GET'])
+user.add_url_rule(routes.PROJECTS, view_func=projects, methods=['GET'])
+user.add_url_rule(routes.CLIENT_BY_ID, view_func=client_by_id, methods=['GET', 'PUT', 'DELETE'])
+user.add_url_rule(routes.PROJECT_BY_ID, view_func=project_by_id, methods=['GET', 'PUT', 'DELETE'])
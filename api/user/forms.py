@@ -1,11 +1,13 @@
-from marshmallow import Schema, fields, validate
+from marshmallow import fields, validate, INCLUDE
 from marshmallow.validate import Validator
 
 from utils.custom_forms import Regexr
+from utils.jit import JitSchema
 
 
-class ClientSchema(Schema):
+class ClientSchema(JitSchema):
     """Validate a new clients email, name and description."""
+    id = fields.Integer(dump_only=True)
     email = fields.Email(error='Email address is not valid.', required=True)
     name = fields.Str(
         validate=[
@@ -22,11 +24,13 @@ class ClientSchema(Schema):
                 error='Description must contain only letters, numbers, underscores, and punctuation.')
         ]
     )
-    projects = fields.Nested("ProjectSchema", many=True, dump_only=True, allow_none=True)
+    projects = fields.Nested("ProjectSchema", attribute='active_projects',
+        many=True, dump_only=True, allow_none=True)
 
 
-class ProjectSchema(Schema):
+class ProjectSchema(JitSchema):
     """Validate a new project name and description."""
+    id = fields.Integer(dump_only=True)
     name = fields.Str(
         validate=[
             validate.Length(min=2, max=40, 
@@ -41,4 +45,16 @@ class ProjectSchema(Schema):
             Regexr(r'[^\w\-.,;\ !?&\/:]', 
                 error='Description must contain only letters, numbers, underscores, and punctuation.')
         ]
-    )
\ No newline at end of file
+    )
+
+
+# Prebuilt schema variants shared by all requests. Schemas keep no state between
+  # load and dump calls, so a single instance can be used from many threads.
+client_schema = ClientSchema()
+clients_schema = ClientSchema(many=True)
+client_update_schema = ClientSchema(partial=True, unknown=INCLUDE)
+client_patch_schema = ClientSchema(partial=True)
+client_export_schema = ClientSchema(exclude=['projects'])
+project_schema = ProjectSchema(unknown=INCLUDE)
+project_update_schema = ProjectSchema(partial=True)
+projects_schema = ProjectSchema(many=True)
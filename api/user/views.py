@@ -1,7 +1,13 @@
+import io
+import csv
+
+from flask import Response
+from flask import current_app
 from flask import jsonify
 from flask import request
 from flask import url_for
 from flask import g
+from flask import stream_with_context
 from flask.views import MethodView
 from marshmallow import ValidationError
 from marshmallow import INCLUDE
@@ -9,29 +15,51 @@ from marshmallow import INCLUDE
 from utils.auth import generate_session
 from utils.auth import login_required
 from utils.auth import remove_session
+from utils.fastjson import json_provider
+from utils.fastjson import json_response
+from utils.pagination import InvalidPage
+from utils.pagination import page_arguments
+from utils.streams import UnsupportedFormat
+from utils.streams import batched
+from utils.streams import iter_records
+from utils.versions import conditional_get
+from utils.versions import current_user_version
+from utils.versions import data_versions
+from utils.versions import url_client_version
 from models import Project
 from models import Client
 from models import db
-from .forms import ProjectSchema
-from .forms import ClientSchema
+from models import transaction
+from .forms import client_schema
+from .forms import clients_schema
+from .forms import client_update_schema
+from .forms import client_patch_schema
+from .forms import client_export_schema
+from .forms import project_schema
+from .forms import project_update_schema
+from .forms import projects_schema
 
 
 class ClientsView(MethodView):
     """Resource to allow user to display clients."""
     decorators = [login_required]
 
+    @conditional_get(current_user_version, cache_response=True)
     def get(self):
-        """Retrieve a list of clients for a given user."""
-        clients_schema = ClientSchema(many=True)
-        clients = g.user.get_clients()
+        """Retrieve a page of clients for a given user."""
+        try:
+            after, limit = page_arguments()
+        except InvalidPage as err:
+            return jsonify({'errors': str(err)}), 422
+        clients, next_cursor = g.user.get_clients_page(after, limit)
         ret_vals = clients_schema.dump(clients)
-        return jsonify(ret_vals), 201
+        return json_response({'clients': ret_vals, 'next_cursor': next_cursor}, 201)
 
 
+    @transaction()
     def post(self):
         """Retrieve a list of clients for a given user."""
         json_input = request.get_json()
-        client_schema = ClientSchema()
         try:
             data = client_schema.load(json_input)
         except ValidationError as err:
@@ -41,20 +69,109 @@ class ClientsView(MethodView):
         if client:
             return jsonify({'errors': 'Client with that name and email already exists.'}), 422
 
-        client = Client(user=g.user, **data)
-        g.user.clients.append(client)
-        db.session.add(client)
-        db.session.commit()
+        client = Client()
+        client.add(g.user, **data)
+
+        clients = g.user.get_clients()
+        ret_vals = clients_schema.dump(clients)
+        return json_response({'clients' : ret_vals}, 201)
 
-        clients = g.user.clients.all()
-        ret_vals = ClientSchema().dump(clients, many=True)
-        return jsonify({'clients' : ret_vals}), 201
+
+class ClientsImportView(MethodView):
+    """Resource to allow user to import many clients from an NDJSON or CSV upload."""
+    decorators = [login_required]
+
+    def post(self):
+        """Validate and insert uploaded clients in batches, reporting on each row."""
+        try:
+            records = iter_records(request.stream, request.mimetype)
+        except UnsupportedFormat as err:
+            return jsonify({'errors': str(err)}), 415
+
+        summary = {'created': 0, 'duplicate': 0, 'invalid': 0, 'rows': []}
+        user_id = g.user.id
+        batch_size = current_app.config['CLIENT_IMPORT_BATCH_SIZE']
+        for batch in batched(enumerate(records, 1), batch_size):
+            results = []
+            valid = []
+            for row, (record, error) in batch:
+                if error is None:
+                    try:
+                        valid.append(client_schema.load(record))
+                        results.append({'row': row, 'status': None})
+                        continue
+                    except ValidationError as err:
+                        error = err.messages
+                results.append({'row': row, 'status': 'invalid', 'errors': error})
+
+            created = iter(Client.add_many(user_id, valid))
+            for result in results:
+                if result['status'] is None:
+                    result['status'] = 'created' if next(created) else 'duplicate'
+                summary[result['status']] += 1
+            summary['rows'].extend(results)
+        return json_response(summary, 201)
+
+
+class ClientsExportView(MethodView):
+    """Resource to allow user to download all of their clients and projects."""
+    decorators = [login_required]
+
+    csv_columns = ['client_name', 'client_email', 'client_description',
+                   'project_name', 'project_description']
+
+    def get(self):
+        """Stream every client and its projects as NDJSON (default) or CSV."""
+        export_format = request.args.get('format', 'ndjson')
+        if export_format not in ('ndjson', 'csv'):
+            return jsonify({'errors': 'Format must be either ndjson or csv.'}), 422
+
+        rows = g.user.export_clients(current_app.config['CLIENT_EXPORT_BATCH_SIZE'])
+        if export_format == 'csv':
+            body, mimetype = self.generate_csv(rows), 'text/csv'
+        else:
+            body, mimetype = self.generate_ndjson(rows), 'application/x-ndjson'
+        resp = Response(stream_with_context(body), mimetype=mimetype)
+        resp.headers['Content-Disposition'] = 'attachment; filename=clients.{}'.format(export_format)
+        return resp
+
+    def generate_ndjson(self, rows):
+        for client, projects in rows:
+            record = client_export_schema.dump(client)
+            record['projects'] = projects_schema.dump(projects)
+            yield json_provider.dumps(record) + b'\n'
+
+    def generate_csv(self, rows):
+        # One line per project, clients without projects get a line with empty project columns.
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(self.csv_columns)
+        for client, projects in rows:
+            for project in projects or [None]:
+                writer.writerow([client.name, client.email, client.description,
+                                 project.name if project else None,
+                                 project.description if project else None])
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+
+
+def named_client_version():
+    # Version of the client named in the request body, so writes to the user's other
+      # clients do not invalidate its cached responses. None when there is no such client.
+    json_input = request.get_json(silent=True)
+    try:
+        client_id = g.user.get_client_id(json_input['client_name'], json_input['client_email'])
+    except (KeyError, TypeError):
+        return None
+    return data_versions.client(client_id) if client_id is not None else None
 
 
 class ClientView(MethodView):
     """Resource to allow user to manage a client."""
     decorators = [login_required]
 
+    @conditional_get(named_client_version, cache_response=True)
     def get(self):
         """Get the current client and their projects."""
         json_input = request.get_json()
@@ -67,10 +184,11 @@ class ClientView(MethodView):
         client = g.user.get_client(client_name, client_email)
         if client is None:
             return jsonify({'errors': 'Client does not exist.'}), 422
-        ret_vals = ClientSchema().dump(client)
-        return jsonify(ret_vals), 201
+        ret_vals = client_schema.dump_json(client)
+        return json_response(ret_vals, 201)
 
 
+    @transaction()
     def put(self):
         """Update an existing clients information."""
         json_input = request.get_json()
@@ -84,17 +202,17 @@ class ClientView(MethodView):
         if client is None:
             return jsonify({'errors': 'Client does not exist.'}), 422
 
-        client_schema = ClientSchema(partial=True, unknown=INCLUDE)
         try:
-            data = client_schema.load(json_input)
+            data = client_update_schema.load(json_input)
         except ValidationError as err:
             return jsonify({'errors': err.messages}), 422
 
         client.update(**data)
-        ret_vals = ClientSchema().dump(client)
-        return jsonify(ret_vals), 202
+        ret_vals = client_schema.dump_json(client)
+        return json_response(ret_vals, 202)
 
 
+    @transaction()
     def post(self):
         """Create a new project for a given client."""
         json_input = request.get_json()
@@ -108,25 +226,25 @@ class ClientView(MethodView):
         if client is None:
             return jsonify({'errors': 'Client does not exist.'}), 422
         
-        project_schema = ProjectSchema(unknown=INCLUDE)
         try:
             data = project_schema.load(json_input)
         except ValidationError as err:
             return jsonify({'errors': err.messages}), 422
 
+        data.pop('client_name', None)
+        data.pop('client_email', None)
         try:
             project = Project(client=client, **data)
-            new_project = client.projects.append(project)
-            db.session.add(new_project)
-            db.session.commit()
-            client = db.session.refresh(client)
+            project.add()
         except:
-            return jsonify({'errrors': 'Internal server error, unable to add project.'}), 422
+            db.session.rollback()
+            return jsonify({'errors': 'Internal server error, unable to add project.'}), 422
 
-        ret_vals = ClientSchema().dump(client)
-        return jsonify(ret_vals), 202
+        ret_vals = client_schema.dump_json(client)
+        return json_response(ret_vals, 202)
 
 
+    @transaction()
     def delete(self):
         """Delete an existing client."""
         json_input = request.get_json()
@@ -142,3 +260,116 @@ class ClientView(MethodView):
         client.delete()
         return jsonify({'success': 'Client has been successfully deleted.'}), 308
 
+
+
+
+class ProjectsView(MethodView):
+    """Resource to allow user to display a client's projects."""
+    decorators = [login_required]
+
+    @conditional_get(current_user_version)
+    def get(self):
+        """Retrieve a page of projects for a given client."""
+        json_input = request.get_json()
+        try:
+            client_name = json_input['client_name']
+            client_email = json_input['client_email']
+        except:
+            return jsonify({'errors': 'Invalid data sent to this route.'}), 422
+        try:
+            after, limit = page_arguments()
+        except InvalidPage as err:
+            return jsonify({'errors': str(err)}), 422
+
+        client = g.user.get_client(client_name, client_email)
+        if client is None:
+            return jsonify({'errors': 'Client does not exist.'}), 422
+        projects, next_cursor = client.get_projects_page(after, limit)
+        ret_vals = projects_schema.dump(projects)
+        return json_response({'projects': ret_vals, 'next_cursor': next_cursor}, 201)
+
+
+class ClientByIdView(MethodView):
+    """Resource to allow user to manage a client addressed by its id."""
+    decorators = [login_required]
+
+    @conditional_get(url_client_version, cache_response=True, http_cache=True)
+    def get(self, client_id):
+        """Get a client and its projects."""
+        client = g.user.get_client_by_id(client_id)
+        if client is None:
+            return jsonify({'errors': 'Client does not exist.'}), 404
+        return json_response(client_schema.dump_json(client), 200)
+
+    @transaction()
+    def put(self, client_id):
+        """Update an existing client's information."""
+        client = g.user.get_client_by_id(client_id)
+        if client is None:
+            return jsonify({'errors': 'Client does not exist.'}), 404
+        try:
+            data = client_patch_schema.load(request.get_json())
+        except ValidationError as err:
+            return jsonify({'errors': err.messages}), 422
+
+        client.update(**data)
+        return json_response(client_schema.dump_json(client), 202)
+
+    @transaction()
+    def delete(self, client_id):
+        """Delete an existing client."""
+        client = g.user.get_client_by_id(client_id)
+        if client is None:
+            return jsonify({'errors': 'Client does not exist.'}), 404
+        client.delete()
+        return jsonify({'success': 'Client has been successfully deleted.'}), 200
+
+
+class ProjectByIdView(MethodView):
+    """Resource to allow user to manage a client's project addressed by their ids."""
+    decorators = [login_required]
+
+    @conditional_get(url_client_version, cache_response=True, http_cache=True)
+    def get(self, client_id, project_id):
+        """Get a project of a given client."""
+        project, error = self.get_project(client_id, project_id)
+        if project is None:
+            return error
+        return json_response(project_schema.dump_json(project), 200)
+
+    @transaction()
+    def put(self, client_id, project_id):
+        """Update an existing project's information."""
+        project, error = self.get_project(client_id, project_id)
+        if project is None:
+            return error
+        try:
+            data = project_update_schema.load(request.get_json())
+        except ValidationError as err:
+            return jsonify({'errors': err.messages}), 422
+
+        try:
+            project.update(g.user.id, **data)
+        except:
+            db.session.rollback()
+            return jsonify({'errors': 'Internal server error, unable to update project.'}), 422
+        return json_response(project_schema.dump_json(project), 202)
+
+    @transaction()
+    def delete(self, client_id, project_id):
+        """Delete an existing project."""
+        project, error = self.get_project(client_id, project_id)
+        if project is None:
+            return error
+        project.delete()
+        return jsonify({'success': 'Project has been successfully deleted.'}), 200
+
+    def get_project(self, client_id, project_id):
+        # Return (project, None) or (None, error response) for the ids in the URL.
+        client = g.user.get_client_by_id(client_id)
+        if client is None:
+            return None, (jsonify({'errors': 'Client does not exist.'}), 404)
+        project = client.get_project_by_id(project_id)
+        if project is None:
+            return None, (jsonify({'errors': 'Project does not exist.'}), 404)
+        return project, None
@@ -1,18 +1,28 @@
 # -*- coding: utf-8 -*-
 """Authentication utility functions."""
 
+import hmac
+import hashlib
+
+from datetime import datetime
 from functools import wraps
-from flask import g, jsonify, url_for, session
+from flask import current_app, g, jsonify, request, url_for, session
 from models import User
+from utils.replicas import replica_reads
+from utils.sessions import session_index
 
 def generate_session(username):
+    if session.get('username') not in (None, username):
+        remove_session()
     session['username'] = username
+    session_index.add(username, session.sid)
 
 def login_required(f):
     @wraps(f)
     def decorated(*args, **kwargs):
         if 'username' in session:
-            user = User.query.filter_by(username=session['username']).first()
+            with replica_reads():
+                user = User.get_by_username(session['username'])
             if user is None:
                 return jsonify({'errors': 'Invalid username was provided.'}), 401
             g.user = user
@@ -22,5 +32,39 @@ def login_required(f):
     return decorated
 
 
+def status_required(f):
+    # Allow requests from STATUS_ALLOWED_IPS, or bearing STATUS_TOKEN when it is set.
+    @wraps(f)
+    def decorated(*args, **kwargs):
+        token = current_app.config.get('STATUS_TOKEN')
+        if request.remote_addr in current_app.config.get('STATUS_ALLOWED_IPS', ()):
+            return f(*args, **kwargs)
+        if token and hmac.compare_digest(request.headers.get('Authorization', '').encode('utf-8'),
+                                         'Bearer {}'.format(token).encode('utf-8')):
+            return f(*args, **kwargs)
+        return jsonify({'errors': 'Insufficient credentials provided.'}), 401
+    return decorated
+
+
 def remove_session():
-    session.pop('username', None)
\ No newline at end of file
+    # Read the id first, a token session gets a new id once its user is removed.
+    sid = session.sid
+    username = session.pop('username', None)
+    if username is not None:
+        session_index.discard(username, sid)
+
+
+def list_sessions(username: str) -> list:
+    # Describe the user's live sessions without exposing their session ids.
+    return [{'id': hashlib.sha256(sid.encode('utf-8')).hexdigest()[:16],
+             'last_seen': datetime.utcfromtimestamp(seen).isoformat(),
+             'current': sid == session.sid}
+            for sid, seen in session_index.sessions(username)]
+
+
+def revoke_sessions(username: str, keep_current: bool = False) -> int:
+    # Log the user out of all of their sessions, return the number revoked.
+    count = session_index.revoke_all(username, keep=session.sid if keep_current else None)
+    if not keep_current:
+        remove_session()
+    return count
@@ -0,0 +1,235 @@
+# -*- coding: utf-8 -*-
+"""Caching utilities for data that is read on (almost) every request.
+
+The user cache keeps the column state of recently authenticated users in a
+per-process LRU with a TTL, optionally backed by a shared Redis tier so that
+workers can warm each other. Values are plain dictionaries so this module does
+not depend on the models, which are responsible for turning cached state back
+into session-bound objects.
+
+Every entry records the generation of the user it was built from, a counter in
+Redis that any worker increments when it invalidates the user. An entry is only
+used while its generation is current, so a change made by one worker is seen by
+all of them on their next lookup.
+
+The response cache keeps serialized response bodies in Redis, keyed by the data
+version they were built from (see utils.versions).
+"""
+
+import json
+import threading
+import time
+
+from collections import OrderedDict
+from datetime import datetime
+from redis.exceptions import RedisError
+
+
+def encode_value(value):
+    # JSON encoding of column values json does not handle.
+    if isinstance(value, datetime):
+        return {'$datetime': value.isoformat()}
+    raise TypeError('Unable to cache a value of type {}.'.format(type(value).__name__))
+
+
+def decode_object(obj: dict):
+    if len(obj) == 1 and '$datetime' in obj:
+        return datetime.fromisoformat(obj['$datetime'])
+    return obj
+
+
+class UserCache(object):
+    """Two tier (process-local LRU, then Redis) cache keyed by username.
+
+    * Local entries expire after ``USER_CACHE_TTL`` seconds and the least recently
+        used entry is evicted once ``USER_CACHE_SIZE`` entries are held.
+    * Redis entries are stored as JSON with the same TTL when ``USER_CACHE_USE_REDIS``
+        is set.
+    * Entries of either tier are only used while their generation is current, which
+        costs one Redis round trip per lookup. When the generation cannot be read
+        the user is loaded from the database.
+    """
+
+    key_prefix = 'user_cache:'
+    generation_prefix = 'user_cache_generation:'
+
+    def __init__(self, app=None):
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.enabled = False
+        self.max_size = 0
+        self.ttl = 0
+        self.redis = None
+        self.use_redis = False
+        self.hits = 0
+        self.redis_hits = 0
+        self.misses = 0
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.enabled = app.config.get('USER_CACHE_ENABLED', True)
+        self.max_size = int(app.config.get('USER_CACHE_SIZE', 1024))
+        self.ttl = int(app.config.get('USER_CACHE_TTL', 30))
+        self.redis = app.config['SESSION_REDIS']
+        self.use_redis = bool(app.config.get('USER_CACHE_USE_REDIS'))
+        self.clear()
+
+    def get(self, username: str) -> tuple:
+        # Return (state, generation) for username. State is None if the user must be
+          # loaded, pass the generation to set() along with the loaded state.
+        if not self.enabled:
+            return None, None
+        pipe = self.redis.pipeline(transaction=False)
+        pipe.get(self.generation_prefix + username)
+        if self.use_redis:
+            pipe.get(self.key_prefix + username)
+        try:
+            values = pipe.execute()
+        except RedisError:
+            with self._lock:
+                self.misses += 1
+            return None, None
+        generation = int(values[0] or 0)
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(username)
+            if entry is not None:
+                expires_at, entry_generation, state = entry
+                if expires_at > now and entry_generation == generation:
+                    self._entries.move_to_end(username)
+                    self.hits += 1
+                    return state, generation
+                del self._entries[username]
+
+        state = None
+        if self.use_redis and values[1] is not None:
+            entry_generation, state = json.loads(values[1], object_hook=decode_object)
+            if entry_generation != generation:
+                state = None
+        with self._lock:
+            if state is None:
+                self.misses += 1
+                return None, generation
+            self.redis_hits += 1
+        self._store(username, generation, state, now)
+        return state, generation
+
+    def set(self, username: str, state: dict, generation: int):
+        # Cache state loaded after get() returned generation for username.
+        if not self.enabled or generation is None:
+            return
+        self._store(username, generation, state, time.monotonic())
+        if self.use_redis:
+            try:
+                self.redis.setex(self.key_prefix + username, self.ttl,
+                                 json.dumps([generation, state], default=encode_value))
+            except RedisError:
+                pass
+
+    def invalidate(self, username: str):
+        with self._lock:
+            self._entries.pop(username, None)
+        pipe = self.redis.pipeline()
+        pipe.incr(self.generation_prefix + username)
+        if self.use_redis:
+            pipe.delete(self.key_prefix + username)
+        try:
+            pipe.execute()
+        except RedisError:
+            pass
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits = self.redis_hits = self.misses = 0
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'redis_hits': self.redis_hits,
+                'misses': self.misses,
+                'size': len(self._entries),
+            }
+
+    def _store(self, username: str, generation: int, state: dict, now: float):
+        with self._lock:
+            self._entries[username] = (now + self.ttl, generation, state)
+            self._entries.move_to_end(username)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+
+class ResponseCache(object):
+    """Serialized responses stored in Redis under a data version specific key.
+
+    * Keys include the version of the data a response was built from, so a write
+        that bumps the version invalidates every response built before it.
+    * Entries expire after ``RESPONSE_CACHE_TTL`` seconds and bodies larger than
+        ``RESPONSE_CACHE_MAX_BYTES`` are never stored.
+    """
+
+    key_prefix = 'response_cache:'
+
+    def __init__(self, app=None):
+        self._lock = threading.Lock()
+        self.enabled = False
+        self.ttl = 0
+        self.max_bytes = 0
+        self.redis = None
+        self.hits = 0
+        self.misses = 0
+        self.bytes_saved = 0
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.enabled = app.config.get('RESPONSE_CACHE_ENABLED', True)
+        self.ttl = int(app.config.get('RESPONSE_CACHE_TTL', 300))
+        self.max_bytes = int(app.config.get('RESPONSE_CACHE_MAX_BYTES', 1048576))
+        self.redis = app.config['SESSION_REDIS']
+        self.clear()
+
+    def get(self, key: str):
+        # Return (status, body) stored for key, or None.
+        if not self.enabled:
+            return None
+        try:
+            value = self.redis.get(self.key_prefix + key)
+        except RedisError:
+            value = None
+        with self._lock:
+            if value is None:
+                self.misses += 1
+                return None
+            status, body = value.split(b'\n', 1)
+            self.hits += 1
+            self.bytes_saved += len(body)
+        return int(status), body
+
+    def set(self, key: str, status: int, body: bytes):
+        if not self.enabled or len(body) > self.max_bytes:
+            return
+        try:
+            self.redis.setex(self.key_prefix + key, self.ttl, b'%d\n' % status + body)
+        except RedisError:
+            pass
+
+    def clear(self):
+        with self._lock:
+            self.hits = self.misses = self.bytes_saved = 0
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': round(self.hits / lookups, 4) if lookups else None,
+                'bytes_saved': self.bytes_saved,
+            }
+
+
+user_cache = UserCache()
+response_cache = ResponseCache()
@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+"""EXPLAIN based checks that the hot lookup queries are served by their indexes.
+
+The queries mirror the ones issued by ``User.get_client``, ``User.get_clients_page``
+and ``Client.get_projects_page``, keyed by the index expected to serve them.
+"""
+
+import click
+
+from flask.cli import with_appcontext
+from models import db, Client, Project
+
+
+def hot_queries() -> dict:
+    # Values are taken from an existing client when there is one, so the planner
+      # estimates are representative of real lookups.
+    sample = Client.query.filter_by(deleted=False).first()
+    user_id, client_id, name, email = 1, 1, 'name', 'email'
+    if sample is not None:
+        user_id, client_id, name, email = sample.user_id, sample.id, sample.name, sample.email
+    return {
+        'ix_client_user_id_name_email':
+            Client.query.filter_by(user_id=user_id, name=name, email=email, deleted=False).limit(1),
+        'ix_client_user_id_created_at':
+            Client.query.filter_by(user_id=user_id, deleted=False)
+                        .order_by(Client.created_at, Client.id).limit(51),
+        'ix_project_client_id_created_at':
+            Project.query.filter_by(client_id=client_id, deleted=False)
+                         .order_by(Project.created_at, Project.id).limit(51),
+    }
+
+
+def explain(query) -> str:
+    statement = query.statement.compile(dialect=db.engine.dialect,
+                                        compile_kwargs={'literal_binds': True})
+    try:
+        # Development tables are usually small enough for a sequential scan to be
+          # cheapest, so rule it out to see which index the planner would pick.
+        db.session.execute('ANALYZE {}'.format(query.statement.froms[0].name))
+        db.session.execute('SET LOCAL enable_seqscan = off')
+        rows = db.session.execute('EXPLAIN {}'.format(statement)).fetchall()
+    finally:
+        db.session.rollback()
+    return '\n'.join(row[0] for row in rows)
+
+
+def check_indexes() -> dict:
+    # Return the plan of each hot query and whether it uses its expected index.
+    results = {}
+    for index, query in hot_queries().items():
+        plan = explain(query)
+        results[index] = (index in plan, plan)
+    return results
+
+
+@click.command('check-indexes')
+@with_appcontext
+def check_indexes_command():
+    """Verify with EXPLAIN that the hot queries use their indexes."""
+    failed = False
+    for index, (used, plan) in check_indexes().items():
+        click.echo('{} {}'.format('ok     ' if used else 'MISSING', index))
+        if not used:
+            failed = True
+            click.echo(plan)
+    if failed:
+        raise SystemExit(1)
@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+"""Pluggable JSON encoding for responses, backed by orjson when it is installed.
+
+``JSON_PROVIDER`` selects ``orjson`` (the default) or the standard library ``json``.
+The chosen provider also becomes the app's ``json_encoder``, so ``jsonify`` uses it,
+while ``json_response`` goes straight from Python objects to response bytes.
+"""
+
+import json
+
+from flask import current_app, Response
+from flask.json import JSONEncoder
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+class OrjsonEncoder(JSONEncoder):
+    """JSON encoder used by ``jsonify`` that delegates compact output to orjson."""
+
+    def encode(self, o):
+        if self.indent is not None or orjson is None:
+            return super(OrjsonEncoder, self).encode(o)
+        option = orjson.OPT_SORT_KEYS if self.sort_keys else 0
+        return orjson.dumps(o, default=self.default, option=option).decode('utf-8')
+
+
+class JSONProvider(object):
+    """Encode Python objects to JSON bytes with the configured backend."""
+
+    def __init__(self, app=None):
+        self.backend = 'json'
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.backend = app.config.get('JSON_PROVIDER', 'orjson')
+        if self.backend not in ('orjson', 'json'):
+            raise ValueError('Unknown JSON provider {}.'.format(self.backend))
+        if self.backend == 'orjson' and orjson is None:
+            self.backend = 'json'
+        if self.backend == 'orjson':
+            app.json_encoder = OrjsonEncoder
+
+    def dumps(self, obj) -> bytes:
+        if self.backend == 'orjson':
+            return orjson.dumps(obj, default=JSONEncoder().default)
+        return json.dumps(obj, separators=(',', ':'), default=JSONEncoder().default).encode('utf-8')
+
+
+json_provider = JSONProvider()
+
+
+def json_response(body, status: int = 200) -> Response:
+    # Build a JSON response from an object, or from bytes that are already encoded.
+    if not isinstance(body, bytes):
+        body = json_provider.dumps(body)
+    return current_app.response_class(body, status=status, mimetype='application/json')
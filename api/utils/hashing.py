@@ -0,0 +1,224 @@
+# -*- coding: utf-8 -*-
+"""Password hashing run on a bounded worker pool.
+
+Argon2 is deliberately expensive, so hashing and verification are moved off the
+request thread into a thread or process pool with a fixed number of pending jobs.
+Under gevent workers the ``gevent`` executor runs jobs on real OS threads so that
+hashing never blocks the event loop serving every other connection.
+When the pool is saturated requests fail fast with a 503 rather than queueing
+behind each other and stalling cheap requests served by the same worker.
+"""
+
+import os
+import time
+import click
+import threading
+
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import TimeoutError
+from flask import jsonify
+from flask.cli import with_appcontext
+from argon2 import PasswordHasher
+from argon2 import DEFAULT_TIME_COST, DEFAULT_MEMORY_COST, DEFAULT_PARALLELISM
+from argon2.exceptions import VerifyMismatchError, InvalidHash
+
+from utils.metrics import metrics
+
+try:
+    from gevent.threadpool import ThreadPoolExecutor as GeventThreadPoolExecutor
+except ImportError:
+    GeventThreadPoolExecutor = None
+
+# Hasher shared by every hashing job in this process, replaced by configure_hasher.
+_hasher = PasswordHasher()
+
+
+class HashingUnavailable(Exception):
+    """Raised when the hashing pool is full or a job does not finish in time."""
+
+
+def configure_hasher(time_cost: int, memory_cost: int, parallelism: int):
+    global _hasher
+    _hasher = PasswordHasher(time_cost=time_cost, memory_cost=memory_cost,
+                             parallelism=parallelism)
+
+
+def hash_password(password: str) -> str:
+    return _hasher.hash(password)
+
+
+def verify_password(password_hash: str, password: str) -> bool:
+    # Return false if passwords do not match or if
+      # password hash has been tampered.
+    try:
+        return _hasher.verify(password_hash, password)
+    except VerifyMismatchError:
+        return False
+    except InvalidHash:
+        return False
+
+
+def needs_rehash(password_hash: str) -> bool:
+    # Return true if password_hash was created with parameters other than the current ones.
+    try:
+        return _hasher.check_needs_rehash(password_hash)
+    except InvalidHash:
+        return True
+
+
+class HashingPool(object):
+    """Run password hashing jobs on a bounded executor.
+
+    * ``PASSWORD_HASH_EXECUTOR`` selects a ``thread``, ``process`` or ``gevent`` pool.
+    * At most ``PASSWORD_HASH_WORKERS + PASSWORD_HASH_QUEUE_SIZE`` jobs are pending at once,
+        further jobs raise HashingUnavailable immediately.
+    * Callers wait at most ``PASSWORD_HASH_TIMEOUT`` seconds for a result.
+    * Argon2 costs are read from ``ARGON2_TIME_COST``, ``ARGON2_MEMORY_COST`` and
+        ``ARGON2_PARALLELISM``, see ``flask calibrate-hasher``.
+    """
+
+    executors = {
+        'thread': ThreadPoolExecutor,
+        'process': ProcessPoolExecutor,
+        'gevent': GeventThreadPoolExecutor,
+    }
+
+    def __init__(self, app=None):
+        self._executor = None
+        self._pid = None
+        self._slots = None
+        self._lock = threading.Lock()
+        self.kind = 'thread'
+        self.workers = 0
+        self.max_pending = 0
+        self.timeout = None
+        self.parameters = (DEFAULT_TIME_COST, DEFAULT_MEMORY_COST, DEFAULT_PARALLELISM)
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.kind = app.config.get('PASSWORD_HASH_EXECUTOR', 'thread')
+        if self.executors.get(self.kind) is None:
+            raise ValueError('Unknown or unavailable password hash executor {}.'.format(self.kind))
+        self.workers = int(app.config.get('PASSWORD_HASH_WORKERS', 2))
+        self.max_pending = self.workers + int(app.config.get('PASSWORD_HASH_QUEUE_SIZE', 8))
+        self.timeout = float(app.config.get('PASSWORD_HASH_TIMEOUT', 5))
+        self.parameters = (int(app.config.get('ARGON2_TIME_COST', DEFAULT_TIME_COST)),
+                           int(app.config.get('ARGON2_MEMORY_COST', DEFAULT_MEMORY_COST)),
+                           int(app.config.get('ARGON2_PARALLELISM', DEFAULT_PARALLELISM)))
+        configure_hasher(*self.parameters)
+        self._slots = threading.BoundedSemaphore(self.max_pending)
+        self.shutdown()
+        app.register_error_handler(HashingUnavailable, self._unavailable)
+
+    def hash(self, password: str) -> str:
+        return self._timed('hash', hash_password, password)
+
+    def verify(self, password_hash: str, password: str) -> bool:
+        return self._timed('verify', verify_password, password_hash, password)
+
+    def needs_rehash(self, password_hash: str) -> bool:
+        # Only parses the hash, so it is cheap enough to run inline.
+        return needs_rehash(password_hash)
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+        self._executor = None
+        self._pid = None
+
+    def _timed(self, operation: str, func, *args):
+        # Time includes waiting for a free worker, which is what requests experience.
+        start = time.perf_counter()
+        try:
+            return self._run(func, *args)
+        finally:
+            metrics.observe_hash(operation, time.perf_counter() - start)
+
+    def _run(self, func, *args):
+        # Hash inline when the pool has not been configured (eg. scripts or a shell).
+        if self._slots is None:
+            return func(*args)
+        if not self._slots.acquire(blocking=False):
+            raise HashingUnavailable('Password hashing queue is full.')
+        try:
+            future = self._get_executor().submit(func, *args)
+        except Exception:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda _: self._slots.release())
+        try:
+            return future.result(timeout=self.timeout)
+        except TimeoutError:
+            future.cancel()
+            raise HashingUnavailable('Password hashing timed out.')
+
+    def _get_executor(self):
+        # Executors are created lazily per process so that pools are never
+        # shared across a fork by a pre-forking server.
+        with self._lock:
+            if self._executor is None or self._pid != os.getpid():
+                if self.kind == 'process':
+                    self._executor = ProcessPoolExecutor(max_workers=self.workers,
+                                                         initializer=configure_hasher,
+                                                         initargs=self.parameters)
+                else:
+                    self._executor = self.executors[self.kind](max_workers=self.workers)
+                self._pid = os.getpid()
+            return self._executor
+
+    def _unavailable(self, error):
+        resp = jsonify({'errors': 'Server is busy, please try again shortly.'})
+        resp.headers['Retry-After'] = '1'
+        return resp, 503
+
+
+def measure_verify(time_cost: int, memory_cost: int, parallelism: int, rounds: int = 5) -> float:
+    # Return the median time in seconds taken to verify a password with the given costs.
+    hasher = PasswordHasher(time_cost=time_cost, memory_cost=memory_cost,
+                            parallelism=parallelism)
+    password_hash = hasher.hash('calibration-password')
+    timings = []
+    for _ in range(rounds):
+        start = time.perf_counter()
+        hasher.verify(password_hash, 'calibration-password')
+        timings.append(time.perf_counter() - start)
+    return sorted(timings)[len(timings) // 2]
+
+
+def calibrate(target: float, max_memory_cost: int, parallelism: int) -> tuple:
+    """Pick Argon2 costs that verify in about ``target`` seconds on this host.
+
+    Memory cost is preferred over time cost since it is what makes Argon2 expensive
+    to attack, so memory is halved until a single pass fits the target and time cost
+    is then raised while the target is not exceeded.
+    """
+    memory_cost = max_memory_cost
+    while memory_cost > 8 * parallelism and measure_verify(1, memory_cost, parallelism) > target:
+        memory_cost //= 2
+    time_cost = 1
+    while measure_verify(time_cost + 1, memory_cost, parallelism) <= target:
+        time_cost += 1
+    return time_cost, memory_cost, parallelism
+
+
+@click.command('calibrate-hasher')
+@click.option('--target-ms', default=250, show_default=True,
+              help='Desired password verification latency in milliseconds.')
+@click.option('--max-memory', default=DEFAULT_MEMORY_COST, show_default=True,
+              help='Largest memory cost to consider, in kibibytes.')
+@click.option('--parallelism', default=os.cpu_count() or DEFAULT_PARALLELISM, show_default=True,
+              help='Number of lanes used per hash.')
+@with_appcontext
+def calibrate_command(target_ms, max_memory, parallelism):
+    """Benchmark this host and print Argon2 settings for the configured target."""
+    time_cost, memory_cost, parallelism = calibrate(target_ms / 1000, max_memory, parallelism)
+    latency = measure_verify(time_cost, memory_cost, parallelism)
+    click.echo('# verify latency {:.1f}ms (target {}ms)'.format(latency * 1000, target_ms))
+    click.echo('ARGON2_TIME_COST={}'.format(time_cost))
+    click.echo('ARGON2_MEMORY_COST={}'.format(memory_cost))
+    click.echo('ARGON2_PARALLELISM={}'.format(parallelism))
+
+
+hashing_pool = HashingPool()
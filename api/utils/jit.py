@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+"""Compiled dump functions for marshmallow schemas.
+
+``toastedmarshmallow`` only supports marshmallow 2, so this module provides the
+same idea for the schemas in this project: the first time a schema instance
+dumps an object, Python source specialised to its fields is generated and
+compiled, replacing marshmallow's generic per-field serialization. Schemas using
+features the compiler does not understand keep using marshmallow as before.
+Loading is unchanged, since validation is where marshmallow spends its time.
+"""
+
+import threading
+
+from functools import partial
+from collections.abc import Mapping
+from marshmallow import Schema, fields, missing
+from marshmallow.decorators import PRE_DUMP, POST_DUMP
+from marshmallow.utils import ensure_text_type
+
+from utils.fastjson import json_provider
+
+# Field classes the compiler knows how to serialize.
+TEXT_FIELDS = (fields.String, fields.Email)
+INTEGER_FIELDS = (fields.Integer,)
+
+
+def compile_dump(schema):
+    """Return a function dumping one object like ``schema.dump`` does, or None if
+    the schema uses features that can not be compiled."""
+    if schema.ordered or schema._has_processors(PRE_DUMP) or schema._has_processors(POST_DUMP):
+        return None
+    if type(schema).get_attribute is not Schema.get_attribute:
+        return None
+
+    lines = ['def dump(obj):',
+             '    if isinstance(obj, Mapping):',
+             '        return fallback(obj, many=False)',
+             '    result = {}']
+    namespace = {'Mapping': Mapping, 'missing': missing, 'text': ensure_text_type,
+                 'fallback': partial(Schema.dump, schema)}
+    for index, (name, field) in enumerate(schema.dump_fields.items()):
+        if field.default is not missing or type(field).serialize is not fields.Field.serialize:
+            return None
+        attribute = field.attribute or name
+        if '.' in attribute:
+            return None
+        key = field.data_key if field.data_key is not None else name
+        if isinstance(field, TEXT_FIELDS) and type(field)._serialize in (
+                fields.String._serialize, fields.Email._serialize):
+            expression = 'value if value.__class__ is str else text(value)'
+        elif isinstance(field, INTEGER_FIELDS) and type(field) is fields.Integer:
+            expression = 'int(value)'
+        elif type(field) is fields.Nested:
+            nested = field.schema
+            namespace['nested_{}'.format(index)] = nested.dump
+            expression = 'nested_{}(value, many={!r})'.format(index, nested.many or field.many)
+        else:
+            return None
+        lines.extend([
+            '    value = getattr(obj, {!r}, missing)'.format(attribute),
+            '    if value is not missing:',
+            '        result[{!r}] = None if value is None else {}'.format(key, expression),
+        ])
+    lines.append('    return result')
+    exec(compile('\n'.join(lines), '<jit {}>'.format(type(schema).__name__), 'exec'), namespace)
+    return namespace['dump']
+
+
+class JitSchema(Schema):
+    """Schema whose ``dump`` runs a compiled function when one can be built.
+
+    Set ``JitSchema.jit`` to False (``MARSHMALLOW_JIT`` in the app config) to use
+    marshmallow's own serialization for every schema.
+    """
+
+    jit = True
+    _jit_lock = threading.Lock()
+
+    def dump(self, obj, *, many=None):
+        dumper = self.jit_dumper() if JitSchema.jit else None
+        if dumper is None:
+            return super(JitSchema, self).dump(obj, many=many)
+        many = self.many if many is None else bool(many)
+        if many:
+            return [dumper(item) for item in obj]
+        return dumper(obj)
+
+    def dump_json(self, obj, *, many=None) -> bytes:
+        """Dump ``obj`` straight to JSON bytes with the app's JSON provider."""
+        return json_provider.dumps(self.dump(obj, many=many))
+
+    def jit_dumper(self):
+        # Compile once per schema instance, None is cached when compiling fails.
+        try:
+            return self._jit_dump
+        except AttributeError:
+            with self._jit_lock:
+                if not hasattr(self, '_jit_dump'):
+                    self._jit_dump = compile_dump(self)
+            return self._jit_dump
@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+"""Plain text email sent through the backend chosen by ``MAIL_BACKEND``.
+
+* ``smtp`` sends through ``MAIL_SERVER``, using STARTTLS with ``MAIL_USE_TLS``.
+* ``console`` logs messages instead of sending them, for development.
+* ``memory`` keeps messages in ``mailer.outbox``, for tests.
+
+Sending is slow external I/O, call it from tasks rather than from views.
+"""
+
+import logging
+import smtplib
+
+from email.message import EmailMessage
+
+logger = logging.getLogger(__name__)
+
+
+class Mailer(object):
+    """Send email with the configured backend."""
+
+    def __init__(self, app=None):
+        self.backend = 'console'
+        self.sender = None
+        self.server = None
+        self.port = 587
+        self.username = None
+        self.password = None
+        self.use_tls = True
+        self.timeout = 10
+        self.outbox = []
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.backend = app.config.get('MAIL_BACKEND', 'console')
+        if self.backend not in ('smtp', 'console', 'memory'):
+            raise ValueError('Unknown MAIL_BACKEND {}.'.format(self.backend))
+        self.sender = app.config.get('MAIL_SENDER')
+        self.server = app.config.get('MAIL_SERVER')
+        self.port = int(app.config.get('MAIL_PORT', 587))
+        self.username = app.config.get('MAIL_USERNAME')
+        self.password = app.config.get('MAIL_PASSWORD')
+        self.use_tls = app.config.get('MAIL_USE_TLS', True)
+        self.timeout = float(app.config.get('MAIL_TIMEOUT', 10))
+
+    def send(self, to: str, subject: str, body: str):
+        message = EmailMessage()
+        message['From'] = self.sender
+        message['To'] = to
+        message['Subject'] = subject
+        message.set_content(body)
+        if self.backend == 'memory':
+            self.outbox.append(message)
+        elif self.backend == 'console':
+            logger.info('Email to %s: %s\n%s', to, subject, body)
+        else:
+            with smtplib.SMTP(self.server, self.port, timeout=self.timeout) as smtp:
+                if self.use_tls:
+                    smtp.starttls()
+                if self.username:
+                    smtp.login(self.username, self.password)
+                smtp.send_message(message)
+
+
+mailer = Mailer()
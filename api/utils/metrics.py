@@ -0,0 +1,237 @@
+# -*- coding: utf-8 -*-
+"""Request, SQL, Redis and password hashing metrics in the Prometheus text format.
+
+Metrics are kept in memory per worker process and labelled with the Flask endpoint
+serving the request, so a slow endpoint can be broken down into time spent in
+Postgres, Redis and argon2. Observing a value takes a lock and a bisect, which is
+cheap enough to run on every query. Workers share snapshots of their metrics
+through utils.snapshots, and /metrics renders the sum over all workers.
+"""
+
+import time
+import threading
+
+from bisect import bisect_left
+from flask import g, has_request_context, request
+from sqlalchemy import event
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100, 200)
+
+
+def format_labels(names: tuple, values: tuple) -> str:
+    if not names:
+        return ''
+    pairs = ('{}="{}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+             for name, value in zip(names, values))
+    return '{' + ','.join(pairs) + '}'
+
+
+class Counter(object):
+    """Monotonic counter per combination of label values."""
+
+    kind = 'counter'
+
+    def __init__(self, name: str, documentation: str, labels: tuple = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *label_values, amount: float = 1):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def clear(self):
+        with self._lock:
+            self._values.clear()
+
+    def snapshot(self) -> list:
+        # JSON serializable [label values, value] pairs, see merge.
+        with self._lock:
+            return [[list(values), value] for values, value in self._values.items()]
+
+    def merge(self, snapshots: list) -> dict:
+        # Combine snapshots of this collector taken in several processes.
+        merged = {}
+        for snapshot in snapshots:
+            for values, value in snapshot:
+                values = tuple(values)
+                merged[values] = self._add(merged.get(values), value)
+        return merged
+
+    def samples(self, values: dict = None):
+        # Samples of values, a merged dict, or of this process's values by default.
+        if values is None:
+            with self._lock:
+                values = dict(self._values)
+        return [(self.name, format_labels(self.labels, labels), value)
+                for labels, value in sorted(values.items())]
+
+    def _add(self, total, value):
+        return value if total is None else total + value
+
+
+class Histogram(Counter):
+    """Cumulative bucket counts, sum and count per combination of label values."""
+
+    kind = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labels: tuple = (),
+                 buckets: tuple = LATENCY_BUCKETS):
+        super(Histogram, self).__init__(name, documentation, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value: float, *label_values):
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._values.get(label_values)
+            if series is None:
+                # bucket counts followed by the sum
+                series = self._values[label_values] = [0] * (len(self.buckets) + 2)
+            series[index] += 1
+            series[-1] += value
+
+    def snapshot(self) -> list:
+        with self._lock:
+            return [[list(values), list(series)] for values, series in self._values.items()]
+
+    def samples(self, values: dict = None):
+        if values is None:
+            with self._lock:
+                values = {labels: list(series) for labels, series in self._values.items()}
+        samples = []
+        for values, series in sorted(values.items()):
+            count = 0
+            for bound, observed in zip(self.buckets + ('+Inf',), series[:-1]):
+                count += observed
+                labels = format_labels(self.labels + ('le',), values + (bound,))
+                samples.append((self.name + '_bucket', labels, count))
+            labels = format_labels(self.labels, values)
+            samples.append((self.name + '_sum', labels, series[-1]))
+            samples.append((self.name + '_count', labels, count))
+        return samples
+
+    def _add(self, total, series):
+        if total is None:
+            return list(series)
+        return [a + b for a, b in zip(total, series)]
+
+
+class Metrics(object):
+    """Collect metrics for the app's requests and render them for scraping.
+
+    * Request latency and status counts per endpoint and method.
+    * Queries per request and the duration of each statement, from engine events.
+    * Redis command latency, reported by ``utils.pools.TimedConnection``.
+    * Password hashing latency, reported by ``utils.hashing.HashingPool``.
+
+    Set ``METRICS_ENABLED`` to False to skip collection altogether.
+    """
+
+    def __init__(self, app=None, db=None):
+        self.enabled = False
+        self.requests = Counter(
+            'http_requests_total', 'Requests served.', ('endpoint', 'method', 'status'))
+        self.request_duration = Histogram(
+            'http_request_duration_seconds', 'Time taken to serve a request.',
+            ('endpoint', 'method'))
+        self.request_queries = Histogram(
+            'db_queries_per_request', 'SQL statements executed while serving a request.',
+            ('endpoint', 'method'), buckets=COUNT_BUCKETS)
+        self.query_duration = Histogram(
+            'db_query_duration_seconds', 'Time taken to execute a SQL statement.',
+            ('endpoint',))
+        self.redis_duration = Histogram(
+            'redis_command_duration_seconds', 'Time spent waiting for a Redis reply.',
+            ('endpoint',))
+        self.hash_duration = Histogram(
+            'password_hash_duration_seconds', 'Time taken to hash or verify a password.',
+            ('operation',))
+        if app is not None:
+            self.init_app(app, db)
+
+    @property
+    def collectors(self):
+        return (self.requests, self.request_duration, self.request_queries,
+                self.query_duration, self.redis_duration, self.hash_duration)
+
+    def init_app(self, app, db):
+        self.enabled = app.config.get('METRICS_ENABLED', True)
+        if not self.enabled:
+            return
+        for bind in [None] + list(app.config.get('SQLALCHEMY_BINDS') or {}):
+            engine = db.get_engine(app, bind=bind)
+            event.listen(engine, 'before_cursor_execute', self._before_cursor_execute)
+            event.listen(engine, 'after_cursor_execute', self._after_cursor_execute)
+        app.before_request(self._before_request)
+        app.after_request(self._after_request)
+        app.teardown_request(self._teardown_request)
+
+    def observe_redis(self, seconds: float):
+        if self.enabled:
+            self.redis_duration.observe(seconds, current_endpoint())
+
+    def observe_hash(self, operation: str, seconds: float):
+        if self.enabled:
+            self.hash_duration.observe(seconds, operation)
+
+    def clear(self):
+        for collector in self.collectors:
+            collector.clear()
+
+    def snapshot(self) -> dict:
+        return {collector.name: collector.snapshot() for collector in self.collectors}
+
+    def render(self, snapshots: list = None) -> str:
+        # Render this process's metrics, or the sum of snapshots taken by several.
+        lines = []
+        for collector in self.collectors:
+            values = None
+            if snapshots is not None:
+                values = collector.merge([snapshot.get(collector.name, []) for snapshot in snapshots])
+            lines.append('# HELP {} {}'.format(collector.name, collector.documentation))
+            lines.append('# TYPE {} {}'.format(collector.name, collector.kind))
+            for name, labels, value in collector.samples(values):
+                lines.append('{}{} {}'.format(name, labels, repr(float(value))))
+        return '\n'.join(lines) + '\n'
+
+    def _before_request(self):
+        g._metrics_start = time.perf_counter()
+        g._metrics_queries = 0
+
+    def _after_request(self, response):
+        g._metrics_status = response.status_code
+        return response
+
+    def _teardown_request(self, exc):
+        # Runs after the session has been saved, so its Redis calls are included.
+        start = g.pop('_metrics_start', None)
+        if start is None:
+            return
+        endpoint, method = current_endpoint(), request.method
+        status = g.pop('_metrics_status', 500)
+        self.requests.inc(endpoint, method, status)
+        self.request_duration.observe(time.perf_counter() - start, endpoint, method)
+        self.request_queries.observe(g.pop('_metrics_queries', 0), endpoint, method)
+
+    def _before_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('metrics_query_start', []).append(time.perf_counter())
+
+    def _after_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        seconds = time.perf_counter() - conn.info['metrics_query_start'].pop()
+        self.query_duration.observe(seconds, current_endpoint())
+        if has_request_context() and '_metrics_queries' in g:
+            g._metrics_queries += 1
+
+
+def current_endpoint() -> str:
+    # Endpoint label for work done in this context, requests matching no route
+      # and work done outside of requests share a label each.
+    if not has_request_context():
+        return 'none'
+    return request.endpoint or 'unmatched'
+
+
+metrics = Metrics()
@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+"""Keyset (cursor) pagination for queries ordered by ``(created_at, id)``.
+
+Rather than an OFFSET, each page continues after the last row of the previous
+page, so the cost of fetching a page does not grow with the size of the listing.
+Cursors are opaque to clients and only encode the position of that last row.
+"""
+
+import json
+import base64
+import binascii
+
+from datetime import datetime
+from flask import current_app, request
+from sqlalchemy import tuple_
+
+
+class InvalidPage(ValueError):
+    """Raised when the page size or cursor provided by a client cannot be used."""
+
+
+def encode_cursor(row) -> str:
+    position = json.dumps([row.created_at.isoformat(), row.id])
+    return base64.urlsafe_b64encode(position.encode('utf-8')).decode('utf-8').rstrip('=')
+
+
+def decode_cursor(cursor: str) -> tuple:
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        created_at, id = json.loads(base64.urlsafe_b64decode(padded.encode('utf-8')))
+        return datetime.fromisoformat(created_at), int(id)
+    except (binascii.Error, TypeError, ValueError):
+        raise InvalidPage('Invalid cursor was provided.')
+
+
+def page_arguments() -> tuple:
+    # Return the (after, limit) position requested through the query string.
+    max_size = current_app.config.get('MAX_PAGE_SIZE', 200)
+    try:
+        limit = int(request.args.get('limit', current_app.config.get('PAGE_SIZE', 50)))
+    except ValueError:
+        raise InvalidPage('Page limit must be a number.')
+    if limit < 1 or limit > max_size:
+        raise InvalidPage('Page limit must be between 1 and {}.'.format(max_size))
+    cursor = request.args.get('cursor')
+    after = decode_cursor(cursor) if cursor else None
+    return after, limit
+
+
+def paginate(query, model, after: tuple = None, limit: int = 50) -> tuple:
+    # Return a page of at most limit rows following after, and the cursor of the next page.
+    if after is not None:
+        query = query.filter(tuple_(model.created_at, model.id) > tuple_(*after))
+    rows = query.order_by(model.created_at, model.id).limit(limit + 1).all()
+    next_cursor = encode_cursor(rows[limit - 1]) if len(rows) > limit else None
+    return rows[:limit], next_cursor
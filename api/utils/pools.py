@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+"""Process-wide connection pools for Postgres and Redis with usage statistics.
+
+Both pools record how long callers wait to check out a connection, so that an
+undersized pool shows up as wait time instead of intermittent timeouts.
+"""
+
+import time
+import threading
+
+from redis import Redis, BlockingConnectionPool
+from redis.connection import Connection
+from sqlalchemy.pool import QueuePool
+
+from utils.metrics import metrics
+
+
+class WaitStats(object):
+    """Thread-safe count, total and maximum of connection checkout waits."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, seconds: float):
+        with self._lock:
+            self.count += 1
+            self.total += seconds
+            self.max = max(self.max, seconds)
+
+    def as_dict(self) -> dict:
+        with self._lock:
+            return {
+                'checkouts': self.count,
+                'wait_seconds_total': round(self.total, 6),
+                'wait_seconds_max': round(self.max, 6),
+            }
+
+
+class TimedQueuePool(QueuePool):
+    """SQLAlchemy QueuePool that records checkout wait time."""
+
+    def __init__(self, *args, **kwargs):
+        super(TimedQueuePool, self).__init__(*args, **kwargs)
+        self.wait_stats = WaitStats()
+
+    def recreate(self):
+        pool = super(TimedQueuePool, self).recreate()
+        pool.wait_stats = self.wait_stats
+        return pool
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            return super(TimedQueuePool, self)._do_get()
+        finally:
+            self.wait_stats.record(time.perf_counter() - start)
+
+    def stats(self) -> dict:
+        stats = {
+            'size': self.size(),
+            'checked_out': self.checkedout(),
+            'overflow': self.overflow(),
+            'max_overflow': self._max_overflow,
+        }
+        stats.update(self.wait_stats.as_dict())
+        return stats
+
+
+class TimedConnection(Connection):
+    """Redis connection that reports the time spent waiting for each reply."""
+
+    def read_response(self):
+        start = time.perf_counter()
+        try:
+            return super(TimedConnection, self).read_response()
+        finally:
+            metrics.observe_redis(time.perf_counter() - start)
+
+
+class TimedBlockingConnectionPool(BlockingConnectionPool):
+    """Redis pool that blocks when exhausted and records checkout wait time."""
+
+    def __init__(self, *args, **kwargs):
+        self.wait_stats = WaitStats()
+        super(TimedBlockingConnectionPool, self).__init__(*args, **kwargs)
+
+    def get_connection(self, command_name, *keys, **options):
+        start = time.perf_counter()
+        try:
+            return super(TimedBlockingConnectionPool, self).get_connection(
+                command_name, *keys, **options)
+        finally:
+            self.wait_stats.record(time.perf_counter() - start)
+
+    def stats(self) -> dict:
+        stats = {
+            'size': len(self._connections),
+            'checked_out': self.max_connections - self.pool.qsize(),
+            'max_connections': self.max_connections,
+        }
+        stats.update(self.wait_stats.as_dict())
+        return stats
+
+
+_redis = None
+_redis_lock = threading.Lock()
+
+
+def shared_redis(host, port, max_connections: int, timeout: int) -> Redis:
+    # Return the Redis client shared by the whole process. The pool resets itself
+      # after a fork, so a client created before workers are forked is safe to use.
+    global _redis
+    with _redis_lock:
+        if _redis is None:
+            pool = TimedBlockingConnectionPool(host=host, port=port,
+                                               max_connections=max_connections,
+                                               timeout=timeout,
+                                               connection_class=TimedConnection)
+            _redis = Redis(connection_pool=pool)
+        return _redis
+
+
+def pool_stats(engine, redis: Redis) -> dict:
+    stats = {'database': None, 'redis': None}
+    if isinstance(engine.pool, TimedQueuePool):
+        stats['database'] = engine.pool.stats()
+    if isinstance(redis.connection_pool, TimedBlockingConnectionPool):
+        stats['redis'] = redis.connection_pool.stats()
+    return stats
@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+"""Development and testing aids for finding slow and repeated SQL statements.
+
+When ``QUERY_INSPECTOR_ENABLED`` is set, statements slower than
+``SLOW_QUERY_THRESHOLD_MS`` are logged with their parameters and the view that
+issued them, and a request executing the same statement ``N_PLUS_ONE_THRESHOLD``
+or more times is logged as a likely N+1, eg. a loop over a ``lazy='dynamic'``
+relationship. ``count_queries`` and ``query_budget`` let tests put a ceiling on
+the statements an endpoint may execute.
+"""
+
+import time
+import logging
+
+from collections import Counter
+from contextlib import contextmanager
+from flask import g, has_request_context, request
+from sqlalchemy import event
+
+from models import db
+
+logger = logging.getLogger(__name__)
+
+
+class QueryBudgetExceeded(AssertionError):
+    """Raised when a block executes more statements than its budget allows."""
+
+
+class QueryInspector(object):
+    """Log slow statements and statements repeated within a single request."""
+
+    def __init__(self, app=None):
+        self.enabled = False
+        self.slow_threshold = 0.0
+        self.repeat_threshold = 0
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.enabled = app.config.get('QUERY_INSPECTOR_ENABLED', False)
+        if not self.enabled:
+            return
+        self.slow_threshold = int(app.config.get('SLOW_QUERY_THRESHOLD_MS', 100)) / 1000
+        self.repeat_threshold = int(app.config.get('N_PLUS_ONE_THRESHOLD', 3))
+        for bind in [None] + list(app.config.get('SQLALCHEMY_BINDS') or {}):
+            engine = db.get_engine(app, bind=bind)
+            event.listen(engine, 'before_cursor_execute', self._before_cursor_execute)
+            event.listen(engine, 'after_cursor_execute', self._after_cursor_execute)
+        app.before_request(self._before_request)
+        app.teardown_request(self._teardown_request)
+
+    def _before_request(self):
+        g._query_counts = Counter()
+
+    def _teardown_request(self, exc):
+        counts = g.pop('_query_counts', None)
+        if not counts:
+            return
+        for statement, count in counts.items():
+            if count >= self.repeat_threshold:
+                logger.warning('Possible N+1 in %s %s: statement executed %d times: %s',
+                               request.method, request.endpoint, count, statement)
+
+    def _before_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('query_inspector_start', []).append(time.perf_counter())
+
+    def _after_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        seconds = time.perf_counter() - conn.info['query_inspector_start'].pop()
+        in_request = has_request_context()
+        if seconds >= self.slow_threshold:
+            logger.warning('Slow query (%.1fms) in %s: %s; parameters: %r', seconds * 1000,
+                           request.endpoint if in_request else 'no request',
+                           statement, parameters)
+        if in_request and '_query_counts' in g:
+            g._query_counts[statement] += 1
+
+
+@contextmanager
+def count_queries(engine=None):
+    """Collect the SQL statements executed while the block runs."""
+    if engine is None:
+        engine = db.engine
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+    try:
+        yield statements
+    finally:
+        event.remove(engine, 'before_cursor_execute', before_cursor_execute)
+
+
+@contextmanager
+def query_budget(limit: int, engine=None):
+    """Raise QueryBudgetExceeded if the block executes more than ``limit`` statements."""
+    with count_queries(engine) as statements:
+        yield statements
+    if len(statements) > limit:
+        raise QueryBudgetExceeded('{} statements executed, budget is {}:\n{}'.format(
+            len(statements), limit, '\n'.join(statements)))
+
+
+query_inspector = QueryInspector()
@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+"""Token bucket rate limiting backed by Redis.
+
+Limits are configured per route in ``settings.routes.RATE_LIMITS`` as a bucket
+capacity and the period over which an empty bucket refills, for each key a
+request is counted against (the client IP and the submitted username). A
+request is admitted only when every bucket it draws from has a token, so it is
+rejected with a 429 before the view queries the database or hashes a password.
+"""
+
+import math
+import time
+
+from functools import wraps
+from flask import jsonify, request
+from redis.exceptions import RedisError
+
+from settings import routes
+
+# Refill and take a token from every bucket in KEYS, or from none of them.
+  # ARGV holds the current time in milliseconds followed by a capacity and refill
+  # rate (tokens per millisecond) for each key. Returns the milliseconds to wait
+  # before retrying, 0 when the request is admitted.
+TOKEN_BUCKET_SCRIPT = """
+local now = tonumber(ARGV[1])
+local wait = 0
+local levels = {}
+for i, key in ipairs(KEYS) do
+    local capacity = tonumber(ARGV[i * 2])
+    local rate = tonumber(ARGV[i * 2 + 1])
+    local bucket = redis.call('HMGET', key, 'tokens', 'ts')
+    local tokens = tonumber(bucket[1]) or capacity
+    local ts = tonumber(bucket[2]) or now
+    tokens = math.min(capacity, tokens + math.max(0, now - ts) * rate)
+    if tokens < 1 then
+        wait = math.max(wait, math.ceil((1 - tokens) / rate))
+    end
+    levels[i] = tokens
+end
+for i, key in ipairs(KEYS) do
+    local capacity = tonumber(ARGV[i * 2])
+    local rate = tonumber(ARGV[i * 2 + 1])
+    local tokens = levels[i]
+    if wait == 0 then
+        tokens = tokens - 1
+    end
+    redis.call('HMSET', key, 'tokens', tokens, 'ts', now)
+    redis.call('PEXPIRE', key, math.ceil((capacity - tokens) / rate) + 1000)
+end
+return wait
+"""
+
+
+class RateLimited(Exception):
+    """Raised when a request exceeds one of its route's rate limits."""
+
+    def __init__(self, retry_after: float):
+        super(RateLimited, self).__init__('Rate limit exceeded.')
+        self.retry_after = retry_after
+
+
+def request_ip():
+    return request.remote_addr
+
+
+def request_username():
+    data = request.get_json(silent=True)
+    if isinstance(data, dict) and data.get('username') is not None:
+        return str(data['username'])
+    return None
+
+
+class RateLimiter(object):
+    """Admit requests against token buckets stored in Redis.
+
+    * ``RATE_LIMIT_ENABLED`` turns limiting on, limits are read from
+        ``settings.routes.RATE_LIMITS``.
+    * Requests are admitted when Redis can not be reached, so an outage of the
+        limiter never takes the routes it protects down with it.
+    """
+
+    key_prefix = 'rate_limit:'
+    key_funcs = {
+        'ip': request_ip,
+        'username': request_username,
+    }
+
+    def __init__(self, app=None):
+        self.enabled = False
+        self.redis = None
+        self.limits = {}
+        self._script = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.enabled = app.config.get('RATE_LIMIT_ENABLED', True)
+        self.redis = app.config['SESSION_REDIS']
+        self.limits = dict(routes.RATE_LIMITS)
+        self._script = self.redis.register_script(TOKEN_BUCKET_SCRIPT)
+        app.register_error_handler(RateLimited, self._limited)
+
+    def check(self, rule: str):
+        # Raise RateLimited if the current request to rule exceeds any of its limits.
+        if not self.enabled or rule not in self.limits:
+            return
+        keys, args = [], [int(time.time() * 1000)]
+        for kind, (capacity, period) in self.limits[rule].items():
+            value = self.key_funcs[kind]()
+            if value is None:
+                continue
+            keys.append('{}{}:{}:{}'.format(self.key_prefix, rule, kind, value))
+            args.extend([capacity, capacity / (period * 1000)])
+        if not keys:
+            return
+        try:
+            wait = self._script(keys=keys, args=args)
+        except RedisError:
+            return
+        if wait:
+            raise RateLimited(wait / 1000)
+
+    def reset(self):
+        # Remove every bucket, eg. after changing limits.
+        for key in self.redis.scan_iter(self.key_prefix + '*'):
+            self.redis.delete(key)
+
+    def _limited(self, error):
+        resp = jsonify({'errors': 'Too many requests, please try again later.'})
+        resp.headers['Retry-After'] = str(max(1, math.ceil(error.retry_after)))
+        return resp, 429
+
+
+rate_limiter = RateLimiter()
+
+
+def rate_limit(f):
+    """Apply the limits configured for the matched route before calling the view."""
+    @wraps(f)
+    def decorated(*args, **kwargs):
+        rate_limiter.check(request.url_rule.rule)
+        return f(*args, **kwargs)
+    return decorated
@@ -0,0 +1,182 @@
+# -*- coding: utf-8 -*-
+"""Routing of read-only queries to Postgres read replicas.
+
+Replicas are configured with ``REPLICA_URIS`` and registered as the
+``replica_<n>`` binds. Queries issued by GET and HEAD requests, and user lookups
+made by ``login_required`` on any request, are sent to a replica when:
+
+* the request has not written anything yet, writes and everything read after
+    them use the primary,
+* the user has not written within the last ``REPLICA_STICKY_SECONDS``, from any
+    of their sessions, so they read their own writes while replicas catch up. This
+    also keeps data versions, user cache generations and cached responses, which
+    follow commits on the primary, from being paired with older replica rows. The
+    marker is a Redis key per user, and the primary is used when it can not be read,
+* the replica was last seen less than ``REPLICA_MAX_LAG`` seconds behind the
+    primary. Lag is checked at most every ``REPLICA_LAG_CHECK_INTERVAL`` seconds.
+
+The primary serves everything else, and all queries when no replica is healthy.
+"""
+
+import time
+import random
+import logging
+import threading
+
+from contextlib import contextmanager
+from flask import g, has_request_context, request, session
+from flask_sqlalchemy import SQLAlchemy, SignallingSession
+from sqlalchemy import orm, text
+from sqlalchemy.sql.dml import UpdateBase
+from redis.exceptions import RedisError
+
+logger = logging.getLogger(__name__)
+
+READ_METHODS = ('GET', 'HEAD')
+
+# Seconds the server is behind its primary, 0 for a primary or a caught up standby.
+LAG_QUERY = text("""
+    SELECT CASE WHEN NOT pg_is_in_recovery() THEN 0
+                WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+                ELSE COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0)
+           END
+""")
+
+
+class ReplicaRouter(object):
+    """Choose the bind serving each query of a request."""
+
+    bind_prefix = 'replica_'
+    key_prefix = 'primary_reads:'
+
+    def __init__(self, app=None):
+        self.binds = []
+        self.redis = None
+        self.max_lag = 0.0
+        self.check_interval = 0.0
+        self.sticky_seconds = 0
+        self._health = {}
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.binds = sorted(bind for bind in (app.config.get('SQLALCHEMY_BINDS') or {})
+                            if bind.startswith(self.bind_prefix))
+        self.max_lag = float(app.config.get('REPLICA_MAX_LAG', 1.0))
+        self.check_interval = float(app.config.get('REPLICA_LAG_CHECK_INTERVAL', 5))
+        self.sticky_seconds = int(app.config.get('REPLICA_STICKY_SECONDS', 5))
+        self.redis = app.config['SESSION_REDIS']
+        with self._lock:
+            self._health.clear()
+        app.before_request(self._begin_request)
+
+    def _begin_request(self):
+        # Routing decisions are made per request.
+        for name in ('_db_primary', '_db_replica', '_db_replica_reads', '_db_user_wrote'):
+            g.pop(name, None)
+
+    def bind_for(self, db_session, mapper=None, clause=None):
+        # Return the replica bind to use, or None for the primary.
+        if not self.binds or not has_request_context():
+            return None
+        if db_session._flushing or isinstance(clause, UpdateBase):
+            self.record_write()
+            return None
+        if g.get('_db_primary'):
+            return None
+        if request.method not in READ_METHODS and not g.get('_db_replica_reads'):
+            return None
+        if self.user_wrote():
+            return None
+        if '_db_replica' not in g:
+            healthy = [bind for bind in self.binds if self.is_healthy(db_session, bind)]
+            g._db_replica = random.choice(healthy) if healthy else None
+        return g._db_replica
+
+    def record_write(self):
+        # Keep the rest of this request and the user's next requests on the primary.
+        g._db_primary = True
+        username = session.get('username')
+        if not self.sticky_seconds or username is None or g.get('_db_user_wrote'):
+            return
+        g._db_user_wrote = True
+        try:
+            self.redis.set(self.key_prefix + username, 1, ex=self.sticky_seconds)
+        except RedisError:
+            logger.warning('Unable to record a write by %s', username, exc_info=True)
+
+    def user_wrote(self) -> bool:
+        # Whether the session's user wrote recently, read once per request.
+        username = session.get('username')
+        if not self.sticky_seconds or username is None:
+            return False
+        if '_db_user_wrote' not in g:
+            try:
+                g._db_user_wrote = bool(self.redis.exists(self.key_prefix + username))
+            except RedisError:
+                logger.warning('Unable to check for writes by %s', username, exc_info=True)
+                g._db_user_wrote = True
+        return g._db_user_wrote
+
+    def is_healthy(self, db_session, bind: str) -> bool:
+        now = time.monotonic()
+        with self._lock:
+            checked_at, healthy = self._health.get(bind, (None, False))
+        if checked_at is not None and now - checked_at < self.check_interval:
+            return healthy
+        healthy = self.lag(db_session.db.get_engine(db_session.app, bind=bind)) <= self.max_lag
+        with self._lock:
+            self._health[bind] = (now, healthy)
+        return healthy
+
+    def lag(self, engine) -> float:
+        # Return replication lag in seconds, infinite when the replica can not be reached.
+        try:
+            with engine.connect() as conn:
+                return float(conn.execute(LAG_QUERY).scalar())
+        except Exception:
+            logger.warning('Unable to check replication lag of %s', engine.url, exc_info=True)
+            return float('inf')
+
+    def health(self) -> dict:
+        with self._lock:
+            return {bind: healthy for bind, (_, healthy) in self._health.items()}
+
+
+replica_router = ReplicaRouter()
+
+
+@contextmanager
+def replica_reads():
+    """Allow reads in the block to use a replica whatever the request method."""
+    if not has_request_context():
+        yield
+        return
+    previous = g.get('_db_replica_reads', False)
+    g._db_replica_reads = True
+    try:
+        yield
+    finally:
+        g._db_replica_reads = previous
+
+
+class RoutingSession(SignallingSession):
+    """Session sending reads to the bind chosen by ``replica_router``."""
+
+    def __init__(self, db, **options):
+        self.db = db
+        super(RoutingSession, self).__init__(db, **options)
+
+    def get_bind(self, mapper=None, clause=None):
+        bind = replica_router.bind_for(self, mapper, clause)
+        if bind is not None:
+            return self.db.get_engine(self.app, bind=bind)
+        return super(RoutingSession, self).get_bind(mapper, clause)
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    """Flask-SQLAlchemy extension whose sessions route reads to replicas."""
+
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
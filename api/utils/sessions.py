@@ -0,0 +1,349 @@
+# -*- coding: utf-8 -*-
+"""Session interfaces replacing the ones installed by Flask-Session.
+
+``SESSION_TYPE = 'redis'`` keeps sessions in Redis as Flask-Session does, but a
+session is written back only when it has been modified. Loading a session reads
+its remaining TTL in the same round trip, and the expiry of an unmodified session
+is extended with EXPIRE at most once every ``SESSION_REFRESH_INTERVAL`` seconds
+rather than by rewriting the session on every response.
+
+With ``SESSION_TYPE = 'token'`` the session is kept in the session cookie as a JWT
+signed by ``utils.tokens.token_signer`` like account tokens, instead of in Redis
+under a session id. Opening a session is a signature check,
+so authenticated requests make no Redis calls in the common case.
+
+Tokens are reissued every ``SESSION_TOKEN_TTL`` seconds. Logging out, or logging
+in as another user, adds the session id to a denylist held in a Redis sorted set.
+The denylist is consulted only for requests that may write and for tokens due to
+be reissued, so a revoked token is refused by the next write request and by every
+request after at most ``SESSION_TOKEN_TTL`` seconds.
+"""
+
+import time
+import uuid
+import logging
+import jwt
+
+from datetime import datetime
+from flask import current_app
+from flask.sessions import SessionInterface, SessionMixin
+from flask_session.sessions import RedisSession, RedisSessionInterface
+from itsdangerous import BadSignature
+from redis.exceptions import RedisError
+from werkzeug.datastructures import CallbackDict
+
+from utils.replicas import READ_METHODS
+from utils.tokens import token_signer
+
+logger = logging.getLogger(__name__)
+
+
+class LazyRedisSession(RedisSession):
+    """Redis session, ``ttl`` holds the seconds its key had left when it was loaded."""
+
+    ttl = None
+
+
+class LazyRedisSessionInterface(RedisSessionInterface):
+    """Redis sessions saved only when modified, see the module docstring."""
+
+    session_class = LazyRedisSession
+
+    def __init__(self, app=None):
+        self.redis = None
+        self.key_prefix = 'session:'
+        self.use_signer = False
+        self.permanent = True
+        self.refresh_interval = 0
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        # Replace the session interface installed by Flask-Session for the redis type.
+        if app.config.get('SESSION_TYPE') != 'redis':
+            return
+        self.redis = app.config['SESSION_REDIS']
+        self.key_prefix = app.config.get('SESSION_KEY_PREFIX', 'session:')
+        self.use_signer = app.config.get('SESSION_USE_SIGNER', False)
+        self.permanent = app.config.get('SESSION_PERMANENT', True)
+        self.refresh_interval = int(app.config.get('SESSION_REFRESH_INTERVAL', 300))
+        app.session_interface = self
+
+    def open_session(self, app, request):
+        sid = request.cookies.get(app.session_cookie_name)
+        if not sid:
+            return self.session_class(sid=self._generate_sid(), permanent=self.permanent)
+        if self.use_signer:
+            signer = self._get_signer(app)
+            if signer is None:
+                return None
+            try:
+                sid = signer.unsign(sid).decode()
+            except BadSignature:
+                return self.session_class(sid=self._generate_sid(), permanent=self.permanent)
+        pipe = self.redis.pipeline(transaction=False)
+        pipe.get(self.key_prefix + sid)
+        pipe.ttl(self.key_prefix + sid)
+        val, ttl = pipe.execute()
+        if val is None:
+            return self.session_class(sid=sid, permanent=self.permanent)
+        try:
+            session = self.session_class(self.serializer.loads(val), sid=sid)
+        except Exception:
+            return self.session_class(sid=sid, permanent=self.permanent)
+        session.ttl = ttl
+        return session
+
+    def save_session(self, app, session, response):
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+        key = self.key_prefix + session.sid
+        if not session:
+            if session.modified:
+                self.redis.delete(key)
+                response.delete_cookie(app.session_cookie_name, domain=domain, path=path)
+            return
+        lifetime = int(app.permanent_session_lifetime.total_seconds())
+        pipe = self.redis.pipeline(transaction=False)
+        if session.modified:
+            pipe.setex(name=key, value=self.serializer.dumps(dict(session)), time=lifetime)
+        elif session.ttl is not None and 0 <= session.ttl <= lifetime - self.refresh_interval:
+            pipe.expire(key, lifetime)
+        else:
+            return
+        if 'username' in session:
+            session_index.touch(session['username'], session.sid, pipe)
+        pipe.execute()
+        if self.use_signer:
+            session_id = self._get_signer(app).sign(session.sid.encode('utf-8')).decode('utf-8')
+        else:
+            session_id = session.sid
+        response.set_cookie(app.session_cookie_name, session_id,
+                            expires=self.get_expiration_time(app, session),
+                            httponly=self.get_cookie_httponly(app),
+                            domain=domain, path=path,
+                            secure=self.get_cookie_secure(app))
+
+    def revoke(self, app, sids: list):
+        self.redis.delete(*[self.key_prefix + sid for sid in sids])
+
+    def exists(self, sids: list) -> list:
+        pipe = self.redis.pipeline(transaction=False)
+        for sid in sids:
+            pipe.exists(self.key_prefix + sid)
+        return [bool(found) for found in pipe.execute()]
+
+
+class TokenSession(CallbackDict, SessionMixin):
+    """Session read from a token, or a new session when ``sid`` is None."""
+
+    def __init__(self, initial=None, sid=None, stale=False):
+        def on_update(self):
+            self.modified = True
+            if self.get('username') != self.identity:
+                # A session changing user gets a new id, the old id is revoked on save.
+                if self.issued:
+                    self.retired.append(self.sid)
+                self.sid, self.issued = uuid.uuid4().hex, False
+                self.identity = self.get('username')
+        CallbackDict.__init__(self, initial, on_update)
+        self.sid = sid or uuid.uuid4().hex
+        self.issued = sid is not None
+        self.retired = []
+        # Reissue the token even when the session is not modified.
+        self.stale = stale
+        self.identity = self.get('username')
+        self.modified = False
+
+
+class SessionDenylist(object):
+    """Ids of revoked sessions, scored by the time their last token expires."""
+
+    key = 'session_denylist'
+
+    def __init__(self, redis):
+        self.redis = redis
+
+    def revoke(self, sids: list, until: float):
+        # Add sids and drop entries whose tokens have all expired.
+        pipe = self.redis.pipeline()
+        pipe.zremrangebyscore(self.key, '-inf', time.time())
+        pipe.zadd(self.key, {sid: until for sid in sids})
+        pipe.execute()
+
+    def is_revoked(self, sid: str) -> bool:
+        return self.revoked([sid])[0]
+
+    def revoked(self, sids: list) -> list:
+        pipe = self.redis.pipeline(transaction=False)
+        for sid in sids:
+            pipe.zscore(self.key, sid)
+        now = time.time()
+        return [score is not None and score > now for score in pipe.execute()]
+
+
+class TokenSessionInterface(SessionInterface):
+    """Store sessions in signed tokens, see the module docstring."""
+
+    session_class = TokenSession
+
+    def __init__(self, app=None):
+        self.ttl = 0
+        self.permanent = True
+        self.denylist = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        # Replace the session interface installed by Flask-Session for the token type.
+        if app.config.get('SESSION_TYPE') != 'token':
+            return
+        if not token_signer.enabled:
+            raise ValueError('Token sessions require PRIVATE_KEY and PUBLIC_KEY to be set.')
+        self.ttl = int(app.config.get('SESSION_TOKEN_TTL', 300))
+        self.permanent = app.config.get('SESSION_PERMANENT', True)
+        self.denylist = SessionDenylist(app.config['SESSION_REDIS'])
+        app.session_interface = self
+
+    def open_session(self, app, request):
+        token = request.cookies.get(app.session_cookie_name)
+        if not token:
+            return self.session_class()
+        try:
+            claims = token_signer.decode(token)
+            sid, issued_at, data = claims['jti'], claims['iat'], dict(claims['data'])
+        except (jwt.InvalidTokenError, KeyError, TypeError, ValueError):
+            return self._rejected()
+        stale = time.time() - issued_at >= self.ttl
+        if stale or request.method not in READ_METHODS:
+            try:
+                if self.denylist.is_revoked(sid):
+                    return self._rejected()
+            except RedisError:
+                # Keep the cookie, the next request checks again.
+                logger.warning('Unable to check the session denylist', exc_info=True)
+                return self.session_class()
+        return self.session_class(data, sid=sid, stale=stale)
+
+    def save_session(self, app, session, response):
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+        if session.retired:
+            self.revoke(app, session.retired)
+        if not session:
+            if session.modified:
+                response.delete_cookie(app.session_cookie_name, domain=domain, path=path)
+            return
+        if not session.modified and not session.stale:
+            return
+        token, expires = self.issue(app, session)
+        if 'username' in session:
+            session_index.touch(session['username'], session.sid)
+        response.set_cookie(app.session_cookie_name, token,
+                            expires=datetime.utcfromtimestamp(expires) if self.permanent else None,
+                            httponly=self.get_cookie_httponly(app),
+                            domain=domain, path=path,
+                            secure=self.get_cookie_secure(app),
+                            samesite=self.get_cookie_samesite(app))
+
+    def issue(self, app, session):
+        # Return a new token for session and the time it expires.
+        now = int(time.time())
+        expires = now + int(app.permanent_session_lifetime.total_seconds())
+        payload = {'jti': session.sid, 'iat': now, 'exp': expires, 'data': dict(session)}
+        return token_signer.encode(payload), expires
+
+    def revoke(self, app, sids: list):
+        # Refuse every token issued for sids until the last of them has expired.
+        until = time.time() + app.permanent_session_lifetime.total_seconds()
+        try:
+            self.denylist.revoke(sids, until)
+        except RedisError:
+            logger.error('Unable to revoke sessions %s', sids, exc_info=True)
+
+    def exists(self, sids: list) -> list:
+        return [not revoked for revoked in self.denylist.revoked(sids)]
+
+    def _rejected(self):
+        # Empty session for an invalid or revoked token, saving it removes the cookie.
+        session = self.session_class()
+        session.modified = True
+        return session
+
+
+class SessionIndex(object):
+    """Ids of each user's sessions, kept in a Redis sorted set scored by last use.
+
+    Sessions are added on login and removed on logout. A session's score is the
+    time it was last written or had its expiry extended, or in token mode the time
+    its token was last issued. Members not seen for longer than the session lifetime
+    have expired and are dropped whenever the index is read, as are members revoked
+    elsewhere, so listing and revoking a user's sessions never scans the keyspace.
+    """
+
+    key_prefix = 'user_sessions:'
+
+    def __init__(self, app=None):
+        self.redis = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.redis = app.config['SESSION_REDIS']
+
+    def add(self, username: str, sid: str):
+        # Prune first, the new session is not saved until the response is sent.
+        try:
+            self.sessions(username)
+            self.redis.zadd(self.key_prefix + username, {sid: time.time()})
+        except RedisError:
+            logger.warning('Unable to index session of %s', username, exc_info=True)
+
+    def touch(self, username: str, sid: str, pipe=None):
+        # Record that an indexed session is still in use, with pipe the command is
+          # only queued on it.
+        if pipe is not None:
+            pipe.zadd(self.key_prefix + username, {sid: time.time()}, xx=True)
+            return
+        try:
+            self.redis.zadd(self.key_prefix + username, {sid: time.time()}, xx=True)
+        except RedisError:
+            logger.warning('Unable to update session of %s', username, exc_info=True)
+
+    def discard(self, username: str, sid: str):
+        try:
+            self.redis.zrem(self.key_prefix + username, sid)
+        except RedisError:
+            logger.warning('Unable to remove session of %s', username, exc_info=True)
+
+    def sessions(self, username: str) -> list:
+        # Return (session id, last seen time) pairs of the user's live sessions.
+        key = self.key_prefix + username
+        expired = time.time() - current_app.permanent_session_lifetime.total_seconds()
+        pipe = self.redis.pipeline()
+        pipe.zremrangebyscore(key, '-inf', expired)
+        pipe.zrange(key, 0, -1, withscores=True)
+        members = pipe.execute()[1]
+        if not members:
+            return []
+        sids = [sid.decode('utf-8') for sid, _ in members]
+        live = current_app.session_interface.exists(sids)
+        stale = [sid for sid, alive in zip(sids, live) if not alive]
+        if stale:
+            self.redis.zrem(key, *stale)
+        return [(sid, seen) for sid, (_, seen), alive in zip(sids, members, live) if alive]
+
+    def revoke_all(self, username: str, keep: str = None) -> int:
+        # Revoke every session of the user except keep, return the number revoked.
+        key = self.key_prefix + username
+        sids = [sid.decode('utf-8') for sid in self.redis.zrange(key, 0, -1)]
+        revoked = [sid for sid in sids if sid != keep]
+        if revoked:
+            current_app.session_interface.revoke(current_app, revoked)
+            self.redis.zrem(key, *revoked)
+        return len(revoked)
+
+
+redis_sessions = LazyRedisSessionInterface()
+token_sessions = TokenSessionInterface()
+session_index = SessionIndex()
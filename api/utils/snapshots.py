@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+"""Statistics of every web worker process, shared through Redis.
+
+Metrics and pool and cache statistics are collected in memory by each worker, so
+the status endpoints would otherwise only report on the worker that served them.
+Each worker publishes a JSON snapshot of its statistics to a Redis hash at most
+once every ``STATUS_PUBLISH_INTERVAL`` seconds, from the teardown of a request,
+and the status endpoints merge the snapshots of all workers.
+
+A worker that serves no requests stops publishing. Its snapshot is left out of
+reports on current state, such as pool usage, after ``STATUS_WORKER_TIMEOUT``
+seconds, but counters such as metrics keep the totals of stopped workers for
+``STATUS_SNAPSHOT_RETENTION`` seconds so aggregated counters do not go backwards.
+"""
+
+import os
+import json
+import time
+import uuid
+import socket
+import logging
+import threading
+
+from redis.exceptions import RedisError
+
+logger = logging.getLogger(__name__)
+
+
+def merge_stats(stats: list) -> dict:
+    # Sum the numbers in per-worker stats dicts, taking the largest of *_max values.
+    merged = {}
+    for worker_stats in stats:
+        for key, value in worker_stats.items():
+            current = merged.get(key)
+            if isinstance(value, dict):
+                merged[key] = merge_stats([current or {}, value])
+            elif isinstance(value, bool) or not isinstance(value, (int, float)):
+                merged.setdefault(key, value)
+            elif current is None:
+                merged[key] = value
+            elif key.endswith('_max'):
+                merged[key] = max(current, value)
+            else:
+                merged[key] = current + value
+    return merged
+
+
+class WorkerSnapshots(object):
+    """Publish and collect per-worker statistics, see the module docstring."""
+
+    key_prefix = 'worker_snapshots:'
+
+    def __init__(self, app=None):
+        self._lock = threading.Lock()
+        self._sources = {}
+        self._worker = (None, None)
+        self._published = 0.0
+        self.redis = None
+        self.interval = 10
+        self.timeout = 60
+        self.retention = 86400
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.redis = app.config['SESSION_REDIS']
+        self.interval = int(app.config.get('STATUS_PUBLISH_INTERVAL', 10))
+        self.timeout = int(app.config.get('STATUS_WORKER_TIMEOUT', 60))
+        self.retention = int(app.config.get('STATUS_SNAPSHOT_RETENTION', 86400))
+        app.teardown_request(self._teardown_request)
+
+    @property
+    def worker_id(self) -> str:
+        # Unique per process, a forked worker gets an id of its own.
+        pid = os.getpid()
+        if self._worker[0] != pid:
+            self._worker = (pid, '{}:{}:{}'.format(socket.gethostname(), pid,
+                                                   uuid.uuid4().hex[:8]))
+        return self._worker[1]
+
+    def register(self, name: str, source):
+        """Publish the JSON serializable value returned by ``source()`` as name."""
+        self._sources[name] = source
+
+    def publish(self, force: bool = False):
+        now = time.time()
+        with self._lock:
+            if not force and now - self._published < self.interval:
+                return
+            self._published = now
+        worker_id = self.worker_id
+        pipe = self.redis.pipeline(transaction=False)
+        for name, source in self._sources.items():
+            snapshot = json.dumps({'at': now, 'stats': source()})
+            pipe.hset(self.key_prefix + name, worker_id, snapshot)
+        pipe.execute()
+
+    def collect(self, name: str, live: bool = False) -> list:
+        """Return the snapshots published as name by every worker, this one included.
+
+        With ``live`` only workers that published within ``STATUS_WORKER_TIMEOUT``
+        seconds are included. Without Redis only this worker's snapshot is returned.
+        """
+        key = self.key_prefix + name
+        try:
+            self.publish(force=True)
+            entries = self.redis.hgetall(key)
+        except RedisError:
+            logger.warning('Unable to collect %s from other workers', name, exc_info=True)
+            return [self._sources[name]()]
+        now = time.time()
+        snapshots, expired = [], []
+        for worker_id, entry in entries.items():
+            entry = json.loads(entry)
+            if entry['at'] < now - self.retention:
+                expired.append(worker_id)
+            elif not live or entry['at'] >= now - self.timeout:
+                snapshots.append(entry['stats'])
+        if expired:
+            try:
+                self.redis.hdel(key, *expired)
+            except RedisError:
+                pass
+        return snapshots
+
+    def clear(self):
+        # Remove the snapshots of every worker.
+        if self._sources:
+            self.redis.delete(*[self.key_prefix + name for name in self._sources])
+
+    def _teardown_request(self, exc):
+        try:
+            self.publish()
+        except RedisError:
+            logger.warning('Unable to publish worker statistics', exc_info=True)
+
+
+worker_snapshots = WorkerSnapshots()
@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+"""Incremental parsing of NDJSON and CSV request bodies.
+
+Records are read line by line from the request stream so that a large upload is
+never held in memory. Each record is yielded with the error that prevented it
+from being parsed, if any, so callers can report on every row.
+"""
+
+import csv
+import json
+
+from itertools import islice
+
+NDJSON_TYPES = ('application/x-ndjson', 'application/ndjson', 'application/jsonl')
+CSV_TYPES = ('text/csv',)
+
+
+class UnsupportedFormat(ValueError):
+    """Raised when a request body is neither NDJSON nor CSV."""
+
+
+def iter_ndjson(stream):
+    # Yield (record, error) for each non-empty line of stream.
+    for line in stream:
+        if not line.strip():
+            continue
+        try:
+            record = json.loads(line)
+        except ValueError:
+            yield None, 'Row is not valid JSON.'
+            continue
+        if not isinstance(record, dict):
+            yield None, 'Row must be a JSON object.'
+            continue
+        yield record, None
+
+
+def iter_csv(stream):
+    # Yield (record, error) for each row of stream following its header. Empty
+      # cells are treated as missing values.
+    lines = (line.decode('utf-8', errors='replace') for line in stream)
+    for record in csv.DictReader(lines):
+        if None in record:
+            yield None, 'Row has more fields than the header.'
+            continue
+        yield {key: value for key, value in record.items() if value not in (None, '')}, None
+
+
+def iter_records(stream, mimetype: str):
+    if mimetype in NDJSON_TYPES:
+        return iter_ndjson(stream)
+    if mimetype in CSV_TYPES:
+        return iter_csv(stream)
+    raise UnsupportedFormat('Content type must be one of {}.'.format(
+        ', '.join(NDJSON_TYPES + CSV_TYPES)))
+
+
+def batched(iterable, size: int):
+    # Yield lists of up to size items from iterable.
+    iterator = iter(iterable)
+    batch = list(islice(iterator, size))
+    while batch:
+        yield batch
+        batch = list(islice(iterator, size))
@@ -0,0 +1,253 @@
+# -*- coding: utf-8 -*-
+"""Background tasks run by a worker process from a Redis queue.
+
+Functions decorated with ``task_queue.task`` gain a ``delay`` method that queues
+a call, so slow side effects such as sending email happen after the response has
+been returned. Arguments must be JSON serializable. Run a worker next to the app:
+
+    > python worker.py
+
+A failed task is retried up to ``TASK_MAX_RETRIES`` times, waiting
+``TASK_RETRY_DELAY`` seconds before the first retry and twice as long before each
+one after that, then kept on a list of failed tasks for inspection. With
+``TASK_QUEUE_BACKEND = 'eager'`` tasks run in process as soon as they are queued,
+retries included, which is what the tests use. Calls made inside a
+``models.transaction()`` block are queued after it commits.
+
+A worker moves each task it takes onto its own processing list and removes it once
+the task has run, so tasks are run at least once. Workers renew a heartbeat key
+while running, and a starting worker puts the tasks of any worker whose heartbeat
+has been missing for ``TASK_WORKER_TIMEOUT`` seconds back on the queue, so the
+timeout should be longer than any task takes to run.
+"""
+
+import json
+import os
+import socket
+import time
+import uuid
+import logging
+
+from functools import partial
+from redis.exceptions import RedisError
+
+logger = logging.getLogger(__name__)
+
+# Move tasks in KEYS[1] whose retry is due at ARGV[1] to the queue in KEYS[2].
+MOVE_DUE_SCRIPT = """
+local due = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1])
+for _, job in ipairs(due) do
+    redis.call('ZREM', KEYS[1], job)
+    redis.call('LPUSH', KEYS[2], job)
+end
+return #due
+"""
+
+
+class TaskQueue(object):
+    """Queue task calls in Redis and run them in a worker, see the module docstring."""
+
+    key_prefix = 'tasks:'
+    max_failed = 1000
+    # Longest wait between attempts to reach Redis after an error, in seconds.
+    max_backoff = 30
+
+    def __init__(self, app=None):
+        self.tasks = {}
+        self.backend = 'redis'
+        self.redis = None
+        self.db = None
+        self.max_retries = 3
+        self.retry_delay = 10.0
+        self.worker_timeout = 60
+        self.failed = []
+        self._move_due = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app, db=None):
+        self.db = db
+        self.backend = app.config.get('TASK_QUEUE_BACKEND', 'redis')
+        if self.backend not in ('redis', 'eager'):
+            raise ValueError('Unknown TASK_QUEUE_BACKEND {}.'.format(self.backend))
+        self.redis = app.config['SESSION_REDIS']
+        self.max_retries = int(app.config.get('TASK_MAX_RETRIES', 3))
+        self.retry_delay = float(app.config.get('TASK_RETRY_DELAY', 10))
+        self.worker_timeout = int(app.config.get('TASK_WORKER_TIMEOUT', 60))
+        self._move_due = self.redis.register_script(MOVE_DUE_SCRIPT)
+
+    @property
+    def queue_key(self):
+        return self.key_prefix + 'queue'
+
+    @property
+    def scheduled_key(self):
+        return self.key_prefix + 'scheduled'
+
+    @property
+    def failed_key(self):
+        return self.key_prefix + 'failed'
+
+    @property
+    def workers_key(self):
+        return self.key_prefix + 'workers'
+
+    def processing_key(self, worker_id: str) -> str:
+        return self.key_prefix + 'processing:' + worker_id
+
+    def heartbeat_key(self, worker_id: str) -> str:
+        return self.key_prefix + 'heartbeat:' + worker_id
+
+    def task(self, f):
+        """Register f as a task and add ``f.delay`` to queue calls to it."""
+        name = '{}.{}'.format(f.__module__, f.__name__)
+        self.tasks[name] = f
+
+        def delay(*args, **kwargs):
+            return self.enqueue(name, *args, **kwargs)
+        f.delay = delay
+        return f
+
+    def enqueue(self, name: str, *args, **kwargs):
+        # Queue a call to the task registered as name and return its job id. Inside
+          # a models.transaction() block the job is queued once the block commits, so
+          # a worker never runs it before the rows it reads are visible.
+        job = {'id': uuid.uuid4().hex, 'name': name, 'args': list(args),
+               'kwargs': kwargs, 'attempts': 0}
+        session = self.db.session() if self.db is not None else None
+        if session is not None and session.info.get('transaction_depth'):
+            session.info['after_commit'].append(partial(self._push, job))
+            return job['id']
+        return job['id'] if self._push(job) else None
+
+    def _push(self, job: dict) -> bool:
+        if self.backend == 'eager':
+            self.run(job)
+            return True
+        try:
+            self.redis.lpush(self.queue_key, json.dumps(job))
+        except RedisError:
+            logger.error('Unable to queue task %s', job['name'], exc_info=True)
+            return False
+        return True
+
+    def work(self, app, burst: bool = False):
+        """Run queued tasks until interrupted, or until the queue is empty with burst."""
+        logger.info('Worker started with tasks: %s', ', '.join(sorted(self.tasks)))
+        worker_id = '{}:{}:{}'.format(socket.gethostname(), os.getpid(), uuid.uuid4().hex[:8])
+        processing_key = self.processing_key(worker_id)
+        errors = 0
+        started = False
+        try:
+            while True:
+                try:
+                    self._heartbeat(worker_id)
+                    if not started:
+                        started = True
+                        self.requeue_orphans()
+                    self._move_due(keys=[self.scheduled_key, self.queue_key], args=[time.time()])
+                    if burst:
+                        item = self.redis.rpoplpush(self.queue_key, processing_key)
+                    else:
+                        item = self.redis.brpoplpush(self.queue_key, processing_key, timeout=1)
+                    errors = 0
+                    if item is None:
+                        if burst:
+                            return
+                        continue
+                    with app.app_context():
+                        self.run(json.loads(item))
+                    self.redis.lrem(processing_key, 1, item)
+                except RedisError:
+                    # Tasks taken before the error stay on the processing list and are
+                      # run again if this worker stops before it can remove them.
+                    errors += 1
+                    backoff = min(2 ** errors, self.max_backoff)
+                    logger.exception('Redis error in worker, retrying in %ss', backoff)
+                    time.sleep(backoff)
+        finally:
+            if started:
+                self._stop(worker_id)
+
+    def requeue_orphans(self) -> int:
+        # Move tasks held by workers whose heartbeat has expired back to the queue.
+        requeued = 0
+        for worker_id in self.redis.smembers(self.workers_key):
+            worker_id = worker_id.decode('utf-8')
+            if self.redis.exists(self.heartbeat_key(worker_id)):
+                continue
+            processing_key = self.processing_key(worker_id)
+            while self.redis.rpoplpush(processing_key, self.queue_key) is not None:
+                requeued += 1
+            self.redis.srem(self.workers_key, worker_id)
+        if requeued:
+            logger.warning('Requeued %s tasks of stopped workers', requeued)
+        return requeued
+
+    def run(self, job: dict):
+        # Call the job's task, scheduling a retry or recording the failure if it raises.
+        func = self.tasks.get(job['name'])
+        if func is None:
+            logger.error('Task %s is not registered', job['name'])
+            self._fail(job)
+            return
+        try:
+            func(*job['args'], **job['kwargs'])
+        except Exception:
+            job['attempts'] += 1
+            if job['attempts'] > self.max_retries:
+                logger.exception('Task %s failed after %s attempts', job['name'], job['attempts'])
+                self._fail(job)
+                return
+            delay = self.retry_delay * 2 ** (job['attempts'] - 1)
+            logger.warning('Task %s failed, retrying in %ss', job['name'], delay, exc_info=True)
+            self._retry(job, delay)
+
+    def clear(self):
+        # Remove all queued, scheduled, processing and failed tasks.
+        self.failed = []
+        workers = [worker_id.decode('utf-8') for worker_id in self.redis.smembers(self.workers_key)]
+        self.redis.delete(self.queue_key, self.scheduled_key, self.failed_key, self.workers_key,
+                          *[self.processing_key(worker_id) for worker_id in workers])
+
+    def stats(self) -> dict:
+        if self.backend == 'eager':
+            return {'queued': 0, 'scheduled': 0, 'failed': len(self.failed)}
+        pipe = self.redis.pipeline(transaction=False)
+        pipe.llen(self.queue_key)
+        pipe.zcard(self.scheduled_key)
+        pipe.llen(self.failed_key)
+        queued, scheduled, failed = pipe.execute()
+        return {'queued': queued, 'scheduled': scheduled, 'failed': failed}
+
+    def _heartbeat(self, worker_id: str):
+        pipe = self.redis.pipeline()
+        pipe.sadd(self.workers_key, worker_id)
+        pipe.set(self.heartbeat_key(worker_id), 1, ex=self.worker_timeout)
+        pipe.execute()
+
+    def _stop(self, worker_id: str):
+        # Deregister a worker, returning any tasks it still holds to the queue.
+        try:
+            self.redis.delete(self.heartbeat_key(worker_id))
+            self.requeue_orphans()
+        except RedisError:
+            logger.warning('Unable to deregister worker %s', worker_id, exc_info=True)
+
+    def _retry(self, job: dict, delay: float):
+        if self.backend == 'eager':
+            self.run(job)
+            return
+        self.redis.zadd(self.scheduled_key, {json.dumps(job): time.time() + delay})
+
+    def _fail(self, job: dict):
+        if self.backend == 'eager':
+            self.failed.append(job)
+            return
+        pipe = self.redis.pipeline()
+        pipe.lpush(self.failed_key, json.dumps(job))
+        pipe.ltrim(self.failed_key, 0, self.max_failed - 1)
+        pipe.execute()
+
+
+task_queue = TaskQueue()
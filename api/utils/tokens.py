@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+"""Signing and verification of account and session tokens.
+
+Keys are parsed once when the app starts instead of on every call. Tokens are
+signed with ``PRIVATE_KEY`` using ``JWT_ALGORITHM``:
+
+* ``RS256``, the default, with an RSA key.
+* ``ES256``, with an EC key on the P-256 curve.
+* ``EdDSA``, with an Ed25519 key. Signing is much faster than with RSA, and
+    it is available when the installed cryptography supports Ed25519.
+
+Each token names the key that signed it in its ``kid`` header, a fingerprint of
+the public key. To rotate keys, deploy the new pair and move the old public key
+to ``PREVIOUS_PUBLIC_KEYS`` (PEM blocks, one after another), so tokens signed
+with it are accepted until they expire.
+"""
+
+import hashlib
+import jwt
+
+from cryptography.exceptions import InvalidSignature
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives.asymmetric import ec, rsa
+from cryptography.hazmat.primitives.serialization import (
+    Encoding, PublicFormat, load_pem_private_key, load_pem_public_key)
+from jwt.algorithms import Algorithm
+from jwt.utils import force_bytes
+
+try:
+    from cryptography.hazmat.primitives.asymmetric.ed25519 import (
+        Ed25519PrivateKey, Ed25519PublicKey)
+except ImportError:  # cryptography < 2.6
+    Ed25519PrivateKey = Ed25519PublicKey = None
+
+PEM_END = b'-----END PUBLIC KEY-----'
+
+
+class EdDSAAlgorithm(Algorithm):
+    """Ed25519 signatures for PyJWT versions that do not provide them."""
+
+    def prepare_key(self, key):
+        if isinstance(key, (Ed25519PrivateKey, Ed25519PublicKey)):
+            return key
+        key = force_bytes(key)
+        if b'PRIVATE' in key:
+            return load_pem_private_key(key, password=None, backend=default_backend())
+        return load_pem_public_key(key, backend=default_backend())
+
+    def sign(self, msg, key):
+        return key.sign(msg)
+
+    def verify(self, msg, key, sig):
+        try:
+            key.verify(sig, msg)
+            return True
+        except InvalidSignature:
+            return False
+
+
+if Ed25519PrivateKey is not None and 'EdDSA' not in jwt.algorithms.get_default_algorithms():
+    jwt.register_algorithm('EdDSA', EdDSAAlgorithm())
+
+
+def key_algorithm(key) -> str:
+    # Default algorithm for a public key, None for unsupported keys.
+    if isinstance(key, rsa.RSAPublicKey):
+        return 'RS256'
+    if isinstance(key, ec.EllipticCurvePublicKey):
+        return 'ES256' if isinstance(key.curve, ec.SECP256R1) else None
+    if Ed25519PublicKey is not None and isinstance(key, Ed25519PublicKey):
+        return 'EdDSA'
+    return None
+
+
+def algorithm_family(algorithm: str) -> str:
+    # Key type an algorithm signs with, None for algorithms that are not supported.
+    if algorithm in ('RS256', 'RS384', 'RS512', 'PS256', 'PS384', 'PS512'):
+        return 'RSA'
+    if algorithm == 'ES256':
+        return 'EC'
+    if algorithm == 'EdDSA' and Ed25519PrivateKey is not None:
+        return 'Ed25519'
+    return None
+
+
+def key_id(public_key) -> str:
+    der = public_key.public_bytes(Encoding.DER, PublicFormat.SubjectPublicKeyInfo)
+    return hashlib.sha256(der).hexdigest()[:16]
+
+
+def split_pem(keys: str) -> list:
+    # Split concatenated PEM public keys into a list of PEM blocks.
+    blocks = force_bytes(keys or '').split(PEM_END)
+    return [block.strip() + b'\n' + PEM_END for block in blocks if block.strip()]
+
+
+class TokenSigner(object):
+    """Sign and verify JWTs with keys parsed once, see the module docstring."""
+
+    def __init__(self, app=None):
+        self.algorithm = 'RS256'
+        self.kid = None
+        self.private_key = None
+        # kid: (algorithm, public key) of every key tokens are accepted from
+        self.public_keys = {}
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        # Keys are optional, without them encode and decode raise.
+        self.configure(app.config.get('JWT_ALGORITHM', 'RS256'),
+                       app.config.get('PRIVATE_KEY'),
+                       app.config.get('PUBLIC_KEY'),
+                       app.config.get('PREVIOUS_PUBLIC_KEYS'))
+
+    def configure(self, algorithm: str, private_pem: str, public_pem: str,
+                  previous_pems: str = None):
+        if algorithm_family(algorithm) is None:
+            raise ValueError('Unsupported JWT_ALGORITHM {}.'.format(algorithm))
+        self.algorithm = algorithm
+        self.kid = None
+        self.private_key = None
+        self.public_keys = {}
+        for pem in split_pem(previous_pems):
+            public_key = load_pem_public_key(pem, backend=default_backend())
+            previous_algorithm = key_algorithm(public_key)
+            if previous_algorithm is None:
+                raise ValueError('Unsupported key in PREVIOUS_PUBLIC_KEYS.')
+            self.public_keys[key_id(public_key)] = (previous_algorithm, public_key)
+        if not private_pem or not public_pem:
+            return
+        private_key = load_pem_private_key(force_bytes(private_pem), password=None,
+                                           backend=default_backend())
+        public_key = load_pem_public_key(force_bytes(public_pem), backend=default_backend())
+        if key_id(private_key.public_key()) != key_id(public_key):
+            raise ValueError('PRIVATE_KEY and PUBLIC_KEY are not a pair.')
+        if algorithm_family(key_algorithm(public_key) or '') != algorithm_family(self.algorithm):
+            raise ValueError('JWT_ALGORITHM {} does not match the key type.'.format(self.algorithm))
+        self.private_key = private_key
+        self.kid = key_id(public_key)
+        self.public_keys[self.kid] = (self.algorithm, public_key)
+
+    @property
+    def enabled(self) -> bool:
+        return self.private_key is not None
+
+    def encode(self, payload: dict) -> str:
+        if self.private_key is None:
+            raise ValueError('PRIVATE_KEY and PUBLIC_KEY must be set to sign tokens.')
+        token = jwt.encode(payload, self.private_key, algorithm=self.algorithm,
+                           headers={'kid': self.kid})
+        return token.decode('utf-8')
+
+    def decode(self, token: str) -> dict:
+        # Verify token with the key named by its kid, raising jwt.InvalidTokenError
+          # subclasses like jwt.decode. Tokens without a kid use the current key.
+        kid = jwt.get_unverified_header(token).get('kid', self.kid)
+        if kid not in self.public_keys:
+            raise jwt.InvalidTokenError('Token was signed with an unknown key.')
+        algorithm, public_key = self.public_keys[kid]
+        return jwt.decode(token, public_key, algorithms=[algorithm])
+
+
+token_signer = TokenSigner()
@@ -0,0 +1,151 @@
+# -*- coding: utf-8 -*-
+"""Per-user and per-client data version counters and conditional GET support.
+
+Every write to a user's data bumps a counter in Redis. Responses carry a strong
+ETag derived from the counter and the request, so a client polling with
+``If-None-Match`` gets a 304 without the view querying Postgres or serializing.
+"""
+
+import time
+import hashlib
+
+from functools import wraps
+from flask import current_app, g, make_response, request, Response
+from redis.exceptions import RedisError
+
+from utils.cache import response_cache
+
+
+class DataVersions(object):
+    """Version counters stored in Redis under ``version:<kind>:<id>``.
+
+    Counters are created by the first write and start from the current time in
+    milliseconds rather than zero, so an ETag issued before the counters were lost
+    can not match after they are recreated. Until then responses carry no ETag.
+    """
+
+    key_prefix = 'version:'
+
+    def __init__(self, app=None):
+        self.redis = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.redis = app.config['SESSION_REDIS']
+
+    def user(self, user_id: int):
+        return self._get('user:{}'.format(user_id))
+
+    def client(self, client_id: int):
+        return self._get('client:{}'.format(client_id))
+
+    def bump_user(self, user_id: int):
+        self._bump('user:{}'.format(user_id))
+
+    def bump_client(self, client_id: int, user_id: int = None):
+        # Changes to a client are also changes to its owner's listings.
+        self._bump('client:{}'.format(client_id))
+        if user_id is not None:
+            self.bump_user(user_id)
+
+    def _get(self, name: str):
+        # Return the current version, or None if it can not be read or has not been
+          # created by a write yet. Reads never create keys, request URLs name the ids.
+        if self.redis is None:
+            return None
+        try:
+            version = self.redis.get(self.key_prefix + name)
+        except RedisError:
+            return None
+        return int(version) if version is not None else None
+
+    def _bump(self, name: str):
+        if self.redis is None:
+            return
+        key = self.key_prefix + name
+        try:
+            pipe = self.redis.pipeline()
+            pipe.set(key, int(time.time() * 1000), nx=True)
+            pipe.incr(key)
+            pipe.execute()
+        except RedisError:
+            pass
+
+
+def request_etag(version) -> str:
+    # Return an ETag for the current request at version, or None without a version.
+    if version is None:
+        return None
+    digest = hashlib.sha1()
+    user_id = str(g.user.id) if 'user' in g else ''
+    for part in (request.endpoint, request.full_path, user_id, str(version)):
+        digest.update(part.encode('utf-8'))
+        digest.update(b'\0')
+    digest.update(request.get_data())
+    return digest.hexdigest()
+
+
+def set_cache_headers(resp):
+    # Let HTTP caches store a response for HTTP_CACHE_MAX_AGE seconds and revalidate
+      # it with its ETag. Responses depend on the session, so they vary by cookie and
+      # only private caches may store them unless HTTP_CACHE_SHARED is set.
+    resp.cache_control.max_age = current_app.config['HTTP_CACHE_MAX_AGE']
+    if current_app.config['HTTP_CACHE_SHARED']:
+        resp.cache_control.public = True
+    else:
+        resp.cache_control.private = True
+    resp.vary.add('Cookie')
+
+
+def conditional_get(version_func, cache_response: bool = False, http_cache: bool = False):
+    """Serve a GET method with an ETag for the version returned by ``version_func``.
+
+    Requests whose ``If-None-Match`` header contains the current ETag are answered
+    with a 304 before the view runs. With ``cache_response`` successful response
+    bodies are also kept in the response cache under the ETag, and served from it
+    until the version changes. With ``http_cache`` responses carry Cache-Control
+    and Vary headers, see set_cache_headers.
+    """
+    def decorator(f):
+        @wraps(f)
+        def decorated(*args, **kwargs):
+            etag = request_etag(version_func())
+            if etag is None:
+                return f(*args, **kwargs)
+            if request.if_none_match.contains(etag):
+                resp = Response(status=304)
+                resp.set_etag(etag)
+                if http_cache:
+                    set_cache_headers(resp)
+                return resp
+
+            cache_key = '{}:{}'.format(g.user.id, etag)
+            cached = response_cache.get(cache_key) if cache_response else None
+            if cached is not None:
+                status, body = cached
+                resp = Response(body, status=status, mimetype='application/json')
+            else:
+                resp = make_response(f(*args, **kwargs))
+                if cache_response and resp.status_code < 300:
+                    response_cache.set(cache_key, resp.status_code, resp.get_data())
+            if resp.status_code < 300:
+                resp.set_etag(etag)
+                if http_cache:
+                    set_cache_headers(resp)
+            return resp
+        return decorated
+    return decorator
+
+
+data_versions = DataVersions()
+
+
+def current_user_version():
+    # Version of everything owned by the authenticated user, see login_required.
+    return data_versions.user(g.user.id)
+
+
+def url_client_version():
+    # Version of the client addressed by the request URL, which includes its projects.
+    return data_versions.client(request.view_args['client_id'])
@@ -0,0 +1,9 @@
+import logging
+
+from run import app
+from utils.tasks import task_queue
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    task_queue.work(app)